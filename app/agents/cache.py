@@ -0,0 +1,119 @@
+import json
+import os
+import re
+from typing import Any, AsyncGenerator, List, Optional
+
+from llama_index.core.llms import ChatMessage, ChatResponse
+from llama_index.core.llms.function_calling import FunctionCallingLLM
+from llama_index.core.tools import ToolSelection
+from llama_index.core.tools.types import BaseTool
+from pydantic import BaseModel
+
+from app.cache import TieredCache, hash_key
+
+
+class CachedLLMResponse(BaseModel):
+    response: ChatResponse
+    tool_calls: List[ToolSelection]
+
+    async def stream(self) -> AsyncGenerator[ChatResponse, None]:
+        """
+        Replay the cached response as a stream of chunks
+        """
+        content = ""
+        for delta in re.findall(r"\s*\S+\s*", self.response.message.content or ""):
+            content += delta
+            yield ChatResponse(
+                message=ChatMessage(role=self.response.message.role, content=content),
+                delta=delta,
+            )
+
+
+class LLMResponseCache:
+    """
+    Cache for LLM responses of agent turns. The key is a hash of the model, its temperature, the tools and the messages.
+    """
+
+    def __init__(
+        self,
+        max_size: int = 1024,
+        ttl: Optional[float] = None,
+        cache_dir: Optional[str] = None,
+    ) -> None:
+        self._cache = TieredCache(
+            name="llm_cache",
+            max_size=max_size,
+            ttl=ttl,
+            path=os.path.join(cache_dir, "llm_responses.db") if cache_dir else None,
+        )
+
+    @staticmethod
+    def get_key(
+        llm: FunctionCallingLLM,
+        tools: List[BaseTool],
+        chat_history: List[ChatMessage],
+    ) -> str:
+        return hash_key(
+            llm.class_name(),
+            llm.metadata.model_name,
+            getattr(llm, "temperature", None),
+            [
+                (
+                    tool.metadata.get_name(),
+                    tool.metadata.description,
+                    tool.metadata.get_parameters_dict(),
+                )
+                for tool in tools
+            ],
+            [message.model_dump() for message in chat_history],
+        )
+
+    def get(self, key: str) -> Optional[CachedLLMResponse]:
+        value = self._cache.get(key)
+        if value is None:
+            return None
+        return CachedLLMResponse.model_validate(value)
+
+    def set(
+        self, key: str, response: ChatResponse, tool_calls: List[ToolSelection]
+    ) -> None:
+        # only keep the message, the raw response of the provider is not serializable
+        message = ChatMessage(
+            role=response.message.role,
+            content=response.message.content,
+            additional_kwargs=_to_json(response.message.additional_kwargs),
+        )
+        cached = CachedLLMResponse(
+            response=ChatResponse(message=message), tool_calls=tool_calls
+        )
+        self._cache.set(key, cached.model_dump(mode="json"))
+
+
+def _to_json(value: Any) -> Any:
+    # provider specific objects, e.g. OpenAI tool calls, are converted to plain dicts
+    return json.loads(
+        json.dumps(
+            value,
+            default=lambda o: o.model_dump() if hasattr(o, "model_dump") else str(o),
+        )
+    )
+
+
+_llm_response_cache: Optional[LLMResponseCache] = None
+
+
+def get_llm_response_cache() -> Optional[LLMResponseCache]:
+    """
+    Get the process-wide LLM response cache, None if it's not enabled by setting `LLM_CACHE=true`
+    """
+    global _llm_response_cache
+    if os.getenv("LLM_CACHE", "false").lower() != "true":
+        return None
+    if _llm_response_cache is None:
+        ttl = os.getenv("LLM_CACHE_TTL", "86400")
+        _llm_response_cache = LLMResponseCache(
+            max_size=int(os.getenv("LLM_CACHE_SIZE", "1024")),
+            ttl=float(ttl) if ttl else None,
+            cache_dir=os.getenv("LLM_CACHE_DIR"),
+        )
+    return _llm_response_cache
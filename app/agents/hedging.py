@@ -0,0 +1,187 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from typing import (
+    Any,
+    AsyncGenerator,
+    Awaitable,
+    Callable,
+    Dict,
+    Optional,
+    Tuple,
+    TypeVar,
+)
+
+from llama_index.core.llms import LLM
+from pydantic import BaseModel
+
+from app.budget import check_budget
+from app.observability import metrics
+from app.settings import ModelConfig, create_llm, load_models_config
+
+logger = logging.getLogger("uvicorn")
+
+T = TypeVar("T")
+
+
+class HedgingConfig(BaseModel):
+    # percentile of the latest latencies after which the request is hedged
+    percentile: float = 95
+    # number of latencies to keep and needed before the percentile is used
+    window: int = 100
+    min_samples: int = 20
+    # deadline in seconds until enough latencies are known
+    initial_deadline: float = 30
+    # model for the duplicate request, the same model is used if not set
+    fallback: Optional[ModelConfig] = None
+
+
+class LatencyTracker:
+    def __init__(self, window: int) -> None:
+        self._latencies: deque = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def add(self, latency: float) -> None:
+        with self._lock:
+            self._latencies.append(latency)
+
+    def percentile(self, percentile: float, min_samples: int) -> Optional[float]:
+        with self._lock:
+            if len(self._latencies) < min_samples:
+                return None
+            latencies = sorted(self._latencies)
+        index = min(int(len(latencies) * percentile / 100), len(latencies) - 1)
+        return latencies[index]
+
+
+class Hedger:
+    """
+    Sends a duplicate of an LLM request if it's slower than the configured percentile of the latest requests.
+    The first response wins, the slower request is cancelled.
+    Metrics: `hedging.<name>.hedged` requests, of which `hedging.<name>.hedge_wins` were answered by the duplicate.
+    """
+
+    def __init__(self, name: str, config: HedgingConfig) -> None:
+        self.name = name
+        self.config = config
+        self._trackers: Dict[str, LatencyTracker] = {}
+        self._fallback_llm: Optional[LLM] = None
+
+    def get_fallback_llm(self, llm: LLM) -> LLM:
+        if self.config.fallback is None:
+            return llm
+        if self._fallback_llm is None:
+            self._fallback_llm = create_llm(self.config.fallback)
+        return self._fallback_llm
+
+    def get_deadline(self, kind: str) -> float:
+        tracker = self._trackers.setdefault(kind, LatencyTracker(self.config.window))
+        deadline = tracker.percentile(self.config.percentile, self.config.min_samples)
+        return deadline if deadline is not None else self.config.initial_deadline
+
+    async def run(
+        self,
+        llm: LLM,
+        call: Callable[[LLM], Awaitable[T]],
+        kind: str = "response",
+        discard: Optional[Callable[[T], Awaitable[Any]]] = None,
+    ) -> T:
+        """
+        Run `call` with the LLM and hedge it with the fallback LLM once the deadline for this kind of call is exceeded,
+        e.g. the full response or the first token of a stream.
+        `discard` is called with the result of the slower call if both finished.
+        """
+        deadline = self.get_deadline(kind)
+        start = time.perf_counter()
+        primary = asyncio.create_task(call(llm))
+        done, _ = await asyncio.wait({primary}, timeout=deadline)
+        if done:
+            self._trackers[kind].add(time.perf_counter() - start)
+            return primary.result()
+
+        metrics.incr(f"hedging.{self.name}.hedged")
+        logger.info(
+            f"Hedging request of {self.name} after {deadline:.1f}s without a {kind}"
+        )
+        hedge = asyncio.create_task(call(self.get_fallback_llm(llm)))
+        pending = {primary, hedge}
+        winner = None
+        try:
+            while pending and winner is None:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                # prefer a successful request, a failed one only wins if both failed
+                winner = next((task for task in done if not task.exception()), None)
+        finally:
+            for task in pending:
+                task.cancel()
+            # the latency of a cancelled primary request is at least the time until now
+            self._trackers[kind].add(time.perf_counter() - start)
+
+        if winner is None:
+            return primary.result()
+        for task in (primary, hedge):
+            if task is not winner and task.done() and not task.cancelled():
+                if not task.exception() and discard is not None:
+                    await discard(task.result())
+        if winner is hedge:
+            metrics.incr(f"hedging.{self.name}.hedge_wins")
+        return winner.result()
+
+
+_hedgers: Dict[str, Optional[Hedger]] = {}
+
+
+def get_hedger(name: str) -> Optional[Hedger]:
+    """
+    Get the process-wide hedger of an agent, None if hedging isn't configured for the agent in config/models.yaml
+    """
+    if name not in _hedgers:
+        config = (load_models_config().get("hedging") or {}).get(name)
+        _hedgers[name] = (
+            Hedger(name, HedgingConfig(**config)) if config is not None else None
+        )
+    return _hedgers[name]
+
+
+async def call_llm(
+    llm: LLM,
+    call: Callable[[LLM], Awaitable[T]],
+    hedger: Optional[Hedger] = None,
+    kind: str = "response",
+    discard: Optional[Callable[[T], Awaitable[Any]]] = None,
+) -> T:
+    # fail instead of sending a request if the token budget of the run is used up
+    check_budget()
+    if hedger is None:
+        return await call(llm)
+    return await hedger.run(llm, call, kind=kind, discard=discard)
+
+
+async def start_stream(stream: Awaitable, llm: LLM) -> Tuple[LLM, Optional[Any], Any]:
+    """
+    Start a stream of an LLM and wait for its first chunk, so the time to the first token can be hedged
+    """
+    response_stream = await stream
+    try:
+        first_chunk = await anext(response_stream, None)
+    except BaseException:
+        # e.g. cancelled by the hedger as the other request was faster
+        await response_stream.aclose()
+        raise
+    return llm, first_chunk, response_stream
+
+
+async def resume_stream(
+    first_chunk: Optional[Any], response_stream: Any
+) -> AsyncGenerator:
+    """
+    Stream the first chunk (returned by `start_stream`) and the remaining chunks
+    """
+    if first_chunk is not None:
+        yield first_chunk
+    async for chunk in response_stream:
+        yield chunk
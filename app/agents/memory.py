@@ -0,0 +1,197 @@
+import bisect
+import textwrap
+from typing import Any, List, Optional, Tuple
+
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.llms import ChatMessage, MessageRole
+from llama_index.core.memory import ChatMemoryBuffer
+
+
+class TokenCountingChatMemory(ChatMemoryBuffer):
+    """
+    Chat memory buffer that tokenizes each message only once instead of the whole history on each `get`.
+    The running token totals of the messages are kept, so the history is trimmed to the token limit with a binary search.
+    Messages are counted again if they are replaced or their content is changed, e.g. by applying edits to a draft.
+    Unlike `ChatMemoryBuffer`, the trimmed history never starts with a tool result, also for parallel tool calls.
+    """
+
+    # the counted messages with their content when they were counted
+    _counted: List[Tuple[ChatMessage, Any]] = PrivateAttr(default_factory=list)
+    # _token_totals[i] is the number of tokens of the first i messages
+    _token_totals: List[int] = PrivateAttr(default_factory=lambda: [0])
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "TokenCountingChatMemory"
+
+    def get(
+        self, input: Optional[str] = None, initial_token_count: int = 0, **kwargs: Any
+    ) -> List[ChatMessage]:
+        chat_history = self.get_all()
+
+        if initial_token_count > self.token_limit:
+            raise ValueError("Initial token count exceeds token limit")
+
+        self._update_token_counts(chat_history)
+        totals = self._token_totals
+        # first message from which on the messages fit into the token limit
+        start = bisect.bisect_left(
+            totals, totals[-1] + initial_token_count - self.token_limit
+        )
+        if start > 0:
+            # the history can't start with an answer or a tool result of a trimmed message
+            while start < len(chat_history) and chat_history[start].role in (
+                MessageRole.ASSISTANT,
+                MessageRole.TOOL,
+            ):
+                start += 1
+        return chat_history[start:]
+
+    def _update_token_counts(self, messages: List[ChatMessage]) -> None:
+        counted = self._counted
+        valid = 0
+        for (message, content), current in zip(counted, messages):
+            if message is not current or message.content is not content:
+                break
+            valid += 1
+        del counted[valid:]
+        del self._token_totals[valid + 1 :]
+        for message in messages[valid:]:
+            counted.append((message, message.content))
+            self._token_totals.append(
+                self._token_totals[-1] + len(self.tokenizer_fn(str(message.content)))
+            )
+
+    def _token_count_for_messages(self, messages: List[ChatMessage]) -> int:
+        # the counts are known if the messages are the latest messages of the memory, e.g. the latest turn
+        count = len(messages)
+        counted = self._counted[len(self._counted) - count :]
+        if 0 < count <= len(self._counted) and all(
+            message is current and message.content is content
+            for (message, content), current in zip(counted, messages)
+        ):
+            return self._token_totals[-1] - self._token_totals[-count - 1]
+        return sum(len(self.tokenizer_fn(str(message.content))) for message in messages)
+
+
+class CompactingChatMemory(TokenCountingChatMemory):
+    """
+    Chat memory for agents that are run multiple times on revisions of the same content, e.g. the writer in a review loop.
+    The system prompt and the latest turn (the last user message with all following messages) are kept verbatim.
+    Earlier turns are superseded: once the next user message is put, they are compacted to their user message
+    and final answer, each shortened to about `summary_tokens` tokens, and stored compacted.
+    If the history still exceeds the token limit, the oldest compacted turns are dropped.
+    """
+
+    summary_tokens: int = 100
+
+    # number of messages at the start of the history that are compacted already
+    _num_compacted: int = PrivateAttr(default=0)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CompactingChatMemory"
+
+    def put(self, message: ChatMessage) -> None:
+        if message.role == MessageRole.SYSTEM and any(
+            msg.role == MessageRole.SYSTEM and msg.content == message.content
+            for msg in self.get_all()
+        ):
+            # the system prompt is added each time the agent is run, just keep it once
+            return
+        if message.role == MessageRole.USER:
+            self._compact_superseded_turns()
+        super().put(message)
+
+    def set(self, messages: List[ChatMessage]) -> None:
+        self._num_compacted = 0
+        super().set(messages)
+
+    def reset(self) -> None:
+        self._num_compacted = 0
+        super().reset()
+
+    def get(
+        self, input: Optional[str] = None, initial_token_count: int = 0, **kwargs: Any
+    ) -> List[ChatMessage]:
+        chat_history = self.get_all()
+        self._update_token_counts(chat_history)
+        totals = self._token_totals
+        # the system messages at the start are always kept
+        num_system = 0
+        while (
+            num_system < len(chat_history)
+            and chat_history[num_system].role == MessageRole.SYSTEM
+        ):
+            num_system += 1
+        latest_turn = next(
+            (
+                i
+                for i in range(len(chat_history) - 1, num_system - 1, -1)
+                if chat_history[i].role == MessageRole.USER
+            ),
+            num_system,
+        )
+
+        # first message from which on the messages fit into the token limit
+        start = bisect.bisect_left(
+            totals,
+            totals[-1] - (self.token_limit - initial_token_count - totals[num_system]),
+            lo=num_system,
+        )
+        if start <= latest_turn:
+            # the oldest compacted turns are dropped as a whole
+            while start < latest_turn and chat_history[start].role != MessageRole.USER:
+                start += 1
+        else:
+            # the latest turn alone is too long, it can't start with an answer or a tool result of a trimmed message
+            while start < len(chat_history) and chat_history[start].role in (
+                MessageRole.ASSISTANT,
+                MessageRole.TOOL,
+            ):
+                start += 1
+        return [*chat_history[:num_system], *chat_history[start:]]
+
+    def _compact_superseded_turns(self) -> None:
+        chat_history = self.get_all()
+        if self._num_compacted > len(chat_history):
+            # the history was replaced
+            self._num_compacted = 0
+        compacted = chat_history[: self._num_compacted]
+        turn: List[ChatMessage] = []
+        for message in chat_history[self._num_compacted :]:
+            if message.role == MessageRole.SYSTEM:
+                compacted.append(message)
+                continue
+            if message.role == MessageRole.USER and turn:
+                compacted.extend(self._compact_turn(turn))
+                turn = []
+            turn.append(message)
+        if turn:
+            compacted.extend(self._compact_turn(turn))
+        self._num_compacted = len(compacted)
+        if len(compacted) != len(chat_history) or any(
+            message is not current for message, current in zip(compacted, chat_history)
+        ):
+            self.chat_store.set_messages(self.chat_store_key, compacted)
+
+    def _compact_turn(self, turn: List[ChatMessage]) -> List[ChatMessage]:
+        # only keep the task and the final answer, tool calls and their results are dropped
+        compacted = [self._shorten(turn[0])]
+        answer = turn[-1]
+        if (
+            len(turn) > 1
+            and answer.role == MessageRole.ASSISTANT
+            and not answer.additional_kwargs.get("tool_calls")
+        ):
+            compacted.append(self._shorten(answer))
+        return compacted
+
+    def _shorten(self, message: ChatMessage) -> ChatMessage:
+        content = textwrap.shorten(
+            str(message.content or ""),
+            # about four characters per token
+            width=self.summary_tokens * 4,
+            placeholder=" [...]",
+        )
+        return ChatMessage(role=message.role, content=content)
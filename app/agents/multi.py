@@ -1,5 +1,4 @@
-import asyncio
-from typing import Any, List
+from typing import Any, List, Optional
 
 from llama_index.core.tools.types import ToolMetadata, ToolOutput
 from llama_index.core.tools.utils import create_schema_from_function
@@ -11,11 +10,14 @@ from app.agents.single import (
     FunctionCallingAgent,
 )
 from app.agents.planner import StructuredPlannerAgent
+from app.budget import get_run_budget, is_token_budget_low
 
 
 class AgentCallTool(ContextAwareTool):
-    def __init__(self, agent: Workflow) -> None:
+    def __init__(self, agent: Workflow, max_calls: Optional[int] = None) -> None:
         self.agent = agent
+        # maximal number of calls of the agent per run
+        self.max_calls = max_calls
         name = f"call_{agent.name}"
 
         async def schema_call(input: str) -> str:
@@ -32,21 +34,36 @@ class AgentCallTool(ContextAwareTool):
             fn_schema=fn_schema,
         )
 
-    # overload the acall function with the ctx argument as it's needed for bubbling the events
+    # overload the acall function with the ctx argument of the calling agent
     async def acall(self, ctx: Context, input: str) -> ToolOutput:
-        task = asyncio.create_task(self.agent.run(input=input))
-        # bubble all events while running the agent to the calling agent
-        async for ev in self.agent.stream_events():
-            ctx.write_event_to_stream(ev)
-        ret: AgentRunResult = await task
-        response = ret.response.message.content
+        refusal = self._check_delegation()
+        if refusal is not None:
+            return ToolOutput(
+                content=refusal,
+                tool_name=self.metadata.name,
+                raw_input={"args": input, "kwargs": {}},
+                raw_output=refusal,
+            )
+        # the agent publishes its events into the event sink of the calling agent's run
+        ret: AgentRunResult = await self.agent.run(input=input)
         return ToolOutput(
-            content=str(response),
+            content=str(ret.response.message.content),
             tool_name=self.metadata.name,
             raw_input={"args": input, "kwargs": {}},
-            raw_output=response,
+            # the calling agent keeps the sources of the run, not a copy of the response
+            raw_output=ret,
         )
 
+    def _check_delegation(self) -> Optional[str]:
+        # returns why the agent can't be called, None if it can
+        if is_token_budget_low():
+            return f"The {self.agent.name} agent can't be called anymore as the token budget is almost used up. Finish the task without it."
+        budget = get_run_budget()
+        if self.max_calls is not None and budget is not None:
+            if budget.count_delegation(self.agent.name) > self.max_calls:
+                return f"The {self.agent.name} agent was already called {self.max_calls} times. Finish the task without it."
+        return None
+
 
 class AgentCallingAgent(FunctionCallingAgent):
     def __init__(
@@ -54,14 +71,25 @@ class AgentCallingAgent(FunctionCallingAgent):
         *args: Any,
         name: str,
         agents: List[FunctionCallingAgent] | None = None,
+        max_calls_per_agent: Optional[int] = None,
         **kwargs: Any,
     ) -> None:
         agents = agents or []
-        tools = [AgentCallTool(agent=agent) for agent in agents]
+        tools = [
+            AgentCallTool(agent=agent, max_calls=max_calls_per_agent)
+            for agent in agents
+        ]
         super().__init__(*args, name=name, tools=tools, **kwargs)
+        self.agents = agents
         # call add_workflows so agents will get detected by llama agents automatically
         self.add_workflows(**{agent.name: agent for agent in agents})
 
+    def list_prompts(self) -> List[str]:
+        prompts = super().list_prompts()
+        for agent in self.agents:
+            prompts.extend(agent.list_prompts())
+        return prompts
+
 
 class AgentOrchestrator(StructuredPlannerAgent):
     def __init__(
@@ -79,5 +107,12 @@ class AgentOrchestrator(StructuredPlannerAgent):
             tools=tools,
             **kwargs,
         )
+        self.agents = agents
         # call add_workflows so agents will get detected by llama agents automatically
         self.add_workflows(**{agent.name: agent for agent in agents})
+
+    def list_prompts(self) -> List[str]:
+        prompts = super().list_prompts()
+        for agent in self.agents:
+            prompts.extend(agent.list_prompts())
+        return prompts
@@ -1,7 +1,19 @@
 import asyncio
+import logging
+import os
+import re
 import uuid
 from enum import Enum
-from typing import Any, AsyncGenerator, Dict, List, Optional, Tuple, Union
+from typing import (
+    Any,
+    AsyncGenerator,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 
 from llama_index.core.agent.runner.planner import (
     DEFAULT_INITIAL_PLAN_PROMPT,
@@ -10,8 +22,10 @@ from llama_index.core.agent.runner.planner import (
     PlannerAgentState,
     SubTask,
 )
-from llama_index.core.bridge.pydantic import ValidationError
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.bridge.pydantic import BaseModel, ValidationError
 from llama_index.core.llms.function_calling import FunctionCallingLLM
+from llama_index.core.program.function_program import _get_function_tool
 from llama_index.core.prompts import PromptTemplate
 from llama_index.core.settings import Settings
 from llama_index.core.tools import BaseTool
@@ -20,11 +34,22 @@ from llama_index.core.workflow import (
     Event,
     StartEvent,
     StopEvent,
-    Workflow,
     step,
 )
 
+from app.agents.hedging import (
+    call_llm,
+    get_hedger,
+    resume_stream,
+    start_stream,
+)
 from app.agents.single import AgentRunEvent, AgentRunResult, FunctionCallingAgent
+from app.cache import SemanticCache, hash_key
+from app.checkpoint import CheckpointWorkflow, checkpointed
+from app.observability import metrics
+from app.settings import get_agent_llm
+
+logger = logging.getLogger("uvicorn")
 
 
 class ExecutePlanEvent(Event):
@@ -32,10 +57,12 @@ class ExecutePlanEvent(Event):
 
 
 class SubTaskEvent(Event):
+    plan_id: str
     sub_task: SubTask
 
 
 class SubTaskResultEvent(Event):
+    plan_id: str
     sub_task: SubTask
     result: AgentRunResult | AsyncGenerator
 
@@ -55,7 +82,12 @@ class PlanEvent(AgentRunEvent):
         return f"Plan {self.event_type.value}: Let's do: {sub_task_names}"
 
 
-class StructuredPlannerAgent(Workflow):
+class StructuredPlannerAgent(CheckpointWorkflow):
+    """
+    Agent creating a plan of sub tasks for its input and executing them with the executor.
+    Runs started with a `run_id` can be resumed: the plan, its refinements and the results of completed sub tasks are reused.
+    """
+
     def __init__(
         self,
         *args: Any,
@@ -64,11 +96,14 @@ class StructuredPlannerAgent(Workflow):
         tools: List[BaseTool] | None = None,
         timeout: float = 360.0,
         refine_plan: bool = False,
+        stream_plan: bool = False,
         **kwargs: Any,
     ) -> None:
         super().__init__(*args, timeout=timeout, **kwargs)
         self.name = name
         self.refine_plan = refine_plan
+        # start sub tasks without dependencies while the plan is still being generated
+        self.stream_plan = stream_plan
 
         self.tools = tools or []
         self.planner = Planner(llm=llm, tools=self.tools, verbose=self._verbose)
@@ -90,8 +125,38 @@ class StructuredPlannerAgent(Workflow):
         # set streaming
         ctx.data["streaming"] = getattr(ev, "streaming", False)
         ctx.data["task"] = ev.input
-
-        plan_id, plan = await self.planner.create_plan(input=ev.input)
+        ctx.data["started_sub_tasks"] = []
+        ctx.data["pending_results"] = []
+        ctx.data["discarded_plan_ids"] = []
+        ctx.data["sub_task_runs"] = []
+        # the history of the executor before the sub tasks of a streamed plan are started
+        ctx.data["executor_history"] = list(self.executor.memory.get_all())
+
+        def start_sub_task(plan_id: str, sub_task: SubTask) -> None:
+            if sub_task.dependencies:
+                return
+            ctx.data["act_plan_id"] = plan_id
+            ctx.data["started_sub_tasks"].append(sub_task.name)
+            ctx.send_event(SubTaskEvent(plan_id=plan_id, sub_task=sub_task))
+
+        def load_plan(value: dict) -> Tuple[str, Plan]:
+            # the sub tasks of a resumed plan are started once the plan is executed
+            plan = Plan.model_validate(value["plan"])
+            self.planner.state.plan_dict[value["plan_id"]] = plan
+            return value["plan_id"], plan
+
+        plan_id, plan = await checkpointed(
+            "plan",
+            lambda: self.planner.create_plan(
+                input=ev.input,
+                on_sub_task=start_sub_task if self.stream_plan else None,
+            ),
+            lambda created: {"plan_id": created[0], "plan": created[1].model_dump()},
+            load_plan,
+        )
+        streamed_plan_id = ctx.data.get("act_plan_id")
+        if streamed_plan_id is not None and streamed_plan_id != plan_id:
+            self.discard_streamed_plan(ctx, streamed_plan_id)
         ctx.data["act_plan_id"] = plan_id
 
         # inform about the new plan
@@ -104,15 +169,39 @@ class StructuredPlannerAgent(Workflow):
 
     @step()
     async def execute_plan(self, ctx: Context, ev: ExecutePlanEvent) -> SubTaskEvent:
-        upcoming_sub_tasks = self.planner.state.get_next_sub_tasks(
-            ctx.data["act_plan_id"]
+        next_sub_tasks = self.planner.state.get_next_sub_tasks(ctx.data["act_plan_id"])
+        # sub tasks that were already started while streaming the plan
+        started_sub_tasks = ctx.data["started_sub_tasks"]
+        upcoming_sub_tasks = [
+            sub_task
+            for sub_task in next_sub_tasks
+            if sub_task.name not in started_sub_tasks
+        ]
+        num_running_sub_tasks = len(next_sub_tasks) - len(upcoming_sub_tasks)
+
+        ctx.data["num_sub_tasks"] = len(upcoming_sub_tasks) + len(started_sub_tasks)
+        ctx.data["started_sub_tasks"] = []
+        # the result of the last sub task is the final response, so stream it if requested.
+        # refining the plan happens only after non-final batches of sub tasks, so this also works with plan refining
+        is_last_tasks = len(upcoming_sub_tasks) + num_running_sub_tasks == (
+            self.get_remaining_subtasks(ctx)
+        )
+        ctx.data["streaming_sub_task"] = (
+            upcoming_sub_tasks[-1].name
+            if is_last_tasks and upcoming_sub_tasks and ctx.data["streaming"]
+            else None
         )
-
-        ctx.data["num_sub_tasks"] = len(upcoming_sub_tasks)
         # send an event per sub task
-        events = [SubTaskEvent(sub_task=sub_task) for sub_task in upcoming_sub_tasks]
+        events = [
+            SubTaskEvent(plan_id=ctx.data["act_plan_id"], sub_task=sub_task)
+            for sub_task in upcoming_sub_tasks
+        ]
         for event in events:
             ctx.send_event(event)
+        # results of started sub tasks that finished before the plan was complete
+        for event in ctx.data["pending_results"]:
+            ctx.send_event(event)
+        ctx.data["pending_results"] = []
 
         return None
 
@@ -120,32 +209,48 @@ class StructuredPlannerAgent(Workflow):
     async def execute_sub_task(
         self, ctx: Context, ev: SubTaskEvent
     ) -> SubTaskResultEvent:
+        if ev.plan_id in ctx.data["discarded_plan_ids"]:
+            return None
         if self._verbose:
             print(f"=== Executing sub task: {ev.sub_task.name} ===")
-        is_last_tasks = ctx.data["num_sub_tasks"] == self.get_remaining_subtasks(ctx)
-        # TODO: streaming only works without plan refining
-        streaming = is_last_tasks and ctx.data["streaming"] and not self.refine_plan
-        task = asyncio.create_task(
-            self.executor.run(
-                input=ev.sub_task.input,
+        streaming = ev.sub_task.name == ctx.data.get("streaming_sub_task")
+        # the executor publishes its events into the event sink of this run
+        run = asyncio.create_task(
+            self.executor.run_checkpointed(
+                f"sub_task:{ev.plan_id}:{ev.sub_task.name}",
+                ev.sub_task.input,
                 streaming=streaming,
             )
         )
-        # bubble all events while running the executor to the planner
-        async for event in self.executor.stream_events():
-            ctx.write_event_to_stream(event)
-        result = await task
+        ctx.data["sub_task_runs"].append((ev.plan_id, run))
+        try:
+            result = await run
+        except asyncio.CancelledError:
+            # the run was cancelled as its plan was discarded, not this step
+            if run.cancelled() and not asyncio.current_task().cancelling():
+                return None
+            raise
+        finally:
+            ctx.data["sub_task_runs"].remove((ev.plan_id, run))
         if self._verbose:
             print("=== Done executing sub task ===\n")
-        self.planner.state.add_completed_sub_task(ctx.data["act_plan_id"], ev.sub_task)
-        return SubTaskResultEvent(sub_task=ev.sub_task, result=result)
+        self.planner.state.add_completed_sub_task(ev.plan_id, ev.sub_task)
+        return SubTaskResultEvent(
+            plan_id=ev.plan_id, sub_task=ev.sub_task, result=result
+        )
 
     @step()
     async def gather_results(
         self, ctx: Context, ev: SubTaskResultEvent
     ) -> ExecutePlanEvent | StopEvent:
+        if ev.plan_id in ctx.data["discarded_plan_ids"]:
+            return None
+        num_sub_tasks = ctx.data.get("num_sub_tasks")
+        if num_sub_tasks is None:
+            # the plan is still being created, the result is collected once the plan is executed
+            ctx.data["pending_results"].append(ev)
+            return None
         # wait for all sub tasks to finish
-        num_sub_tasks = ctx.data["num_sub_tasks"]
         results = ctx.collect_events(ev, [SubTaskResultEvent] * num_sub_tasks)
         if results is None:
             return None
@@ -153,16 +258,34 @@ class StructuredPlannerAgent(Workflow):
         upcoming_sub_tasks = self.get_upcoming_sub_tasks(ctx)
         # if no more tasks to do, stop workflow and send result of last step
         if upcoming_sub_tasks == 0:
-            return StopEvent(result=results[-1].result)
+            plan = self.planner.state.plan_dict[ctx.data["act_plan_id"]]
+            last_sub_task = plan.sub_tasks[-1].name
+            final_result = next(
+                (r for r in results if r.sub_task.name == last_sub_task), results[-1]
+            )
+            return StopEvent(result=final_result.result)
 
         if self.refine_plan:
             # store all results for refining the plan
             ctx.data["results"] = ctx.data.get("results", {})
             for result in results:
-                ctx.data["results"][result.sub_task.name] = result.result
+                # only the response is needed for refining, not the sources of the result
+                ctx.data["results"][result.sub_task.name] = (
+                    result.result.response.message.content
+                    if isinstance(result.result, AgentRunResult)
+                    else str(result.result)
+                )
 
-            new_plan = await self.planner.refine_plan(
-                ctx.data["task"], ctx.data["act_plan_id"], ctx.data["results"]
+            ctx.data["refinements"] = ctx.data.get("refinements", 0) + 1
+            new_plan = await checkpointed(
+                f"refine_plan:{ctx.data['refinements']}",
+                lambda: self.planner.refine_plan(
+                    ctx.data["task"], ctx.data["act_plan_id"], ctx.data["results"]
+                ),
+                lambda plan: plan.model_dump() if plan is not None else None,
+                lambda value: self.planner.restore_refined_plan(
+                    ctx.data["act_plan_id"], value
+                ),
             )
             # inform about the new plan
             if new_plan is not None:
@@ -175,6 +298,31 @@ class StructuredPlannerAgent(Workflow):
         # continue executing plan
         return ExecutePlanEvent()
 
+    def discard_streamed_plan(self, ctx: Context, plan_id: str) -> None:
+        """
+        Discard the sub tasks that were started while streaming a plan that turned out to be invalid:
+        their runs are cancelled, their results are ignored and the history of the executor is restored.
+        """
+        logger.warning("The streamed plan is invalid, discarding its started sub tasks")
+        metrics.incr("plan_stream.discarded")
+        ctx.data["discarded_plan_ids"].append(plan_id)
+        ctx.data["started_sub_tasks"] = []
+        ctx.data["pending_results"] = []
+        for run_plan_id, run in ctx.data["sub_task_runs"]:
+            if run_plan_id == plan_id:
+                run.cancel()
+        self.executor.memory.set(ctx.data["executor_history"])
+
+    def list_prompts(self) -> List[str]:
+        """
+        Prompts the planner and the executor send to the LLM, e.g. to detect answers recorded with other prompts
+        """
+        return [
+            self.planner.initial_plan_prompt.get_template(),
+            self.planner.plan_refine_prompt.get_template(),
+            *self.executor.list_prompts(),
+        ]
+
     def get_upcoming_sub_tasks(self, ctx: Context):
         upcoming_sub_tasks = self.planner.state.get_next_sub_tasks(
             ctx.data["act_plan_id"]
@@ -188,6 +336,80 @@ class StructuredPlannerAgent(Workflow):
         return len(remaining_subtasks)
 
 
+class CachedPlan(BaseModel):
+    task: str
+    plan: Plan
+
+
+_plan_cache: Optional[SemanticCache[CachedPlan]] = None
+
+
+def get_plan_cache() -> SemanticCache[CachedPlan]:
+    """
+    Get the process-wide cache for plans of similar tasks, so it's shared across requests
+    """
+    global _plan_cache
+    if _plan_cache is None:
+        ttl = os.getenv("PLAN_CACHE_TTL", "86400")
+        _plan_cache = SemanticCache(
+            name="plan_cache",
+            similarity_threshold=float(
+                os.getenv("PLAN_CACHE_SIMILARITY_THRESHOLD", "0.9")
+            ),
+            max_size=int(os.getenv("PLAN_CACHE_SIZE", "0")),
+            ttl=float(ttl) if ttl else None,
+        )
+    return _plan_cache
+
+
+def reparameterize_plan(cached_plan: CachedPlan, task: str) -> Optional[Plan]:
+    """
+    Adapt a cached plan to a new task of the same shape, e.g. "Write a blog post about X" to "Write a blog post about Y".
+    The part of the cached task that differs from the new task is replaced as whole words in the inputs and expected outputs of the sub tasks.
+    Returns None if the plan can't be adapted, e.g. if the part also occurs within other words.
+    """
+    old_words, new_words = cached_plan.task.split(), task.split()
+    prefix = 0
+    while (
+        prefix < min(len(old_words), len(new_words))
+        and old_words[prefix] == new_words[prefix]
+    ):
+        prefix += 1
+    suffix = 0
+    while (
+        suffix < min(len(old_words), len(new_words)) - prefix
+        and old_words[-suffix - 1] == new_words[-suffix - 1]
+    ):
+        suffix += 1
+    old_part = " ".join(old_words[prefix : len(old_words) - suffix])
+    new_part = " ".join(new_words[prefix : len(new_words) - suffix])
+
+    plan = cached_plan.plan.model_copy(deep=True)
+    if old_part == new_part:
+        return plan
+    if not old_part:
+        return None
+    # e.g. "Go" in "how Google uses Go" is only replaced as word
+    pattern = re.compile(rf"(?<!\w){re.escape(old_part)}(?!\w)")
+    texts = [
+        text
+        for sub_task in plan.sub_tasks
+        for text in (sub_task.input, sub_task.expected_output)
+    ]
+    if not any(pattern.search(text) for text in texts):
+        # the sub tasks don't mention the parameter of the task literally
+        return None
+    if any(len(pattern.findall(text)) != text.count(old_part) for text in texts):
+        # a sub task would only be partially adapted
+        return None
+    for sub_task in plan.sub_tasks:
+        sub_task.input = pattern.sub(lambda _: new_part, sub_task.input)
+        sub_task.expected_output = pattern.sub(
+            lambda _: new_part, sub_task.expected_output
+        )
+    return plan
+
+
 # Concern dealing with creating and refining a plan, extracted from https://github.com/run-llama/llama_index/blob/main/llama-index-core/llama_index/core/agent/runner/planner.py#L138
 class Planner:
     def __init__(
@@ -197,47 +419,83 @@ class Planner:
         initial_plan_prompt: Union[str, PromptTemplate] = DEFAULT_INITIAL_PLAN_PROMPT,
         plan_refine_prompt: Union[str, PromptTemplate] = DEFAULT_PLAN_REFINE_PROMPT,
         verbose: bool = True,
+        plan_cache: SemanticCache[CachedPlan] | None = None,
+        embed_model: BaseEmbedding | None = None,
     ) -> None:
         if llm is None:
-            llm = Settings.llm
+            llm = get_agent_llm("planner")
         self.llm = llm
         assert self.llm.metadata.is_function_calling_model
 
+        self.plan_cache = plan_cache if plan_cache is not None else get_plan_cache()
+        self.hedger = get_hedger("planner")
+        self._embed_model = embed_model
+
         self.tools = tools or []
         self.state = PlannerAgentState()
         self.verbose = verbose
 
+        # the tools don't change, so the tools description is a static part of the prompts
+        self.tools_str = "\n".join(
+            f"{tool.metadata.name}: {tool.metadata.description}" for tool in self.tools
+        )
+
         if isinstance(initial_plan_prompt, str):
             initial_plan_prompt = PromptTemplate(initial_plan_prompt)
-        self.initial_plan_prompt = initial_plan_prompt
+        self.initial_plan_prompt = initial_plan_prompt.partial_format(
+            tools_str=self.tools_str
+        )
 
         if isinstance(plan_refine_prompt, str):
             plan_refine_prompt = PromptTemplate(plan_refine_prompt)
-        self.plan_refine_prompt = plan_refine_prompt
-
-    async def create_plan(self, input: str) -> Tuple[str, Plan]:
-        tools = self.tools
-        tools_str = ""
-        for tool in tools:
-            tools_str += tool.metadata.name + ": " + tool.metadata.description + "\n"
+        self.plan_refine_prompt = plan_refine_prompt.partial_format(
+            tools_str=self.tools_str
+        )
 
-        try:
-            plan = await self.llm.astructured_predict(
-                Plan,
-                self.initial_plan_prompt,
-                tools_str=tools_str,
-                task=input,
-            )
-        except (ValueError, ValidationError):
-            if self.verbose:
-                print("No complex plan predicted. Defaulting to a single task plan.")
-            plan = Plan(
-                sub_tasks=[
-                    SubTask(
-                        name="default", input=input, expected_output="", dependencies=[]
+    async def create_plan(
+        self,
+        input: str,
+        on_sub_task: Optional[Callable[[str, SubTask], None]] = None,
+    ) -> Tuple[str, Plan]:
+        """
+        Create a plan for the given input.
+        If `on_sub_task` is set, the plan is streamed and `on_sub_task` is called with the plan id and each sub task as soon as it's generated.
+        """
+        plan_id = str(uuid.uuid4())
+        task_embedding, plan = await self._get_cached_plan(input)
+        if plan is None:
+            try:
+                if on_sub_task is None:
+                    plan = await call_llm(
+                        self.llm,
+                        lambda llm: llm.astructured_predict(
+                            Plan, self.initial_plan_prompt, task=input
+                        ),
+                        self.hedger,
                     )
-                ]
-            )
+                else:
+                    plan = await self._stream_plan(
+                        plan_id, on_sub_task, task=input
+                    )
+                self._cache_plan(input, task_embedding, plan)
+            except (ValueError, ValidationError):
+                if self.verbose:
+                    print(
+                        "No complex plan predicted. Defaulting to a single task plan."
+                    )
+                if on_sub_task is not None:
+                    # the sub tasks of the streamed plan that were already started don't belong to the default plan
+                    plan_id = str(uuid.uuid4())
+                plan = Plan(
+                    sub_tasks=[
+                        SubTask(
+                            name="default",
+                            input=input,
+                            expected_output="",
+                            dependencies=[],
+                        )
+                    ]
+                )
 
         if self.verbose:
             print("=== Initial plan ===")
@@ -246,11 +504,92 @@ class Planner:
                     f"{sub_task.name}:\n{sub_task.input} -> {sub_task.expected_output}\ndeps: {sub_task.dependencies}\n\n"
                 )
 
-        plan_id = str(uuid.uuid4())
         self.state.plan_dict[plan_id] = plan
 
         return plan_id, plan
 
+    def _tools_version(self) -> str:
+        # cached plans are only valid for the same set of tools
+        return hash_key(
+            [(tool.metadata.name, tool.metadata.description) for tool in self.tools]
+        )
+
+    async def _get_cached_plan(
+        self, task: str
+    ) -> Tuple[Optional[List[float]], Optional[Plan]]:
+        if not self.plan_cache.enabled:
+            return None, None
+        embed_model = self._embed_model or Settings.embed_model
+        task_embedding = await embed_model.aget_query_embedding(task)
+        hit = self.plan_cache.lookup(task_embedding, self._tools_version())
+        if hit is None:
+            return task_embedding, None
+        cached_plan, similarity = hit
+        plan = reparameterize_plan(cached_plan, task)
+        if plan is None:
+            metrics.incr("plan_cache.rejected")
+            return task_embedding, None
+        logger.info(
+            f"Using cached plan of task '{cached_plan.task}' (similarity: {similarity:.3f})"
+        )
+        return task_embedding, plan
+
+    def _cache_plan(
+        self, task: str, task_embedding: Optional[List[float]], plan: Plan
+    ) -> None:
+        if task_embedding is not None:
+            self.plan_cache.store(
+                task_embedding,
+                CachedPlan(task=task, plan=plan),
+                self._tools_version(),
+            )
+
+    async def _stream_plan(
+        self,
+        plan_id: str,
+        on_sub_task: Callable[[str, SubTask], None],
+        **prompt_args: Any,
+    ) -> Plan:
+        tool = _get_function_tool(Plan)
+        messages = self.initial_plan_prompt.format_messages(llm=self.llm, **prompt_args)
+        llm, first_chunk, response_stream = await call_llm(
+            self.llm,
+            lambda llm: start_stream(
+                llm.astream_chat_with_tools([tool], chat_history=messages), llm
+            ),
+            self.hedger,
+            kind="first_token",
+            discard=lambda started: started[2].aclose(),
+        )
+
+        response = None
+        num_streamed = 0
+        is_streaming = True
+        async for response in resume_stream(first_chunk, response_stream):
+            if not is_streaming:
+                continue
+            tool_calls = llm.get_tool_calls_from_response(
+                response, error_on_no_tool_call=False
+            )
+            if not tool_calls:
+                continue
+            sub_tasks = tool_calls[0].tool_kwargs.get("sub_tasks") or []
+            # all sub tasks except the last one are complete, the last one might still be generated
+            while is_streaming and num_streamed < len(sub_tasks) - 1:
+                try:
+                    sub_task = SubTask.model_validate(sub_tasks[num_streamed])
+                except ValidationError:
+                    # stop streaming, the plan is validated once it's complete
+                    is_streaming = False
+                    break
+                on_sub_task(plan_id, sub_task)
+                num_streamed += 1
+
+        if response is None:
+            raise ValueError("No plan predicted")
+        tool_calls = llm.get_tool_calls_from_response(response)
+        return Plan.model_validate(tool_calls[0].tool_kwargs)
+
     async def refine_plan(
         self,
         input: str,
@@ -276,6 +615,18 @@ class Planner:
                 print(f"No new plan predicted: {e}")
             return None
 
+    def restore_refined_plan(
+        self, plan_id: str, value: Optional[dict]
+    ) -> Optional[Plan]:
+        """
+        Restore a refinement of the plan of a resumed run, None if the plan wasn't refined
+        """
+        if value is None:
+            return None
+        new_plan = Plan.model_validate(value)
+        self._update_plan(plan_id, new_plan)
+        return new_plan
+
     def _update_plan(self, plan_id: str, new_plan: Plan) -> None:
         """Update the plan."""
         # update state with new plan
@@ -296,33 +647,30 @@ class Planner:
     ) -> dict:
         """Get the refine plan prompt."""
         # gather completed sub-tasks and response pairs
-        completed_outputs_str = ""
-        for sub_task_name, task_output in completed_sub_task.items():
-            task_str = f"{sub_task_name}:\n" f"\t{task_output!s}\n"
-            completed_outputs_str += task_str
+        completed_outputs_str = "\n".join(
+            f"{sub_task_name}:\n\t{task_output!s}"
+            for sub_task_name, task_output in completed_sub_task.items()
+        )
 
         # get a string for the remaining sub-tasks
         remaining_sub_tasks = self.state.get_remaining_subtasks(plan_id)
-        remaining_sub_tasks_str = "" if len(remaining_sub_tasks) != 0 else "None"
-        for sub_task in remaining_sub_tasks:
-            task_str = (
-                f"SubTask(name='{sub_task.name}', "
-                f"input='{sub_task.input}', "
-                f"expected_output='{sub_task.expected_output}', "
-                f"dependencies='{sub_task.dependencies}')\n"
-            )
-            remaining_sub_tasks_str += task_str
-
-        # get the tools string
-        tools = self.tools
-        tools_str = ""
-        for tool in tools:
-            tools_str += tool.metadata.name + ": " + tool.metadata.description + "\n"
+        remaining_sub_tasks_str = (
+            "\n".join(_format_sub_task(sub_task) for sub_task in remaining_sub_tasks)
+            or "None"
+        )
 
         # return the kwargs
         return {
-            "tools_str": tools_str.strip(),
             "task": task.strip(),
             "completed_outputs": completed_outputs_str.strip(),
             "remaining_sub_tasks": remaining_sub_tasks_str.strip(),
         }
+
+
+def _format_sub_task(sub_task: SubTask) -> str:
+    return (
+        f"SubTask(name='{sub_task.name}', "
+        f"input='{sub_task.input}', "
+        f"expected_output='{sub_task.expected_output}', "
+        f"dependencies='{sub_task.dependencies}')"
+    )
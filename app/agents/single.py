@@ -1,10 +1,11 @@
+import os
 from abc import abstractmethod
-from typing import Any, AsyncGenerator, List, Optional
+from typing import Any, AsyncGenerator, List, Optional, Type
 
-from llama_index.core.llms import ChatMessage, ChatResponse
+from llama_index.core.llms import ChatMessage, ChatResponse, MessageRole
 from llama_index.core.llms.function_calling import FunctionCallingLLM
 from llama_index.core.memory import ChatMemoryBuffer
-from llama_index.core.settings import Settings
+from llama_index.core.schema import NodeWithScore
 from llama_index.core.tools import ToolOutput, ToolSelection
 from llama_index.core.tools.types import BaseTool
 from llama_index.core.tools import FunctionTool
@@ -14,11 +15,41 @@ from llama_index.core.workflow import (
     Event,
     StartEvent,
     StopEvent,
-    Workflow,
     step,
 )
 from pydantic import BaseModel
 
+from app.agents.cache import CachedLLMResponse, get_llm_response_cache
+from app.agents.hedging import (
+    call_llm,
+    get_hedger,
+    resume_stream,
+    start_stream,
+)
+from app.agents.memory import TokenCountingChatMemory
+from app.agents.sources import ToolSource
+from app.agents.tool_output import (
+    READ_TOOL_OUTPUT_TOOL_NAME,
+    ToolOutputStore,
+    ToolOutputStrategy,
+    get_tool_output_policy,
+    shorten_tool_output,
+)
+from app.budget import (
+    TokenUsage,
+    get_run_budget,
+    is_token_budget_low,
+    record_usage,
+)
+from app.checkpoint import CheckpointWorkflow, checkpointed
+from app.deadline import is_low_budget
+from app.events import wait_for_event_consumer
+from app.settings import (
+    add_prompt_cache_breakpoint,
+    get_agent_llm,
+    get_low_budget_llm,
+)
+
 
 class InputEvent(Event):
     input: list[ChatMessage]
@@ -41,9 +72,32 @@ class AgentRunEvent(Event):
         self._msg = value
 
 
+class SourceNodesEvent(Event):
+    # nodes retrieved by a tool, e.g. query_index
+    nodes: list[NodeWithScore]
+
+
 class AgentRunResult(BaseModel):
     response: ChatResponse
-    sources: list[ToolOutput]
+    sources: list[ToolSource]
+    # tokens used by the run including its nested runs, only set for the outermost run
+    usage: Optional[TokenUsage] = None
+
+    def dump_checkpoint(self) -> dict:
+        # the raw response of the LLM isn't needed to resume a run
+        return {
+            "content": self.response.message.content,
+            "sources": [source.model_dump() for source in self.sources],
+        }
+
+    @classmethod
+    def load_checkpoint(cls, value: dict) -> "AgentRunResult":
+        return cls(
+            response=ChatResponse(
+                message=ChatMessage(role=MessageRole.ASSISTANT, content=value["content"])
+            ),
+            sources=value["sources"],
+        )
 
 
 class ContextAwareTool(FunctionTool):
@@ -52,7 +106,7 @@ class ContextAwareTool(FunctionTool):
         pass
 
 
-class FunctionCallingAgent(Workflow):
+class FunctionCallingAgent(CheckpointWorkflow):
     def __init__(
         self,
         *args: Any,
@@ -65,23 +119,56 @@ class FunctionCallingAgent(Workflow):
         name: str,
         write_events: bool = True,
         role: Optional[str] = None,
+        cacheable: Optional[bool] = None,
+        memory_cls: Type[ChatMemoryBuffer] = TokenCountingChatMemory,
+        memory_token_limit: Optional[int] = None,
         **kwargs: Any,
     ) -> None:
         super().__init__(*args, verbose=verbose, timeout=timeout, **kwargs)
-        self.tools = tools or []
+        self.tools = list(tools or [])
         self.name = name
+        # large tool outputs are shortened before they are added to the memory (if configured for the tool)
+        self.tool_output_policies = {
+            tool.metadata.get_name(): get_tool_output_policy(tool.metadata.get_name())
+            for tool in self.tools
+        }
+        self.tool_output_store = ToolOutputStore()
+        if any(
+            policy is not None and policy.strategy == ToolOutputStrategy.HANDLE
+            for policy in self.tool_output_policies.values()
+        ):
+            self.tools.append(self.tool_output_store.as_tool())
         self.role = role
         self.write_events = write_events
 
         if llm is None:
-            llm = Settings.llm
+            llm = get_agent_llm(name)
         self.llm = llm
         assert self.llm.metadata.is_function_calling_model
 
+        # cache LLM responses (if enabled) only for deterministic agents, unless explicitly set
+        if cacheable is None:
+            cacheable = getattr(self.llm, "temperature", None) == 0
+        self.response_cache = get_llm_response_cache() if cacheable else None
+        # send a duplicate request if the LLM is slow (if configured for the agent)
+        self.hedger = get_hedger(name)
+
         self.system_prompt = system_prompt
 
-        self.memory = ChatMemoryBuffer.from_defaults(
-            llm=self.llm, chat_history=chat_history
+        self.memory = memory_cls.from_defaults(
+            llm=self.llm, chat_history=chat_history, token_limit=memory_token_limit
+        )
+        # the system prompt is kept out of the memory and always sent first, so each turn starts with the same prefix
+        # (the tools are sent unchanged too) which allows the provider to cache the prompt prefix
+        self._system_msg = (
+            ChatMessage(role="system", content=system_prompt)
+            if system_prompt is not None
+            else None
+        )
+        self._system_token_count = (
+            len(self.memory.tokenizer_fn(system_prompt))
+            if system_prompt is not None
+            else 0
         )
         self.sources = []
 
@@ -90,11 +177,6 @@ class FunctionCallingAgent(Workflow):
         # clear sources
         self.sources = []
 
-        # set system prompt
-        if self.system_prompt is not None:
-            system_msg = ChatMessage(role="system", content=self.system_prompt)
-            self.memory.put(system_msg)
-
         # set streaming
         ctx.data["streaming"] = getattr(ev, "streaming", False)
 
@@ -108,26 +190,48 @@ class FunctionCallingAgent(Workflow):
             )
 
         # get chat history
-        chat_history = self.memory.get()
+        chat_history = self.get_chat_history()
         return InputEvent(input=chat_history)
 
     @step()
     async def handle_llm_input(
         self, ctx: Context, ev: InputEvent
     ) -> ToolCallEvent | StopEvent:
+        # don't get ahead of a slow consumer of the events
+        await wait_for_event_consumer()
         if ctx.data["streaming"]:
             return await self.handle_llm_input_stream(ctx, ev)
 
         chat_history = ev.input
 
-        response = await self.llm.achat_with_tools(
-            self.tools, chat_history=chat_history
-        )
-        self.memory.put(response.message)
+        # e.g. the low budget model, whose answers are cached separately
+        requested_llm = self.get_llm()
+        cached = self._get_cached_response(requested_llm, chat_history)
+        if cached is not None:
+            response, tool_calls = cached.response, cached.tool_calls
+        else:
 
-        tool_calls = self.llm.get_tool_calls_from_response(
-            response, error_on_no_tool_call=False
-        )
+            async def chat(llm: FunctionCallingLLM):
+                response = await llm.achat_with_tools(
+                    self.tools,
+                    chat_history=add_prompt_cache_breakpoint(llm, chat_history),
+                )
+                # the fallback LLM of the hedger might use another format for tool calls
+                return (
+                    llm,
+                    response,
+                    llm.get_tool_calls_from_response(
+                        response, error_on_no_tool_call=False
+                    ),
+                )
+
+            llm, response, tool_calls = await call_llm(
+                requested_llm, chat, self.hedger
+            )
+            # answers of the hedger's fallback model aren't cached as answers of the requested model
+            if llm is requested_llm:
+                self._cache_response(llm, chat_history, response, tool_calls)
+        self.memory.put(response.message)
 
         if not tool_calls:
             if self.write_events:
@@ -145,31 +249,70 @@ class FunctionCallingAgent(Workflow):
     ) -> ToolCallEvent | StopEvent:
         chat_history = ev.input
 
-        async def response_generator() -> AsyncGenerator:
-            response_stream = await self.llm.astream_chat_with_tools(
-                self.tools, chat_history=chat_history
-            )
+        requested_llm = self.get_llm()
+        cached = self._get_cached_response(requested_llm, chat_history)
+        if cached is not None:
+            self.memory.put(cached.response.message)
+            if cached.tool_calls:
+                return ToolCallEvent(tool_calls=cached.tool_calls)
+            if self.write_events:
+                ctx.write_event_to_stream(
+                    AgentRunEvent(name=self.name, msg="Finished task")
+                )
+            return StopEvent(result=cached.stream())
+
+        llm, first_chunk, response_stream = await call_llm(
+            requested_llm,
+            lambda llm: start_stream(
+                llm.astream_chat_with_tools(
+                    self.tools,
+                    chat_history=add_prompt_cache_breakpoint(llm, chat_history),
+                ),
+                llm,
+            ),
+            self.hedger,
+            kind="first_token",
+            discard=lambda started: started[2].aclose(),
+        )
+
+        # the stream might be consumed outside of the run, e.g. by the chat response
+        budget = get_run_budget()
 
+        async def response_generator() -> AsyncGenerator:
             full_response = None
             yielded_indicator = False
-            async for chunk in response_stream:
-                if "tool_calls" not in chunk.message.additional_kwargs:
-                    # Yield a boolean to indicate whether the response is a tool call
-                    if not yielded_indicator:
-                        yield False
+            try:
+                async for chunk in resume_stream(first_chunk, response_stream):
+                    full_response = chunk
+                    if "tool_calls" not in chunk.message.additional_kwargs:
+                        # Yield a boolean to indicate whether the response is a tool call
+                        if not yielded_indicator:
+                            yield False
+                            yielded_indicator = True
+
+                        # if not a tool call, yield the chunks!
+                        yield chunk
+                    elif not yielded_indicator:
+                        # Yield the indicator for a tool call
+                        yield True
                         yielded_indicator = True
-
-                    # if not a tool call, yield the chunks!
-                    yield chunk
-                elif not yielded_indicator:
-                    # Yield the indicator for a tool call
-                    yield True
-                    yielded_indicator = True
-
-                full_response = chunk
-
-            # Write the full response to memory
-            self.memory.put(full_response.message)
+            finally:
+                # Write the full response to memory - or the partial response if the consumer stopped early
+                if full_response is not None:
+                    self.memory.put(full_response.message)
+                    if get_run_budget() is not budget:
+                        record_usage(budget, chat_history, full_response)
+
+            # answers of the hedger's fallback model aren't cached as answers of the requested model
+            if llm is requested_llm:
+                self._cache_response(
+                    llm,
+                    chat_history,
+                    full_response,
+                    llm.get_tool_calls_from_response(
+                        full_response, error_on_no_tool_call=False
+                    ),
+                )
 
             # Yield the final response
             yield full_response
@@ -181,7 +324,7 @@ class FunctionCallingAgent(Workflow):
         is_tool_call = await generator.__anext__()
         if is_tool_call:
             full_response = await generator.__anext__()
-            tool_calls = self.llm.get_tool_calls_from_response(full_response)
+            tool_calls = llm.get_tool_calls_from_response(full_response)
             return ToolCallEvent(tool_calls=tool_calls)
 
         # If we've reached here, it's not an immediate tool call, so we return the generator
@@ -221,11 +364,16 @@ class FunctionCallingAgent(Workflow):
                     tool_output = await tool.acall(ctx=ctx, **tool_call.tool_kwargs)
                 else:
                     tool_output = await tool.acall(**tool_call.tool_kwargs)
-                self.sources.append(tool_output)
+                # only a compact source is kept, the tool output might hold whole query engine responses
+                self.sources.append(ToolSource.from_tool_output(tool_output))
+                # stream the retrieved nodes right away, the answer might take a while
+                source_nodes = getattr(tool_output.raw_output, "source_nodes", None)
+                if source_nodes:
+                    ctx.write_event_to_stream(SourceNodesEvent(nodes=source_nodes))
                 tool_msgs.append(
                     ChatMessage(
                         role="tool",
-                        content=tool_output.content,
+                        content=self._shorten_tool_output(tool_call, tool_output),
                         additional_kwargs=additional_kwargs,
                     )
                 )
@@ -241,5 +389,100 @@ class FunctionCallingAgent(Workflow):
         for msg in tool_msgs:
             self.memory.put(msg)
 
-        chat_history = self.memory.get()
+        chat_history = self.get_chat_history()
         return InputEvent(input=chat_history)
+
+    async def run_checkpointed(
+        self, key: str, input: str, streaming: bool = False
+    ) -> AgentRunResult | AsyncGenerator:
+        """
+        Run the agent as step `key` of the checkpointed outer run (see `checkpointed`).
+        If a resumed run skips the step, its stored result is added to the memory instead.
+        """
+
+        def load(value: dict) -> AgentRunResult:
+            result = AgentRunResult.load_checkpoint(value)
+            self.restore_run(input, result.response.message.content)
+            return result
+
+        return await checkpointed(
+            key,
+            lambda: self.run(input=input, streaming=streaming),
+            AgentRunResult.dump_checkpoint,
+            load,
+        )
+
+    def list_prompts(self) -> List[str]:
+        """
+        Prompts the agent sends to its LLM, e.g. to detect answers recorded with other prompts
+        """
+        return [self.system_prompt or ""]
+
+    def restore_run(self, input: str, response: str) -> None:
+        """
+        Add a run that was skipped when resuming to the memory, so the next runs of the agent have the same history
+        """
+        self.memory.put(ChatMessage(role=MessageRole.USER, content=input))
+        self.memory.put(ChatMessage(role=MessageRole.ASSISTANT, content=response))
+
+    def get_llm(self) -> FunctionCallingLLM:
+        # switch to a cheaper model (if configured) if the deadline of the run is close
+        if is_low_budget():
+            low_budget_llm = get_low_budget_llm(self.name)
+            if low_budget_llm is not None:
+                return low_budget_llm
+        return self.llm
+
+    def _shorten_tool_output(
+        self, tool_call: ToolSelection, tool_output: ToolOutput
+    ) -> str:
+        content = tool_output.content
+        policy = self.tool_output_policies.get(tool_call.tool_name)
+        if policy is not None:
+            content = shorten_tool_output(
+                content,
+                policy,
+                self.tool_output_store,
+                tool_call.tool_name,
+                tool_input=" ".join(str(v) for v in tool_call.tool_kwargs.values()),
+            )
+        # long tool outputs are the most expensive part of the following LLM calls if the token budget is low
+        if tool_call.tool_name == READ_TOOL_OUTPUT_TOOL_NAME:
+            return content
+        max_chars = int(os.getenv("TOKEN_BUDGET_TOOL_OUTPUT_CHARS", "4000"))
+        if not is_token_budget_low() or len(content) <= max_chars:
+            return content
+        return content[:max_chars] + "\n[truncated as the token budget is almost used up]"
+
+    def get_chat_history(self) -> List[ChatMessage]:
+        if self._system_msg is None:
+            return self.memory.get()
+        return [
+            self._system_msg,
+            *self.memory.get(initial_token_count=self._system_token_count),
+        ]
+
+    def _get_cached_response(
+        self, llm: FunctionCallingLLM, chat_history: List[ChatMessage]
+    ) -> Optional[CachedLLMResponse]:
+        if self.response_cache is None:
+            return None
+        key = self.response_cache.get_key(llm, self.tools, chat_history)
+        return self.response_cache.get(key)
+
+    def _cache_response(
+        self,
+        llm: FunctionCallingLLM,
+        chat_history: List[ChatMessage],
+        response: ChatResponse,
+        tool_calls: Optional[List[ToolSelection]] = None,
+    ) -> None:
+        if self.response_cache is None:
+            return
+        if tool_calls is None:
+            tool_calls = llm.get_tool_calls_from_response(
+                response, error_on_no_tool_call=False
+            )
+        # keyed by the model that answered, e.g. answers of the low budget model aren't replayed to runs with time left
+        key = self.response_cache.get_key(llm, self.tools, chat_history)
+        self.response_cache.set(key, response, tool_calls)
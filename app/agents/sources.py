@@ -0,0 +1,70 @@
+import os
+from typing import Any, List, Optional
+
+from llama_index.core.schema import BaseNode, NodeWithScore
+from llama_index.core.tools import ToolOutput
+from pydantic import BaseModel
+
+from app.engine.index import get_storage_context, get_storage_dir
+
+
+def _snippet(text: str) -> str:
+    max_chars = int(os.getenv("SOURCE_SNIPPET_CHARS", "200"))
+    return text if len(text) <= max_chars else text[:max_chars] + "..."
+
+
+class NodeSource(BaseModel):
+    """
+    Node of the index that a tool output is based on, the full node is looked up in the docstore on demand
+    """
+
+    node_id: str
+    score: Optional[float] = None
+    snippet: str
+
+    @classmethod
+    def from_node(cls, node: NodeWithScore) -> "NodeSource":
+        return cls(
+            node_id=node.node.node_id,
+            score=node.score,
+            snippet=_snippet(node.node.get_content()),
+        )
+
+    def get_node(self) -> Optional[BaseNode]:
+        storage_context = get_storage_context(get_storage_dir())
+        return storage_context.docstore.get_node(self.node_id, raise_error=False)
+
+
+class ToolSource(BaseModel):
+    """
+    Compact source of an agent run: the tool that was called with a snippet of its output and the nodes it used.
+    The sources of an agent called as tool are the same objects as in the result of the agent's run, not copies.
+    """
+
+    tool_name: str
+    snippet: str
+    nodes: List[NodeSource] = []
+    sources: List["ToolSource"] = []
+
+    @classmethod
+    def from_tool_output(cls, output: ToolOutput) -> "ToolSource":
+        raw_output: Any = output.raw_output
+        source_nodes: List[NodeWithScore] = (
+            getattr(raw_output, "source_nodes", None) or []
+        )
+        return cls(
+            tool_name=output.tool_name,
+            snippet=_snippet(output.content),
+            nodes=[NodeSource.from_node(node) for node in source_nodes],
+            # the result of an agent called as tool
+            sources=getattr(raw_output, "sources", None) or [],
+        )
+
+    def get_nodes(self) -> List[NodeSource]:
+        """
+        Get the nodes of this source and of its nested sources
+        """
+        return [
+            *self.nodes,
+            *(node for source in self.sources for node in source.get_nodes()),
+        ]
@@ -0,0 +1,140 @@
+import re
+import uuid
+from enum import Enum
+from typing import Dict, List, Optional
+
+from llama_index.core.tools import FunctionTool
+from llama_index.core.utils import get_tokenizer
+from pydantic import BaseModel
+
+from app.observability import metrics
+from app.settings import load_models_config
+
+READ_TOOL_OUTPUT_TOOL_NAME = "read_tool_output"
+
+
+class ToolOutputStrategy(str, Enum):
+    # keep the beginning and the end of the output
+    HEAD_TAIL = "head_tail"
+    # keep the sentences that share the most words with the tool input
+    EXTRACT = "extract"
+    # keep the beginning, the agent can read the rest with the read_tool_output tool
+    HANDLE = "handle"
+
+
+class ToolOutputPolicy(BaseModel):
+    # outputs up to this number of tokens are kept as they are
+    max_tokens: int
+    strategy: ToolOutputStrategy = ToolOutputStrategy.HEAD_TAIL
+
+
+_tool_output_policies: Dict[str, Optional[ToolOutputPolicy]] = {}
+
+
+def get_tool_output_policy(tool_name: str) -> Optional[ToolOutputPolicy]:
+    """
+    Get the output policy of a tool from config/models.yaml, None if the outputs of the tool are kept as they are
+    """
+    # agents are created per request, so the config is only read once per tool
+    if tool_name not in _tool_output_policies:
+        policies = load_models_config().get("tool_outputs") or {}
+        config = policies.get(tool_name, policies.get("default"))
+        _tool_output_policies[tool_name] = (
+            ToolOutputPolicy(**config) if config is not None else None
+        )
+    return _tool_output_policies[tool_name]
+
+
+class ToolOutputStore:
+    """
+    Full tool outputs of an agent that were shortened before they were added to its memory.
+    The agent can read them on demand with the `read_tool_output` tool.
+    """
+
+    def __init__(self, page_tokens: int = 1000) -> None:
+        self.page_tokens = page_tokens
+        self._outputs: Dict[str, str] = {}
+
+    def put(self, content: str) -> str:
+        handle = uuid.uuid4().hex[:8]
+        self._outputs[handle] = content
+        return handle
+
+    def read(self, handle: str, offset: int = 0) -> str:
+        """
+        Read a tool output that was shortened, starting at the character `offset`.
+        """
+        content = self._outputs.get(handle)
+        if content is None:
+            return f"There is no tool output with the handle {handle}."
+        # about four characters per token
+        end = offset + self.page_tokens * 4
+        page = content[offset:end]
+        if end < len(content):
+            page += f"\n[{len(content) - end} more characters, continue with offset {end}]"
+        return page
+
+    def as_tool(self) -> FunctionTool:
+        return FunctionTool.from_defaults(
+            fn=self.read,
+            name=READ_TOOL_OUTPUT_TOOL_NAME,
+            description=(
+                "Use this tool to read more of a tool output that was shortened, "
+                "given the handle of the output and the character offset to start from."
+            ),
+        )
+
+
+def shorten_tool_output(
+    content: str,
+    policy: ToolOutputPolicy,
+    store: ToolOutputStore,
+    tool_name: str,
+    tool_input: str = "",
+) -> str:
+    """
+    Shorten a tool output to the token cap of the policy before it's added to the memory of the agent,
+    so it isn't resent in full on each following LLM call
+    """
+    token_count = len(get_tokenizer()(content))
+    if token_count <= policy.max_tokens:
+        return content
+    metrics.incr(f"tool_output.{tool_name}.shortened")
+    metrics.incr("tool_output.removed_tokens", token_count - policy.max_tokens)
+    # about the same number of characters per token as in the full output
+    max_chars = len(content) * policy.max_tokens // token_count
+    if policy.strategy == ToolOutputStrategy.HANDLE:
+        handle = store.put(content)
+        return (
+            f"{content[:max_chars]}\n[The output was shortened from {token_count} tokens. "
+            f"Use the {READ_TOOL_OUTPUT_TOOL_NAME} tool with the handle '{handle}' and the offset {max_chars} to read more.]"
+        )
+    if policy.strategy == ToolOutputStrategy.EXTRACT:
+        return _extract(content, tool_input, max_chars)
+    half = max_chars // 2
+    return f"{content[:half]}\n[... {token_count - policy.max_tokens} tokens omitted ...]\n{content[-half:]}"
+
+
+def _extract(content: str, query: str, max_chars: int) -> str:
+    # keep the sentences that are most relevant to the tool input in their original order
+    sentences = [s for s in re.split(r"(?<=[.!?])\s+|\n+", content) if s.strip()]
+    query_words = set(_words(query))
+    scores = [len(query_words.intersection(_words(sentence))) for sentence in sentences]
+    # the most relevant sentences first, the earlier sentence first if equally relevant
+    ranked = sorted(range(len(sentences)), key=lambda index: (-scores[index], index))
+    selected: List[int] = []
+    length = 0
+    for index in ranked:
+        sentence = sentences[index]
+        if length + len(sentence) > max_chars:
+            continue
+        selected.append(index)
+        length += len(sentence) + 1
+    if not selected:
+        return content[:max_chars]
+    selected.sort()
+    return " [...] ".join(sentences[index] for index in selected)
+
+
+def _words(text: str) -> List[str]:
+    return re.findall(r"\w{3,}", text.lower())
@@ -1,19 +1,39 @@
 import asyncio
 import logging
+import os
+import uuid
+from typing import Any, Dict
 
 from fastapi import APIRouter, HTTPException, Request, status
 from llama_index.core.workflow import Workflow
 
+from app.budget import RunBudget
 from app.examples.factory import create_agent
 from app.api.routers.models import (
     ChatData,
 )
 from app.api.routers.vercel_response import VercelStreamResponse
+from app.api.services.coalescing import RunCoalescer, SharedRun
+from app.api.services.starters import get_starter_answers, normalize_question
+from app.cache import hash_key
+from app.engine.index import get_index_version
 
 chat_router = r = APIRouter()
 
 logger = logging.getLogger("uvicorn")
 
+# concurrent requests with the same question share one run, e.g. after many users clicked the same conversation starter
+chat_coalescer = RunCoalescer()
+
+
+def get_run_key(data: ChatData) -> str:
+    return hash_key(
+        normalize_question(data.get_last_message_content()),
+        [(message.role, message.content) for message in data.get_history_messages()],
+        sorted(data.get_chat_document_ids()),
+        get_index_version(),
+    )
+
 
 @r.post("")
 async def chat(
@@ -29,12 +49,52 @@ async def chat(
         # TODO: use params
         # params = data.data or {}
 
-        agent: Workflow = create_agent(chat_history=messages)
-        task = asyncio.create_task(
-            agent.run(input=last_message_content, streaming=True)
+        # replay the precomputed answer if the chat starts with a conversation starter
+        starter_answers = get_starter_answers()
+        if starter_answers is not None and not messages:
+            recorded = starter_answers.get(last_message_content)
+            if recorded is not None:
+                task, events = recorded.replay()
+                return VercelStreamResponse(request, task, events, data)
+
+        def get_run_kwargs() -> Dict[str, Any]:
+            return {
+                "input": last_message_content,
+                "streaming": True,
+                # the budget is created here, as the usage is only complete once the response is streamed
+                "budget": RunBudget.from_env(),
+                # the completed steps of an interrupted run with the same id are skipped
+                "run_id": data.run_id or str(uuid.uuid4()),
+            }
+
+        # a resumed run continues the checkpoint of its own run id, so it isn't shared with other requests
+        if (
+            os.getenv("CHAT_COALESCING", "true").lower() != "true"
+            or data.run_id is not None
+        ):
+            # the events are streamed from the run directly, so the agents wait for a slow client
+            agent: Workflow = create_agent(chat_history=messages)
+            run_kwargs = get_run_kwargs()
+            task = asyncio.create_task(agent.run(**run_kwargs))
+            return VercelStreamResponse(
+                request,
+                task,
+                agent.stream_events,
+                data,
+                budget=run_kwargs["budget"],
+                run_id=run_kwargs["run_id"],
+            )
+
+        # the events of a shared run are buffered for all its subscribers, so the agents don't wait for slow clients
+        run = chat_coalescer.get_or_start(
+            get_run_key(data),
+            lambda: SharedRun(create_agent(chat_history=messages), **get_run_kwargs()),
         )
+        task, events = run.subscribe()
 
-        return VercelStreamResponse(request, task, agent.stream_events, data)
+        return VercelStreamResponse(
+            request, task, events, data, budget=run.budget, run_id=run.run_id
+        )
     except Exception as e:
         logger.exception("Error in agent", exc_info=True)
         raise HTTPException(
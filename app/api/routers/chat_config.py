@@ -4,6 +4,7 @@ import os
 from fastapi import APIRouter
 
 from app.api.routers.models import ChatConfig
+from app.api.services.starters import get_conversation_starters
 
 
 config_router = r = APIRouter()
@@ -13,11 +14,7 @@ logger = logging.getLogger("uvicorn")
 
 @r.get("")
 async def chat_config() -> ChatConfig:
-    starter_questions = None
-    conversation_starters = os.getenv("CONVERSATION_STARTERS")
-    if conversation_starters and conversation_starters.strip():
-        starter_questions = conversation_starters.strip().split("\n")
-    return ChatConfig(starter_questions=starter_questions)
+    return ChatConfig(starter_questions=get_conversation_starters() or None)
 
 
 try:
@@ -0,0 +1,12 @@
+from typing import Dict
+
+from fastapi import APIRouter
+
+from app.observability import metrics
+
+metrics_router = r = APIRouter()
+
+
+@r.get("")
+async def get_metrics() -> Dict[str, float]:
+    return metrics.snapshot()
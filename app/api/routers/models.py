@@ -1,6 +1,7 @@
 import logging
 import os
-from typing import Any, Dict, List, Literal, Optional
+from functools import lru_cache
+from typing import Any, Dict, List, Literal, Optional, Tuple
 
 from llama_index.core.llms import ChatMessage, MessageRole
 from llama_index.core.schema import NodeWithScore
@@ -78,6 +79,8 @@ class Message(BaseModel):
 class ChatData(BaseModel):
     messages: List[Message]
     data: Any = None
+    # id of an interrupted run to resume, the id of each run is sent to the client at the start of the response
+    run_id: Optional[str] = None
 
     class Config:
         json_schema_extra = {
@@ -171,11 +174,7 @@ class SourceNodes(BaseModel):
 
     @classmethod
     def get_url_from_metadata(cls, metadata: Dict[str, Any]) -> str:
-        url_prefix = os.getenv("FILESERVER_URL_PREFIX")
-        if not url_prefix:
-            logger.warning(
-                "Warning: FILESERVER_URL_PREFIX not set in environment variables. Can't use file server"
-            )
+        url_prefix, data_dir = _get_file_server_config()
         file_name = metadata.get("file_name")
 
         if file_name and url_prefix:
@@ -192,7 +191,6 @@ class SourceNodes(BaseModel):
             # file is from calling the 'generate' script
             # Get the relative path of file_path to data_dir
             file_path = metadata.get("file_path")
-            data_dir = os.path.abspath(DATA_DIR)
             if file_path and data_dir:
                 relative_path = os.path.relpath(file_path, data_dir)
                 return f"{url_prefix}/data/{relative_path}"
@@ -204,6 +202,17 @@ class SourceNodes(BaseModel):
         return [cls.from_source_node(node) for node in source_nodes]
 
 
+@lru_cache(maxsize=1)
+def _get_file_server_config() -> Tuple[Optional[str], str]:
+    # read once, not for each source node
+    url_prefix = os.getenv("FILESERVER_URL_PREFIX")
+    if not url_prefix:
+        logger.warning(
+            "Warning: FILESERVER_URL_PREFIX not set in environment variables. Can't use file server"
+        )
+    return url_prefix, os.path.abspath(DATA_DIR)
+
+
 class Result(BaseModel):
     result: Message
     nodes: List[SourceNodes]
@@ -5,6 +5,7 @@ from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel
 
 from app.api.services.file import PrivateFileService
+from app.rate_limit import Priority, llm_priority
 
 file_upload_router = r = APIRouter()
 
@@ -21,9 +22,11 @@ class FileUploadRequest(BaseModel):
 def upload_file(request: FileUploadRequest) -> List[str]:
     try:
         logger.info("Processing file")
-        return PrivateFileService.process_file(
-            request.filename, request.base64, request.params
-        )
+        # chats go first, indexing the file can wait
+        with llm_priority(Priority.INGESTION):
+            return PrivateFileService.process_file(
+                request.filename, request.base64, request.params
+            )
     except Exception as e:
         logger.error(f"Error processing file: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="Error processing file")
@@ -1,14 +1,18 @@
+import asyncio
 from asyncio import Task
 import json
 import logging
-from typing import AsyncGenerator
+import os
+from typing import AsyncGenerator, Optional, Set
 
 from aiostream import stream
 from fastapi import Request
 from fastapi.responses import StreamingResponse
 
-from app.api.routers.models import ChatData
-from app.agents.single import AgentRunEvent, AgentRunResult
+from app.api.routers.models import ChatData, SourceNodes
+from app.api.services.suggestion import StreamingSuggestion
+from app.agents.single import AgentRunEvent, AgentRunResult, SourceNodesEvent
+from app.budget import RunBudget
 
 logger = logging.getLogger("uvicorn")
 
@@ -36,12 +40,14 @@ class VercelStreamResponse(StreamingResponse):
         self,
         request: Request,
         task: Task[AgentRunResult | AsyncGenerator],
-        events: AsyncGenerator[AgentRunEvent, None],
+        events: AsyncGenerator[AgentRunEvent | SourceNodesEvent, None],
         chat_data: ChatData,
         verbose: bool = True,
+        budget: Optional[RunBudget] = None,
+        run_id: Optional[str] = None,
     ):
         content = VercelStreamResponse.content_generator(
-            request, task, events, chat_data, verbose
+            request, task, events, chat_data, verbose, budget, run_id
         )
         super().__init__(content=content)
 
@@ -50,29 +56,71 @@ class VercelStreamResponse(StreamingResponse):
         cls,
         request: Request,
         task: Task[AgentRunResult | AsyncGenerator],
-        events: AsyncGenerator[AgentRunEvent, None],
+        events: AsyncGenerator[AgentRunEvent | SourceNodesEvent, None],
         chat_data: ChatData,
         verbose: bool = True,
+        budget: Optional[RunBudget] = None,
+        run_id: Optional[str] = None,
     ):
         # Yield the text response
         async def _chat_response_generator():
+            # the client can resume an interrupted run by sending its id
+            if run_id is not None:
+                yield VercelStreamResponse.convert_data(
+                    {"type": "run", "data": {"id": run_id}}
+                )
             result = await task
-
-            if isinstance(result, AgentRunResult):
-                for token in result.response.message.content:
-                    yield VercelStreamResponse.convert_text(token)
-
-            if isinstance(result, AsyncGenerator):
-                async for token in result:
-                    yield VercelStreamResponse.convert_text(token.delta)
-
-            # TODO: stream NextQuestionSuggestion
-            # TODO: stream sources
+            suggestion = (
+                StreamingSuggestion(chat_data.messages)
+                if os.getenv("NEXT_QUESTION_SUGGESTIONS", "true").lower() == "true"
+                else None
+            )
+
+            try:
+                if isinstance(result, AgentRunResult):
+                    if suggestion is not None:
+                        suggestion.add(result.response.message.content)
+                    for token in result.response.message.content:
+                        yield VercelStreamResponse.convert_text(token)
+
+                if isinstance(result, AsyncGenerator):
+                    async for token in result:
+                        # the suggestion starts in the background once enough of the answer arrived
+                        if suggestion is not None and token.delta:
+                            suggestion.add(token.delta)
+                        yield VercelStreamResponse.convert_text(token.delta)
+
+                if suggestion is not None:
+                    try:
+                        # the stream isn't kept open for a slow suggestion, the questions are just left out
+                        questions = await asyncio.wait_for(
+                            suggestion.get(),
+                            float(os.getenv("SUGGESTION_TIMEOUT", "3")),
+                        )
+                    except asyncio.TimeoutError:
+                        logger.warning("Suggesting the next questions timed out")
+                        questions = []
+                    if questions:
+                        yield VercelStreamResponse.convert_data(
+                            {"type": "suggested_questions", "data": questions}
+                        )
+            finally:
+                # e.g. the client disconnected
+                if suggestion is not None:
+                    suggestion.cancel()
+
+            # the token usage of the whole run is known once the response is streamed
+            if budget is not None:
+                yield VercelStreamResponse.convert_data(
+                    {"type": "usage", "data": budget.usage.model_dump()}
+                )
 
         # Yield the events from the event handler
         async def _event_generator():
+            # nodes retrieved by several agents are only sent once
+            sent_node_ids: Set[str] = set()
             async for event in events():
-                event_response = _event_to_response(event)
+                event_response = _event_to_response(event, sent_node_ids)
                 if verbose:
                     logger.debug(event_response)
                 if event_response is not None:
@@ -86,7 +134,25 @@ class VercelStreamResponse(StreamingResponse):
                     break
 
 
-def _event_to_response(event: AgentRunEvent) -> dict:
+def _event_to_response(
+    event: AgentRunEvent | SourceNodesEvent, sent_node_ids: Set[str]
+) -> Optional[dict]:
+    if isinstance(event, SourceNodesEvent):
+        nodes = []
+        for node in event.nodes:
+            if node.node.node_id not in sent_node_ids:
+                sent_node_ids.add(node.node.node_id)
+                nodes.append(node)
+        if not nodes:
+            return None
+        return {
+            "type": "sources",
+            "data": {
+                "nodes": [
+                    source.model_dump() for source in SourceNodes.from_source_nodes(nodes)
+                ]
+            },
+        }
     return {
         "type": "agent",
         "data": {"agent": event.name, "text": event.msg},
@@ -0,0 +1,138 @@
+import asyncio
+import logging
+from asyncio import Task
+from typing import (
+    Any,
+    AsyncGenerator,
+    Callable,
+    Dict,
+    Generic,
+    List,
+    Optional,
+    Tuple,
+    TypeVar,
+)
+
+from llama_index.core.workflow import Workflow
+
+from app.observability import metrics
+
+logger = logging.getLogger("uvicorn")
+
+T = TypeVar("T")
+
+
+class SharedStream(Generic[T]):
+    """
+    Consumes a stream once and replays it to any number of subscribers, also to subscribers that join late.
+    All items are buffered until the stream is released, so the source doesn't wait for slow subscribers.
+    """
+
+    def __init__(self, source: AsyncGenerator[T, None]) -> None:
+        self._items: List[T] = []
+        self._error: Optional[BaseException] = None
+        self._done = False
+        self._changed = asyncio.Event()
+        self._task = asyncio.create_task(self._consume(source))
+
+    async def _consume(self, source: AsyncGenerator[T, None]) -> None:
+        try:
+            async for item in source:
+                self._items.append(item)
+                self._notify()
+        except Exception as e:
+            self._error = e
+        finally:
+            self._done = True
+            self._notify()
+
+    def _notify(self) -> None:
+        # wake up the waiting subscribers, later waits use a new event
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def wait(self) -> None:
+        await asyncio.wait([self._task])
+
+    async def subscribe(self) -> AsyncGenerator[T, None]:
+        index = 0
+        while True:
+            while index < len(self._items):
+                yield self._items[index]
+                index += 1
+            if self._done:
+                if self._error is not None:
+                    raise self._error
+                return
+            await self._changed.wait()
+
+
+class SharedRun:
+    """
+    Run of an agent that is shared by all requests with the same input.
+    Each subscriber gets its own replay of the events and of the streamed response.
+    """
+
+    def __init__(self, agent: Workflow, **run_kwargs: Any) -> None:
+        # the budget and the id of the run, shared by the subscribers
+        self.budget = run_kwargs.get("budget")
+        self.run_id = run_kwargs.get("run_id")
+        self._task = asyncio.create_task(agent.run(**run_kwargs))
+        self._events = SharedStream(agent.stream_events())
+        self._response: Optional[SharedStream] = None
+        self._task.add_done_callback(self._share_response)
+
+    def _share_response(self, task: Task) -> None:
+        # a streamed response can only be consumed once, so it's replayed to the subscribers
+        if task.cancelled() or task.exception() is not None:
+            return
+        if isinstance(task.result(), AsyncGenerator):
+            self._response = SharedStream(task.result())
+
+    async def wait(self) -> None:
+        """
+        Wait until the run and its streamed response are finished
+        """
+        await asyncio.wait([self._task])
+        if self._response is not None:
+            await self._response.wait()
+
+    async def _result(self) -> Any:
+        # shielded, so a cancelled subscriber doesn't cancel the run of the other subscribers
+        result = await asyncio.shield(self._task)
+        if self._response is not None:
+            return self._response.subscribe()
+        return result
+
+    def subscribe(self) -> Tuple[Task, Callable[[], AsyncGenerator]]:
+        """
+        Get the task with the result of the run and the function to stream the events of the run, like for an agent
+        """
+        return asyncio.create_task(self._result()), self._events.subscribe
+
+
+class RunCoalescer:
+    """
+    Single-flight for agent runs: requests with the same key join the run that is in flight instead of starting a new one.
+    Finished runs aren't reused, so the next request with the same key starts a new run.
+    """
+
+    def __init__(self) -> None:
+        self._runs: Dict[str, SharedRun] = {}
+
+    def get_or_start(self, key: str, start: Callable[[], SharedRun]) -> SharedRun:
+        run = self._runs.get(key)
+        if run is not None:
+            metrics.incr("chat_coalescing.joined")
+            logger.info("Joining the run in flight for the same chat request")
+            return run
+        metrics.incr("chat_coalescing.started")
+        run = self._runs[key] = start()
+        asyncio.create_task(self._forget(key, run))
+        return run
+
+    async def _forget(self, key: str, run: SharedRun) -> None:
+        # finished runs are released once their subscribers are done
+        await run.wait()
+        if self._runs.get(key) is run:
+            del self._runs[key]
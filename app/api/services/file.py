@@ -5,7 +5,12 @@ from io import BytesIO
 from pathlib import Path
 from typing import Any, List, Tuple
 
-from app.engine.index import IndexConfig, get_index
+from app.engine.index import (
+    IndexConfig,
+    bump_index_version,
+    get_index,
+    persist_index,
+)
 from llama_index.core import VectorStoreIndex
 from llama_index.core.ingestion import IngestionPipeline
 from llama_index.core.readers.file.base import (
@@ -87,17 +92,17 @@ class PrivateFileService:
             pipeline_id = current_index._get_pipeline_id()
             # LlamaCloudIndex is a managed index so we can directly use the files
             upload_file = (file_name, BytesIO(file_data))
-            return [
-                LLamaCloudFileService.add_file_to_pipeline(
-                    project_id,
-                    pipeline_id,
-                    upload_file,
-                    custom_metadata={
-                        # Set private=true to mark the document as private user docs (required for filtering)
-                        "private": "true",
-                    },
-                )
-            ]
+            doc_id = LLamaCloudFileService.add_file_to_pipeline(
+                project_id,
+                pipeline_id,
+                upload_file,
+                custom_metadata={
+                    # Set private=true to mark the document as private user docs (required for filtering)
+                    "private": "true",
+                },
+            )
+            bump_index_version()
+            return [doc_id]
         else:
             # First process documents into nodes
             documents = PrivateFileService.store_and_parse_file(
@@ -111,9 +116,7 @@ class PrivateFileService:
                 current_index = VectorStoreIndex(nodes=nodes)
             else:
                 current_index.insert_nodes(nodes=nodes)
-            current_index.storage_context.persist(
-                persist_dir=os.environ.get("STORAGE_DIR", "storage")
-            )
+            persist_index(current_index)
 
             # Return the document ids
             return [doc.doc_id for doc in documents]
@@ -0,0 +1,208 @@
+import asyncio
+import logging
+import os
+import re
+from asyncio import Task
+from typing import Any, AsyncGenerator, Callable, Dict, List, Optional, Tuple
+
+from llama_index.core.llms import ChatMessage, ChatResponse
+from llama_index.core.schema import NodeWithScore
+from llama_index.core.storage.docstore.utils import doc_to_json, json_to_doc
+from llama_index.core.workflow import Workflow
+from pydantic import BaseModel
+
+from app.agents.single import AgentRunEvent, AgentRunResult, SourceNodesEvent
+from app.cache import TieredCache, hash_key
+from app.engine.index import get_index_version
+from app.examples.factory import create_agent
+from app.observability import metrics
+from app.rate_limit import Priority, llm_priority
+
+logger = logging.getLogger("uvicorn")
+
+
+def get_conversation_starters() -> List[str]:
+    conversation_starters = os.getenv("CONVERSATION_STARTERS")
+    if not conversation_starters or not conversation_starters.strip():
+        return []
+    return conversation_starters.strip().split("\n")
+
+
+def normalize_question(text: str) -> str:
+    # questions only differing in whitespace or case are the same
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+def get_prompts_version(agent: Workflow) -> str:
+    """
+    Hash of the prompts of the agent and its nested agents (see `list_prompts` of the agents),
+    changes if a prompt is changed
+    """
+    return hash_key(agent.list_prompts())
+
+
+# recordings of older versions are recorded again
+RECORDING_VERSION = 2
+
+
+class RecordedEvent(BaseModel):
+    # either a progress message of an agent or the source nodes retrieved by a tool
+    name: Optional[str] = None
+    msg: Optional[str] = None
+    nodes: Optional[List[Dict[str, Any]]] = None
+
+    @classmethod
+    def from_event(cls, event: AgentRunEvent | SourceNodesEvent) -> "RecordedEvent":
+        if isinstance(event, SourceNodesEvent):
+            return cls(
+                nodes=[
+                    {"node": doc_to_json(node.node), "score": node.score}
+                    for node in event.nodes
+                ]
+            )
+        return cls(name=event.name, msg=event.msg)
+
+    def to_event(self) -> AgentRunEvent | SourceNodesEvent:
+        if self.nodes is not None:
+            return SourceNodesEvent(
+                nodes=[
+                    NodeWithScore(node=json_to_doc(node["node"]), score=node["score"])
+                    for node in self.nodes
+                ]
+            )
+        return AgentRunEvent(name=self.name, msg=self.msg)
+
+
+class RecordedRun(BaseModel):
+    """
+    Events and response tokens of a run, replayed like a live run
+    """
+
+    events: List[RecordedEvent]
+    tokens: List[str]
+
+    def replay(self) -> Tuple[Task, Callable[[], AsyncGenerator]]:
+        async def response() -> AsyncGenerator[ChatResponse, None]:
+            content = ""
+            for token in self.tokens:
+                content += token
+                yield ChatResponse(
+                    message=ChatMessage(role="assistant", content=content),
+                    delta=token,
+                )
+
+        async def result() -> AsyncGenerator[ChatResponse, None]:
+            return response()
+
+        async def events() -> AsyncGenerator[AgentRunEvent | SourceNodesEvent, None]:
+            for event in self.events:
+                yield event.to_event()
+
+        return asyncio.create_task(result()), events
+
+
+class StarterAnswers:
+    """
+    Precomputed answers for the conversation starters, so the most common first messages are replayed instead of run.
+    The answers are recorded with the agent of the current `EXAMPLE_TYPE` and are invalid once the index,
+    the prompts or the models of the agents change.
+    """
+
+    def __init__(self, cache_dir: Optional[str] = None) -> None:
+        self._cache = TieredCache(
+            name="starter_answers",
+            max_size=256,
+            path=os.path.join(cache_dir, "starter_answers.db") if cache_dir else None,
+        )
+        self._prompts_version: Optional[str] = None
+
+    def get_key(self, question: str) -> str:
+        return hash_key(
+            normalize_question(question),
+            get_index_version(),
+            self._prompts_version,
+            os.getenv("EXAMPLE_TYPE", "").lower(),
+            os.getenv("MODEL_ROUTING", "default"),
+            RECORDING_VERSION,
+        )
+
+    def get(self, question: str) -> Optional[RecordedRun]:
+        # the prompts are known once the answers were warmed up
+        if self._prompts_version is None:
+            return None
+        if normalize_question(question) not in {
+            normalize_question(starter) for starter in get_conversation_starters()
+        }:
+            return None
+        value = self._cache.get(self.get_key(question))
+        return RecordedRun(**value) if value is not None else None
+
+    async def record(self, question: str) -> RecordedRun:
+        agent = create_agent()
+        task = asyncio.create_task(agent.run(input=question, streaming=True))
+        events = [
+            RecordedEvent.from_event(event)
+            async for event in agent.stream_events()
+            if isinstance(event, (AgentRunEvent, SourceNodesEvent))
+        ]
+        result = await task
+        if isinstance(result, AgentRunResult):
+            tokens = [result.response.message.content or ""]
+        else:
+            tokens = [chunk.delta async for chunk in result if chunk.delta]
+        return RecordedRun(events=events, tokens=tokens)
+
+    async def warm_up(self) -> None:
+        """
+        Record the answers of the conversation starters that aren't recorded for the current index and prompts yet
+        """
+        starters = get_conversation_starters()
+        if not starters:
+            return
+        self._prompts_version = get_prompts_version(create_agent())
+        for question in starters:
+            key = self.get_key(question)
+            if self._cache.get(key) is not None:
+                continue
+            logger.info(f"Precomputing the answer for the starter: {question}")
+            try:
+                # chats go first
+                with llm_priority(Priority.BATCH):
+                    recorded = await self.record(question)
+            except Exception:
+                logger.exception(f"Failed to precompute the answer for: {question}")
+                continue
+            # the index might have changed while recording
+            if self.get_key(question) == key:
+                self._cache.set(key, recorded.model_dump())
+                metrics.incr("starter_answers.recorded")
+
+    async def keep_warm(self, interval: float) -> None:
+        """
+        Warm up now and again each time the index version changes
+        """
+        version = object()
+        while True:
+            if get_index_version() != version:
+                version = get_index_version()
+                try:
+                    await self.warm_up()
+                except Exception:
+                    # e.g. there is no index yet
+                    logger.exception("Failed to precompute the conversation starters")
+            await asyncio.sleep(interval)
+
+
+_starter_answers: Optional[StarterAnswers] = None
+
+
+def get_starter_answers() -> Optional[StarterAnswers]:
+    """
+    Get the process-wide precomputed starter answers, None if disabled by setting `STARTER_ANSWERS=false`
+    """
+    global _starter_answers
+    if os.getenv("STARTER_ANSWERS", "true").lower() != "true":
+        return None
+    if _starter_answers is None:
+        _starter_answers = StarterAnswers(cache_dir=os.getenv("STARTER_ANSWERS_DIR"))
+    return _starter_answers
@@ -1,7 +1,11 @@
+import asyncio
 import logging
-from typing import List
+import os
+from typing import List, Optional
 
 from app.api.routers.models import Message
+from app.cache import TieredCache, hash_key
+from llama_index.core.llms import MessageRole
 from llama_index.core.prompts import PromptTemplate
 from llama_index.core.settings import Settings
 from pydantic import BaseModel
@@ -58,3 +62,80 @@ class NextQuestionSuggestion:
         except Exception as e:
             logger.error(f"Error when generating next question: {e}")
             return []
+
+
+_suggestion_cache: Optional[TieredCache] = None
+
+
+def get_suggestion_cache() -> TieredCache:
+    global _suggestion_cache
+    if _suggestion_cache is None:
+        _suggestion_cache = TieredCache(
+            name="suggestion_cache",
+            max_size=int(os.getenv("SUGGESTION_CACHE_SIZE", "1024")),
+        )
+    return _suggestion_cache
+
+
+class StreamingSuggestion:
+    """
+    Suggests the next questions while the answer is streamed: the suggestion is started with the partial answer
+    once `SUGGESTION_START_CHARS` characters arrived, so it's ready when the stream ends.
+    The questions are cached per final answer and per partial answer they were started with,
+    so replayed answers (e.g. of conversation starters) don't need an LLM call.
+    """
+
+    def __init__(self, messages: List[Message]) -> None:
+        self.messages = messages
+        self.start_chars = int(os.getenv("SUGGESTION_START_CHARS", "500"))
+        self._answer = ""
+        self._task: Optional[asyncio.Task] = None
+        self._partial_key: Optional[str] = None
+
+    def _key(self, kind: str) -> str:
+        question = self.messages[-1].content if self.messages else ""
+        return hash_key(kind, question, self._answer)
+
+    def add(self, delta: str) -> None:
+        self._answer += delta
+        if self._task is None and len(self._answer) >= self.start_chars:
+            self._start()
+
+    def _start(self) -> None:
+        self._partial_key = self._key("partial")
+        cached = get_suggestion_cache().get(self._partial_key)
+        if cached is not None:
+            self._task = asyncio.create_task(asyncio.sleep(0, result=cached))
+            return
+        self._task = asyncio.create_task(
+            NextQuestionSuggestion.suggest_next_questions(
+                [
+                    *self.messages,
+                    Message(role=MessageRole.ASSISTANT, content=self._answer),
+                ]
+            )
+        )
+
+    async def get(self) -> List[str]:
+        """
+        Get the questions once the answer is complete
+        """
+        cache = get_suggestion_cache()
+        answer_key = self._key("answer")
+        cached = cache.get(answer_key)
+        if cached is not None:
+            if self._task is not None:
+                self._task.cancel()
+            return cached
+        if self._task is None:
+            # the answer is shorter than needed for starting early
+            self._start()
+        questions = await self._task
+        if questions:
+            cache.set(answer_key, questions)
+            cache.set(self._partial_key, questions)
+        return questions
+
+    def cancel(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
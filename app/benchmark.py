@@ -0,0 +1,129 @@
+# flake8: noqa: E402
+from dotenv import load_dotenv
+
+load_dotenv()
+
+import argparse
+import asyncio
+import logging
+import os
+import time
+from typing import Dict, List
+
+from llama_index.core.callbacks import TokenCountingHandler
+from pydantic import BaseModel
+
+from app.examples.factory import create_agent
+from app.rate_limit import Priority, llm_priority
+from app.settings import (
+    AGENT_NAMES,
+    get_agent_llm,
+    init_model_routing,
+    init_settings,
+    load_models_config,
+)
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger()
+
+DEFAULT_TASKS = ["Write a blog post about physical standards for letters"]
+
+
+class RoutingResult(BaseModel):
+    routing: str
+    latencies: List[float] = []
+    failed: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cost: float = 0
+
+
+async def benchmark_routing(routing: str, tasks: List[str]) -> RoutingResult:
+    init_model_routing(routing)
+    costs: Dict[str, Dict[str, float]] = load_models_config().get("costs") or {}
+    # count the tokens per model, agents without a model of their own share the default model
+    llms = {id(llm): llm for llm in (get_agent_llm(name) for name in AGENT_NAMES)}
+    token_counters = {}
+    for key, llm in llms.items():
+        token_counters[key] = TokenCountingHandler()
+        llm.callback_manager.add_handler(token_counters[key])
+
+    result = RoutingResult(routing=routing)
+    try:
+        for task in tasks:
+            agent = create_agent()
+            start = time.perf_counter()
+            try:
+                await agent.run(input=task)
+            except Exception:
+                logger.exception(f"Task '{task}' failed with routing {routing}")
+                result.failed += 1
+                continue
+            result.latencies.append(time.perf_counter() - start)
+    finally:
+        for key, llm in llms.items():
+            llm.callback_manager.remove_handler(token_counters[key])
+
+    for key, llm in llms.items():
+        counter = token_counters[key]
+        cost = costs.get(llm.metadata.model_name, {})
+        result.prompt_tokens += counter.prompt_llm_token_count
+        result.completion_tokens += counter.completion_llm_token_count
+        result.cost += (
+            counter.prompt_llm_token_count * cost.get("input", 0)
+            + counter.completion_llm_token_count * cost.get("output", 0)
+        ) / 1_000_000
+    return result
+
+
+async def benchmark_routings(
+    routings: List[str], tasks: List[str]
+) -> List[RoutingResult]:
+    # run all routings in one event loop, as the shared HTTP connections are bound to it
+    return [await benchmark_routing(routing, tasks) for routing in routings]
+
+
+def run_benchmark():
+    """
+    Compare the latency and cost of the model routings in config/models.yaml by running the same tasks with each routing.
+    """
+    parser = argparse.ArgumentParser(description=run_benchmark.__doc__)
+    parser.add_argument(
+        "--routing",
+        action="append",
+        help="Routing to benchmark, can be repeated (default: all routings)",
+    )
+    parser.add_argument(
+        "--task",
+        action="append",
+        help="Task to run, can be repeated (default: the blog post task of main.py)",
+    )
+    args = parser.parse_args()
+
+    # disable the response caches, so each routing does the same work
+    os.environ["LLM_CACHE"] = "false"
+    os.environ["RESEARCH_CACHE_SIZE"] = "0"
+    os.environ["PLAN_CACHE_SIZE"] = "0"
+    init_settings()
+
+    routings = args.routing or list(load_models_config().get("routings") or {})
+    tasks = args.task or DEFAULT_TASKS
+    with llm_priority(Priority.BATCH):
+        results = asyncio.run(benchmark_routings(routings or ["default"], tasks))
+
+    print(
+        f"{'routing':<16}{'tasks':>8}{'failed':>8}{'mean latency (s)':>18}"
+        f"{'prompt tokens':>15}{'completion tokens':>19}{'cost (USD)':>12}"
+    )
+    for result in results:
+        mean_latency = (
+            sum(result.latencies) / len(result.latencies) if result.latencies else 0
+        )
+        print(
+            f"{result.routing:<16}{len(tasks):>8}{result.failed:>8}{mean_latency:>18.2f}"
+            f"{result.prompt_tokens:>15}{result.completion_tokens:>19}{result.cost:>12.4f}"
+        )
+
+
+if __name__ == "__main__":
+    run_benchmark()
@@ -0,0 +1,259 @@
+import os
+import threading
+from collections import defaultdict
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional, Tuple
+
+from llama_index.core.base.llms.types import ChatMessage, ChatResponse
+from llama_index.core.instrumentation import get_dispatcher
+from llama_index.core.instrumentation.event_handlers import BaseEventHandler
+from llama_index.core.instrumentation.events import BaseEvent
+from llama_index.core.instrumentation.events.llm import (
+    LLMChatEndEvent,
+    LLMCompletionEndEvent,
+)
+from llama_index.core.utils import get_tokenizer
+from pydantic import BaseModel
+
+from app.deadline import DeadlineWorkflow
+from app.observability import metrics
+
+
+class BudgetExceededError(Exception):
+    pass
+
+
+class TokenUsage(BaseModel):
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    llm_calls: int = 0
+    # estimated cost in USD, only for models with a price in config/models.yaml
+    cost: float = 0
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+
+class RunBudget:
+    """
+    Token and cost budget of a run, shared with all nested runs.
+    Once the soft limit (a fraction of the budget) is used, the agents degrade, e.g. by skipping reviews.
+    Once the budget is used up, further LLM calls fail with a `BudgetExceededError`.
+    """
+
+    def __init__(
+        self,
+        max_tokens: Optional[int] = None,
+        max_cost: Optional[float] = None,
+        soft_limit: float = 0.8,
+    ) -> None:
+        self.max_tokens = max_tokens
+        self.max_cost = max_cost
+        self.soft_limit = soft_limit
+        self.usage = TokenUsage()
+        self._delegations: Dict[str, int] = defaultdict(int)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "RunBudget":
+        max_tokens = os.getenv("RUN_TOKEN_BUDGET")
+        max_cost = os.getenv("RUN_COST_BUDGET")
+        return cls(
+            max_tokens=int(max_tokens) if max_tokens else None,
+            max_cost=float(max_cost) if max_cost else None,
+            soft_limit=float(os.getenv("RUN_BUDGET_SOFT_LIMIT", "0.8")),
+        )
+
+    def record(
+        self, prompt_tokens: int, completion_tokens: int, model: Optional[str] = None
+    ) -> None:
+        cost = _get_cost(model, prompt_tokens, completion_tokens)
+        with self._lock:
+            self.usage.prompt_tokens += prompt_tokens
+            self.usage.completion_tokens += completion_tokens
+            self.usage.llm_calls += 1
+            self.usage.cost += cost
+        metrics.incr("llm.prompt_tokens", prompt_tokens)
+        metrics.incr("llm.completion_tokens", completion_tokens)
+        metrics.incr("llm.cost", cost)
+
+    def used(self) -> float:
+        """
+        Fraction of the budget that is used, 0 if there is no budget
+        """
+        fractions = [0.0]
+        if self.max_tokens:
+            fractions.append(self.usage.total_tokens / self.max_tokens)
+        if self.max_cost:
+            fractions.append(self.usage.cost / self.max_cost)
+        return max(fractions)
+
+    def is_low(self) -> bool:
+        return self.used() >= self.soft_limit
+
+    def check(self) -> None:
+        if self.used() >= 1:
+            metrics.incr("run_budget.exceeded")
+            raise BudgetExceededError(
+                f"Budget of the run is used up: {self.usage.total_tokens} tokens, {self.usage.cost:.4f} USD"
+            )
+
+    def count_delegation(self, agent_name: str) -> int:
+        """
+        Count a call of another agent, returns the number of calls of the agent in this run
+        """
+        with self._lock:
+            self._delegations[agent_name] += 1
+            return self._delegations[agent_name]
+
+
+_run_budget: ContextVar[Optional[RunBudget]] = ContextVar("run_budget", default=None)
+
+
+def get_run_budget() -> Optional[RunBudget]:
+    return _run_budget.get()
+
+
+def is_token_budget_low() -> bool:
+    """
+    Whether the token budget of the current run is almost used up, so optional work should be skipped
+    """
+    budget = _run_budget.get()
+    return budget is not None and budget.is_low()
+
+
+def check_budget() -> None:
+    budget = _run_budget.get()
+    if budget is not None:
+        budget.check()
+
+
+class BudgetedWorkflow(DeadlineWorkflow):
+    """
+    Workflow with a token budget (see `RunBudget`). A run creates a budget unless it's nested in another run
+    or the budget is passed with `run(budget=...)`, e.g. to read the usage of a streamed response.
+    The usage is added to results that have a `usage` field.
+    """
+
+    async def run(self, budget: Optional[RunBudget] = None, **kwargs: Any) -> Any:
+        parent_budget = _run_budget.get()
+        if budget is None:
+            budget = parent_budget or RunBudget.from_env()
+        _ensure_usage_handler()
+        token = _run_budget.set(budget)
+        try:
+            result = await super().run(**kwargs)
+        finally:
+            _run_budget.reset(token)
+        if budget is not parent_budget and hasattr(result, "usage"):
+            result.usage = budget.usage.model_copy()
+        return result
+
+
+def record_usage(
+    budget: Optional[RunBudget],
+    messages: List[ChatMessage],
+    response: ChatResponse,
+) -> None:
+    if budget is None:
+        return
+    prompt_tokens, completion_tokens = _get_token_counts(
+        response.raw, response.additional_kwargs
+    )
+    if prompt_tokens is None:
+        prompt_tokens = _count_tokens(*(message.content for message in messages))
+        completion_tokens = _count_tokens(
+            response.message.content,
+            response.message.additional_kwargs.get("tool_calls"),
+        )
+    budget.record(prompt_tokens, completion_tokens, _get_model(response.raw))
+
+
+class _UsageEventHandler(BaseEventHandler):
+    @classmethod
+    def class_name(cls) -> str:
+        return "UsageEventHandler"
+
+    def handle(self, event: BaseEvent, **kwargs: Any) -> Any:
+        # LLM calls report to the budget of the run they're made in
+        budget = _run_budget.get()
+        if budget is None:
+            return
+        if isinstance(event, LLMChatEndEvent) and event.response is not None:
+            record_usage(budget, event.messages, event.response)
+        elif isinstance(event, LLMCompletionEndEvent):
+            prompt_tokens, completion_tokens = _get_token_counts(
+                event.response.raw, event.response.additional_kwargs
+            )
+            if prompt_tokens is None:
+                prompt_tokens = _count_tokens(event.prompt)
+                completion_tokens = _count_tokens(event.response.text)
+            budget.record(
+                prompt_tokens, completion_tokens, _get_model(event.response.raw)
+            )
+
+
+_usage_handler: Optional[_UsageEventHandler] = None
+
+
+def _ensure_usage_handler() -> None:
+    global _usage_handler
+    if _usage_handler is None:
+        _usage_handler = _UsageEventHandler()
+        get_dispatcher().add_event_handler(_usage_handler)
+
+
+def _get_token_counts(
+    raw: Any, additional_kwargs: Dict[str, Any]
+) -> Tuple[Optional[int], Optional[int]]:
+    # the token counts reported by the provider, e.g. by OpenAI
+    if "prompt_tokens" in additional_kwargs:
+        return (
+            additional_kwargs["prompt_tokens"],
+            additional_kwargs.get("completion_tokens", 0),
+        )
+    usage = raw.get("usage") if isinstance(raw, dict) else getattr(raw, "usage", None)
+    if isinstance(usage, dict):
+        usage = type("Usage", (), usage)
+    if getattr(usage, "prompt_tokens", None) is not None:
+        return usage.prompt_tokens, getattr(usage, "completion_tokens", 0) or 0
+    return None, None
+
+
+def _get_model(raw: Any) -> Optional[str]:
+    return raw.get("model") if isinstance(raw, dict) else getattr(raw, "model", None)
+
+
+def _count_tokens(*texts: Any) -> int:
+    # estimate the tokens if the provider doesn't report them
+    tokenizer = get_tokenizer()
+    return sum(len(tokenizer(str(text))) for text in texts if text)
+
+
+# prices of the models from config/models.yaml, longest model name first
+_costs: Optional[List[Tuple[str, Dict[str, float]]]] = None
+
+
+def _get_model_cost(model: str) -> Optional[Dict[str, float]]:
+    from app.settings import load_models_config
+
+    global _costs
+    if _costs is None:
+        _costs = sorted(
+            (load_models_config().get("costs") or {}).items(),
+            key=lambda item: -len(item[0]),
+        )
+    # providers return versioned model names, e.g. gpt-4o-mini-2024-07-18
+    return next((cost for name, cost in _costs if model.startswith(name)), None)
+
+
+def _get_cost(model: Optional[str], prompt_tokens: int, completion_tokens: int) -> float:
+    if model is None:
+        return 0
+    cost = _get_model_cost(model)
+    if cost is None:
+        return 0
+    return (
+        prompt_tokens * cost.get("input", 0) + completion_tokens * cost.get("output", 0)
+    ) / 1_000_000
@@ -0,0 +1,292 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Generic, List, Optional, Tuple, TypeVar
+
+import numpy as np
+from cachetools import LRUCache, TTLCache
+from llama_index.core.base.embeddings.base import BaseEmbedding, Embedding
+from llama_index.core.bridge.pydantic import PrivateAttr, SerializeAsAny
+
+from app.observability import metrics
+
+T = TypeVar("T")
+
+
+@dataclass
+class _SemanticCacheEntry(Generic[T]):
+    embedding: np.ndarray
+    value: T
+    created_at: float
+
+
+class SemanticCache(Generic[T]):
+    """
+    In-memory cache keyed by embeddings. A lookup hits if a stored embedding has a
+    cosine similarity of at least `similarity_threshold` to the given embedding.
+    Entries are evicted least recently used first (if `max_size` is reached) or once they are older than `ttl` seconds.
+    Each entry belongs to a `version` (e.g. of the index), changing the version clears the cache.
+    Hits and misses are counted in the metrics as `<name>.hits` and `<name>.misses`.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        similarity_threshold: float = 0.95,
+        max_size: int = 256,
+        ttl: Optional[float] = None,
+    ) -> None:
+        self.name = name
+        self.similarity_threshold = similarity_threshold
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: OrderedDict[str, _SemanticCacheEntry[T]] = OrderedDict()
+        self._version: Optional[str] = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    def lookup(
+        self, embedding: List[float], version: Optional[str] = None
+    ) -> Optional[Tuple[T, float]]:
+        """
+        Return the most similar cached value and its similarity, or None on a miss.
+        """
+        if not self.enabled:
+            return None
+        query = _normalize(embedding)
+        with self._lock:
+            self._check_version(version)
+            self._evict_expired()
+            best_key, best_score = None, -1.0
+            for key, entry in self._entries.items():
+                score = float(np.dot(query, entry.embedding))
+                if score > best_score:
+                    best_key, best_score = key, score
+            if best_key is None or best_score < self.similarity_threshold:
+                metrics.incr(f"{self.name}.misses")
+                return None
+            self._entries.move_to_end(best_key)
+            metrics.incr(f"{self.name}.hits")
+            return self._entries[best_key].value, best_score
+
+    def store(
+        self, embedding: List[float], value: T, version: Optional[str] = None
+    ) -> None:
+        if not self.enabled:
+            return
+        with self._lock:
+            if version != self._version:
+                # computed for an outdated version
+                return
+            self._entries[str(uuid.uuid4())] = _SemanticCacheEntry(
+                embedding=_normalize(embedding),
+                value=value,
+                created_at=time.monotonic(),
+            )
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _check_version(self, version: Optional[str]) -> None:
+        if version != self._version:
+            self._entries.clear()
+            self._version = version
+
+    def _evict_expired(self) -> None:
+        if self.ttl is None:
+            return
+        now = time.monotonic()
+        expired = [
+            key
+            for key, entry in self._entries.items()
+            if now - entry.created_at > self.ttl
+        ]
+        for key in expired:
+            del self._entries[key]
+
+
+def _normalize(embedding: Any) -> np.ndarray:
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+class SQLiteCache:
+    """
+    Persistent key-value cache stored in a SQLite database. Values are stored as JSON.
+    """
+
+    def __init__(self, path: str, table: str = "cache", ttl: Optional[float] = None):
+        dirname = os.path.dirname(path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.table = table
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value TEXT, created_at REAL)"
+            )
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            row = self._conn.execute(
+                f"SELECT value, created_at FROM {self.table} WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None:
+            return None
+        value, created_at = row
+        if self.ttl is not None and time.time() - created_at > self.ttl:
+            return None
+        return json.loads(value)
+
+    def set(self, key: str, value: Any) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, created_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value), time.time()),
+            )
+
+
+def hash_key(*parts: Any) -> str:
+    """
+    Stable hash of the given parts, used as cache key.
+    """
+    data = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+class TieredCache:
+    """
+    In-memory LRU cache with an optional persistent SQLite cache as second tier.
+    Values must be JSON serializable. Entries expire after `ttl` seconds (if set).
+    Hits and misses are counted in the metrics as `<name>.hits` and `<name>.misses`.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_size: int = 1024,
+        ttl: Optional[float] = None,
+        path: Optional[str] = None,
+    ) -> None:
+        self.name = name
+        self._memory = (
+            TTLCache(maxsize=max_size, ttl=ttl) if ttl else LRUCache(maxsize=max_size)
+        )
+        self._disk = SQLiteCache(path, table=name, ttl=ttl) if path else None
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            value = self._memory.get(key)
+        if value is None and self._disk is not None:
+            value = self._disk.get(key)
+            if value is not None:
+                metrics.incr(f"{self.name}.disk_hits")
+                with self._lock:
+                    self._memory[key] = value
+        metrics.incr(f"{self.name}.{'misses' if value is None else 'hits'}")
+        return value
+
+    def set(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._memory[key] = value
+        if self._disk is not None:
+            self._disk.set(key, value)
+
+
+class CachedEmbedding(BaseEmbedding):
+    """
+    Wraps an embedding model and caches the embeddings of queries and texts by exact match.
+    Uses an in-memory LRU cache and optionally a persistent SQLite cache as second tier.
+    Hits and misses are counted in the metrics as `embedding_cache.hits` and `embedding_cache.misses`.
+    """
+
+    embed_model: SerializeAsAny[BaseEmbedding]
+
+    _cache: TieredCache = PrivateAttr()
+
+    def __init__(
+        self,
+        embed_model: BaseEmbedding,
+        max_size: int = 1024,
+        cache_dir: Optional[str] = None,
+        **kwargs: Any,
+    ) -> None:
+        super().__init__(
+            embed_model=embed_model,
+            model_name=embed_model.model_name,
+            embed_batch_size=embed_model.embed_batch_size,
+            callback_manager=embed_model.callback_manager,
+            num_workers=embed_model.num_workers,
+            **kwargs,
+        )
+        self._cache = TieredCache(
+            name="embedding_cache",
+            max_size=max_size,
+            path=os.path.join(cache_dir, "embeddings.db") if cache_dir else None,
+        )
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CachedEmbedding"
+
+    def _key(self, kind: str, text: str) -> str:
+        # query and text embeddings differ for some providers
+        return hash_key(self.embed_model.class_name(), self.model_name, kind, text)
+
+    def _get_query_embedding(self, query: str) -> Embedding:
+        key = self._key("query", query)
+        embedding = self._cache.get(key)
+        if embedding is None:
+            embedding = self.embed_model._get_query_embedding(query)
+            self._cache.set(key, embedding)
+        return embedding
+
+    async def _aget_query_embedding(self, query: str) -> Embedding:
+        key = self._key("query", query)
+        embedding = self._cache.get(key)
+        if embedding is None:
+            embedding = await self.embed_model._aget_query_embedding(query)
+            self._cache.set(key, embedding)
+        return embedding
+
+    def _get_text_embedding(self, text: str) -> Embedding:
+        key = self._key("text", text)
+        embedding = self._cache.get(key)
+        if embedding is None:
+            embedding = self.embed_model._get_text_embedding(text)
+            self._cache.set(key, embedding)
+        return embedding
+
+    async def _aget_text_embedding(self, text: str) -> Embedding:
+        key = self._key("text", text)
+        embedding = self._cache.get(key)
+        if embedding is None:
+            embedding = await self.embed_model._aget_text_embedding(text)
+            self._cache.set(key, embedding)
+        return embedding
+
+    # batches are only used for ingestion, pass them through to keep the batching of the provider
+    def _get_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        return self.embed_model._get_text_embeddings(texts)
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        return await self.embed_model._aget_text_embeddings(texts)
@@ -0,0 +1,135 @@
+import logging
+import os
+from contextvars import ContextVar
+from typing import Any, AsyncGenerator, Awaitable, Callable, Optional, TypeVar
+
+from app.cache import TieredCache
+from app.events import EventSinkWorkflow
+from app.observability import metrics
+
+logger = logging.getLogger("uvicorn")
+
+T = TypeVar("T")
+
+
+class CheckpointStore:
+    """
+    Outputs of the completed steps of workflow runs, keyed by run id and step.
+    Kept in memory and, if `cache_dir` is set, persisted, so runs can also be resumed after a restart.
+    Values must be JSON serializable.
+    """
+
+    def __init__(
+        self,
+        cache_dir: Optional[str] = None,
+        max_size: int = 4096,
+        ttl: Optional[float] = None,
+    ) -> None:
+        self._cache = TieredCache(
+            name="checkpoints",
+            max_size=max_size,
+            ttl=ttl,
+            path=os.path.join(cache_dir, "checkpoints.db") if cache_dir else None,
+        )
+
+    def get(self, run_id: str, key: str) -> Optional[Any]:
+        return self._cache.get(f"{run_id}:{key}")
+
+    def set(self, run_id: str, key: str, value: Any) -> None:
+        self._cache.set(f"{run_id}:{key}", value)
+
+
+_checkpoint_store: Optional[CheckpointStore] = None
+
+
+def get_checkpoint_store() -> Optional[CheckpointStore]:
+    """
+    Get the process-wide checkpoint store, None unless enabled by setting `CHECKPOINTS=true`
+    """
+    global _checkpoint_store
+    if os.getenv("CHECKPOINTS", "false").lower() != "true":
+        return None
+    if _checkpoint_store is None:
+        ttl = os.getenv("CHECKPOINT_TTL", "86400")
+        _checkpoint_store = CheckpointStore(
+            cache_dir=os.getenv("CHECKPOINT_DIR"),
+            ttl=float(ttl) if ttl else None,
+        )
+    return _checkpoint_store
+
+
+class RunCheckpoint:
+    """
+    Checkpoint of a single run: the outputs of its completed steps
+    """
+
+    def __init__(self, store: CheckpointStore, run_id: str) -> None:
+        self.store = store
+        self.run_id = run_id
+
+    async def step(
+        self,
+        key: str,
+        compute: Callable[[], Awaitable[T]],
+        dump: Callable[[T], Any],
+        load: Callable[[Any], T],
+    ) -> T:
+        stored = self.store.get(self.run_id, key)
+        if stored is not None:
+            metrics.incr("checkpoint.resumed_steps")
+            logger.info(f"Resuming run {self.run_id}: skipping completed step {key}")
+            return load(stored["value"])
+        result = await compute()
+        # a streamed result is consumed by the caller, so the step is only done once it's streamed
+        if not isinstance(result, AsyncGenerator):
+            self.store.set(self.run_id, key, {"value": dump(result)})
+            metrics.incr("checkpoint.saved_steps")
+        return result
+
+
+_run_checkpoint: ContextVar[Optional[RunCheckpoint]] = ContextVar(
+    "run_checkpoint", default=None
+)
+
+
+def _identity(value: Any) -> Any:
+    return value
+
+
+async def checkpointed(
+    key: str,
+    compute: Callable[[], Awaitable[T]],
+    dump: Callable[[T], Any] = _identity,
+    load: Callable[[Any], T] = _identity,
+) -> T:
+    """
+    Run `compute` as completed step `key` of the current run: if the run is resumed and the step was completed before,
+    its stored output is loaded instead. The key must identify the step within the run,
+    e.g. with the name of the sub task or the number of the revision.
+    Without a checkpoint of the run, `compute` is just awaited.
+    """
+    checkpoint = _run_checkpoint.get()
+    if checkpoint is None:
+        return await compute()
+    return await checkpoint.step(key, compute, dump, load)
+
+
+class CheckpointWorkflow(EventSinkWorkflow):
+    """
+    Workflow that can be resumed: with `run(run_id=...)` the outputs of its completed steps (see `checkpointed`)
+    are stored under the run id and a new run with the same id skips these steps, e.g. after a timeout or a restart.
+    Nested runs aren't checkpointed themselves, their outputs are the outputs of the steps of the outer run.
+    """
+
+    async def run(self, run_id: Optional[str] = None, **kwargs: Any) -> Any:
+        store = get_checkpoint_store()
+        checkpoint = (
+            RunCheckpoint(store, run_id)
+            if run_id is not None and store is not None
+            else None
+        )
+        token = _run_checkpoint.set(checkpoint)
+        try:
+            return await super().run(**kwargs)
+        finally:
+            _run_checkpoint.reset(token)
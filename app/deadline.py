@@ -0,0 +1,96 @@
+import asyncio
+import math
+import os
+import time
+from contextvars import ContextVar
+from typing import Any, List, Optional
+
+from llama_index.core.workflow import Context, StopEvent, Workflow, WorkflowTimeoutError
+
+# monotonic time at which the current request has to be finished
+_deadline: ContextVar[Optional[float]] = ContextVar("deadline", default=None)
+# contexts started by the current workflow run
+_run_contexts: ContextVar[Optional[List[Context]]] = ContextVar(
+    "run_contexts", default=None
+)
+
+
+def get_remaining_time() -> Optional[float]:
+    """
+    Get the seconds left until the deadline of the current run, None if there is no deadline
+    """
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return max(deadline - time.monotonic(), 0)
+
+
+def is_low_budget() -> bool:
+    """
+    Whether the deadline is close, so optional work should be skipped or done cheaper
+    """
+    remaining = get_remaining_time()
+    return remaining is not None and remaining < float(
+        os.getenv("LOW_BUDGET_SECONDS", "60")
+    )
+
+
+class DeadlineWorkflow(Workflow):
+    """
+    Workflow sharing the deadline of the run that started it, e.g. an agent called as tool by another agent.
+    The timeout of a run is the time left until the deadline (or its own timeout if that's shorter),
+    so nested runs stop together with the outer run instead of running on.
+    The deadline is set for all tasks of the run, so its steps, LLM calls and tool calls can check the remaining time.
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        # the timeout is applied per run (see `run`), concurrent runs of the same workflow can have different deadlines
+        self._max_timeout = self._timeout
+        self._timeout = None
+
+    async def run(self, **kwargs: Any) -> Any:
+        deadline = _deadline.get()
+        if self._max_timeout is not None:
+            deadline = min(
+                deadline or math.inf, time.monotonic() + self._max_timeout
+            )
+        contexts: List[Context] = []
+        deadline_token = _deadline.set(deadline)
+        contexts_token = _run_contexts.set(contexts)
+        try:
+            timeout = get_remaining_time()
+            run = asyncio.create_task(super().run(**kwargs))
+        finally:
+            _deadline.reset(deadline_token)
+            _run_contexts.reset(contexts_token)
+        try:
+            done, _ = await asyncio.wait({run}, timeout=timeout)
+        except asyncio.CancelledError:
+            # the caller gave up, e.g. the outer run timed out, so stop the steps of this run too
+            await _stop_run(run, contexts)
+            raise
+        if not done:
+            await _stop_run(run, contexts)
+            raise WorkflowTimeoutError(f"Operation timed out after {timeout} seconds")
+        return run.result()
+
+    def _start(self, *args: Any, **kwargs: Any) -> Context:
+        ctx = super()._start(*args, **kwargs)
+        contexts = _run_contexts.get()
+        if contexts is not None:
+            contexts.append(ctx)
+        return ctx
+
+
+async def _stop_run(run: asyncio.Task, contexts: List[Context]) -> None:
+    if not contexts:
+        # the run didn't start its steps yet
+        run.cancel()
+    for ctx in contexts:
+        # the workflow stops itself on a stop event and cancels its running steps
+        ctx.send_event(StopEvent())
+    await asyncio.wait({run})
+    if not run.cancelled():
+        # the result of the stopped run is discarded
+        run.exception()
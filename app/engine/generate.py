@@ -4,8 +4,8 @@ from dotenv import load_dotenv
 load_dotenv()
 
 import logging
-import os
 
+from app.engine.index import get_storage_dir, persist_index
 from app.engine.loaders import get_documents
 from app.settings import init_settings
 from llama_index.core.indices import (
@@ -19,7 +19,7 @@ logger = logging.getLogger()
 def generate_datasource():
     init_settings()
     logger.info("Creating new index")
-    storage_dir = os.environ.get("STORAGE_DIR", "storage")
+    storage_dir = get_storage_dir()
     # load the documents and create the index
     documents = get_documents()
     # Set private=false to mark the document as public (required for filtering)
@@ -30,7 +30,7 @@ def generate_datasource():
         show_progress=True,
     )
     # store it for later
-    index.storage_context.persist(storage_dir)
+    persist_index(index, storage_dir)
     logger.info(f"Finished creating new index. Stored in {storage_dir}")
 
 
@@ -1,5 +1,6 @@
 import logging
 import os
+import uuid
 from datetime import timedelta
 from typing import Optional
 
@@ -11,6 +12,8 @@ from pydantic import BaseModel, Field
 
 logger = logging.getLogger("uvicorn")
 
+INDEX_VERSION_FILE = "index_version"
+
 
 class IndexConfig(BaseModel):
     callback_manager: Optional[CallbackManager] = Field(
@@ -21,7 +24,7 @@ class IndexConfig(BaseModel):
 def get_index(config: IndexConfig = None):
     if config is None:
         config = IndexConfig()
-    storage_dir = os.getenv("STORAGE_DIR", "storage")
+    storage_dir = get_storage_dir()
     # check if storage already exists
     if not os.path.exists(storage_dir):
         return None
@@ -37,7 +40,43 @@ def get_index(config: IndexConfig = None):
 
 @cached(
     TTLCache(maxsize=10, ttl=timedelta(minutes=5).total_seconds()),
-    key=lambda *args, **kwargs: "global_storage_context",
+    # reload the storage context once the index has been changed
+    key=lambda persist_dir: f"global_storage_context:{get_index_version(persist_dir)}",
 )
 def get_storage_context(persist_dir: str) -> StorageContext:
     return StorageContext.from_defaults(persist_dir=persist_dir)
+
+
+def get_storage_dir() -> str:
+    return os.getenv("STORAGE_DIR", "storage")
+
+
+def persist_index(index, storage_dir: Optional[str] = None) -> None:
+    """
+    Persist the index and mark it as changed, so caches depending on its content get invalidated
+    """
+    storage_dir = storage_dir or get_storage_dir()
+    index.storage_context.persist(persist_dir=storage_dir)
+    bump_index_version(storage_dir)
+
+
+def bump_index_version(storage_dir: Optional[str] = None) -> str:
+    storage_dir = storage_dir or get_storage_dir()
+    os.makedirs(storage_dir, exist_ok=True)
+    version = str(uuid.uuid4())
+    with open(os.path.join(storage_dir, INDEX_VERSION_FILE), "w") as f:
+        f.write(version)
+    return version
+
+
+def get_index_version(storage_dir: Optional[str] = None) -> Optional[str]:
+    """
+    Get the version of the persisted index. Changes each time the index is generated or a file is uploaded.
+    Returns None if the index has no version yet.
+    """
+    storage_dir = storage_dir or get_storage_dir()
+    try:
+        with open(os.path.join(storage_dir, INDEX_VERSION_FILE)) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        return None
@@ -0,0 +1,29 @@
+from typing import List, Optional
+
+from llama_index.core.postprocessor.types import BaseNodePostprocessor
+from llama_index.core.schema import NodeWithScore, QueryBundle
+
+from app.deadline import is_low_budget
+
+
+class LowBudgetNodeLimiter(BaseNodePostprocessor):
+    """
+    Keep only the `top_k` best nodes if the deadline of the run is close, so there is less to synthesize
+    """
+
+    top_k: int = 1
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "LowBudgetNodeLimiter"
+
+    def _postprocess_nodes(
+        self,
+        nodes: List[NodeWithScore],
+        query_bundle: Optional[QueryBundle] = None,
+    ) -> List[NodeWithScore]:
+        if not is_low_budget():
+            return nodes
+        return sorted(nodes, key=lambda node: node.score or 0, reverse=True)[
+            : self.top_k
+        ]
@@ -0,0 +1,152 @@
+import logging
+import os
+import time
+from typing import List, Optional
+
+from llama_index.core.base.base_query_engine import BaseQueryEngine
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.base.response.schema import RESPONSE_TYPE, Response
+from llama_index.core.indices.base import BaseIndex
+from llama_index.core.schema import NodeWithScore, QueryBundle
+from llama_index.core.settings import Settings
+from pydantic import BaseModel
+
+from app.cache import SemanticCache
+from app.deadline import is_low_budget
+from app.engine.index import get_index_version
+from app.observability import metrics
+
+logger = logging.getLogger("uvicorn")
+
+
+class CachedAnswer(BaseModel):
+    response: str
+    node_ids: List[str]
+    scores: List[Optional[float]]
+    # time it took to compute the answer
+    latency: float
+
+
+_research_cache: Optional[SemanticCache[CachedAnswer]] = None
+
+
+def get_research_cache() -> SemanticCache[CachedAnswer]:
+    """
+    Get the process-wide cache for answers of the query engine, so it's shared across requests
+    """
+    global _research_cache
+    if _research_cache is None:
+        ttl = os.getenv("RESEARCH_CACHE_TTL", "3600")
+        _research_cache = SemanticCache(
+            name="research_cache",
+            similarity_threshold=float(
+                os.getenv("RESEARCH_CACHE_SIMILARITY_THRESHOLD", "0.95")
+            ),
+            max_size=int(os.getenv("RESEARCH_CACHE_SIZE", "256")),
+            ttl=float(ttl) if ttl else None,
+        )
+    return _research_cache
+
+
+class SemanticCacheQueryEngine(BaseQueryEngine):
+    """
+    Query engine answering similar queries from a semantic cache instead of running retrieval and synthesis again.
+    The cache is invalidated if the index version changes (see `persist_index`).
+    """
+
+    def __init__(
+        self,
+        query_engine: BaseQueryEngine,
+        index: BaseIndex,
+        cache: SemanticCache[CachedAnswer] | None = None,
+        embed_model: BaseEmbedding | None = None,
+    ) -> None:
+        super().__init__(callback_manager=query_engine.callback_manager)
+        self._query_engine = query_engine
+        self._index = index
+        self._cache = cache if cache is not None else get_research_cache()
+        self._embed_model = embed_model or Settings.embed_model
+
+    def _get_prompt_modules(self):
+        return {"query_engine": self._query_engine}
+
+    def _query(self, query_bundle: QueryBundle) -> RESPONSE_TYPE:
+        if not self._cache.enabled:
+            return self._query_engine.query(query_bundle)
+        version = get_index_version()
+        if query_bundle.embedding is None:
+            query_bundle.embedding = self._embed_model.get_agg_embedding_from_queries(
+                query_bundle.embedding_strs
+            )
+        cached = self._lookup(query_bundle, version)
+        if cached is not None:
+            return cached
+        start = time.perf_counter()
+        response = self._query_engine.query(query_bundle)
+        self._store(query_bundle, response, time.perf_counter() - start, version)
+        return response
+
+    async def _aquery(self, query_bundle: QueryBundle) -> RESPONSE_TYPE:
+        if not self._cache.enabled:
+            return await self._query_engine.aquery(query_bundle)
+        version = get_index_version()
+        if query_bundle.embedding is None:
+            # the embedding is reused by the retriever of the wrapped query engine
+            query_bundle.embedding = (
+                await self._embed_model.aget_agg_embedding_from_queries(
+                    query_bundle.embedding_strs
+                )
+            )
+        cached = self._lookup(query_bundle, version)
+        if cached is not None:
+            return cached
+        start = time.perf_counter()
+        response = await self._query_engine.aquery(query_bundle)
+        self._store(query_bundle, response, time.perf_counter() - start, version)
+        return response
+
+    def _lookup(
+        self, query_bundle: QueryBundle, version: Optional[str]
+    ) -> Optional[Response]:
+        hit = self._cache.lookup(query_bundle.embedding, version)
+        if hit is None:
+            return None
+        answer, similarity = hit
+        logger.info(
+            f"Research cache hit for '{query_bundle.query_str}' (similarity: {similarity:.3f})"
+        )
+        metrics.incr("research_cache.latency_saved_seconds", answer.latency)
+        source_nodes = []
+        for node_id, score in zip(answer.node_ids, answer.scores):
+            node = self._index.docstore.get_node(node_id, raise_error=False)
+            if node is not None:
+                source_nodes.append(NodeWithScore(node=node, score=score))
+        return Response(
+            response=answer.response,
+            source_nodes=source_nodes,
+            metadata={"cached": True, "similarity": similarity},
+        )
+
+    def _store(
+        self,
+        query_bundle: QueryBundle,
+        response: RESPONSE_TYPE,
+        latency: float,
+        version: Optional[str],
+    ) -> None:
+        # only plain responses can be cached, streaming responses are consumed by the caller
+        if not isinstance(response, Response) or response.response is None:
+            return
+        if is_low_budget():
+            # the answer might be synthesized from fewer nodes to meet the deadline
+            return
+        self._cache.store(
+            query_bundle.embedding,
+            CachedAnswer(
+                response=response.response,
+                node_ids=[node.node.node_id for node in response.source_nodes],
+                scores=[node.score for node in response.source_nodes],
+                latency=latency,
+            ),
+            version,
+        )
@@ -0,0 +1,166 @@
+import asyncio
+import os
+from collections import deque
+from contextvars import ContextVar
+from typing import Any, AsyncGenerator, Deque, Dict, List, Optional, Tuple
+
+from llama_index.core.workflow import Context, Event, StopEvent
+
+from app.budget import BudgetedWorkflow
+from app.observability import metrics
+
+
+class EventSink:
+    """
+    Events of a run and all its nested runs, which publish into the sink directly instead of re-sending
+    the events of their nested runs level by level.
+    The sink is bounded: if the consumer is slow, progress events (see `is_progress_event`) are coalesced to the latest
+    per agent and the agents wait before their next LLM call (see `wait_for_event_consumer`).
+    Without a consumer, events exceeding the bound are dropped.
+    """
+
+    def __init__(self, max_size: Optional[int] = None) -> None:
+        self.max_size = max_size or int(os.getenv("EVENT_SINK_SIZE", "256"))
+        self._events: Deque[Event] = deque()
+        # latest progress event per agent that didn't fit into the sink
+        self._progress: Dict[str, Event] = {}
+        self.run_started = False
+        self.consumer_attached = False
+        self._closed = False
+        self._readable = asyncio.Event()
+        self._writable = asyncio.Event()
+        self._writable.set()
+
+    def publish(self, event: Optional[Event]) -> None:
+        # the stop events of the runs are skipped, the stream ends when the run owning the sink is done
+        if event is None or isinstance(event, StopEvent):
+            return
+        if len(self._events) < self.max_size:
+            self._events.append(event)
+        elif is_progress_event(event):
+            self._progress[event.name] = event
+            metrics.incr("event_sink.coalesced")
+        elif self.consumer_attached:
+            # the publishing agents wait for the consumer before their next step
+            self._events.append(event)
+        else:
+            metrics.incr("event_sink.dropped")
+            return
+        if len(self._events) >= self.max_size:
+            self._writable.clear()
+        self._readable.set()
+
+    def close(self) -> None:
+        self._closed = True
+        self._readable.set()
+
+    async def wait_for_space(self) -> None:
+        if self.consumer_attached:
+            await self._writable.wait()
+
+    async def stream(self) -> AsyncGenerator[Event, None]:
+        self.consumer_attached = True
+        while True:
+            if self._events:
+                event = self._events.popleft()
+            elif self._progress:
+                event = self._progress.pop(next(iter(self._progress)))
+            elif self._closed:
+                return
+            else:
+                self._readable.clear()
+                await self._readable.wait()
+                continue
+            if len(self._events) < self.max_size:
+                self._writable.set()
+            yield event
+
+
+def is_progress_event(event: Event) -> bool:
+    # plain progress messages of the agents, only the latest is needed if the consumer is behind
+    from app.agents.single import AgentRunEvent
+
+    return type(event) is AgentRunEvent
+
+
+_event_sink: ContextVar[Optional[EventSink]] = ContextVar("event_sink", default=None)
+# streams of the contexts started by the current run and the tasks forwarding them into the sink
+_run_forwards: ContextVar[Optional[List[Tuple[asyncio.Queue, asyncio.Task]]]] = (
+    ContextVar("run_forwards", default=None)
+)
+
+
+async def wait_for_event_consumer() -> None:
+    """
+    Backpressure: wait until the consumer of the events of the current run caught up
+    """
+    sink = _event_sink.get()
+    if sink is not None:
+        await sink.wait_for_space()
+
+
+async def _forward_events(queue: asyncio.Queue, sink: EventSink) -> None:
+    while True:
+        sink.publish(await queue.get())
+
+
+def _drain_events(queue: asyncio.Queue, sink: EventSink) -> None:
+    while not queue.empty():
+        sink.publish(queue.get_nowait())
+
+
+class EventSinkWorkflow(BudgetedWorkflow):
+    """
+    Workflow publishing its events into the event sink of the run that started it (see `EventSink`),
+    so nested runs are just awaited and `stream_events` of the outermost workflow streams the events of all levels.
+    The steps write their events with `ctx.write_event_to_stream` as usual: the events are forwarded
+    from the stream of the context of each run into the sink.
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self._event_sink: Optional[EventSink] = None
+
+    async def run(self, **kwargs: Any) -> Any:
+        parent_sink = _event_sink.get()
+        sink = parent_sink
+        if sink is None:
+            # the consumer might already wait for the events of this run
+            sink = self._event_sink
+            if sink is None or sink.run_started:
+                sink = self._event_sink = EventSink()
+            sink.run_started = True
+        forwards: List[Tuple[asyncio.Queue, asyncio.Task]] = []
+        sink_token = _event_sink.set(sink)
+        forwards_token = _run_forwards.set(forwards)
+        try:
+            return await super().run(**kwargs)
+        finally:
+            _event_sink.reset(sink_token)
+            _run_forwards.reset(forwards_token)
+            # the events not forwarded yet are published before the caller continues, so they stay in order
+            for queue, task in forwards:
+                task.cancel()
+                _drain_events(queue, sink)
+            if parent_sink is None:
+                sink.close()
+
+    def _start(self, *args: Any, **kwargs: Any) -> Context:
+        # the only hook into upstream: the context of a run is created here, its stream is forwarded into the sink
+        ctx = super()._start(*args, **kwargs)
+        sink = _event_sink.get()
+        forwards = _run_forwards.get()
+        if sink is not None and forwards is not None:
+            queue = ctx.streaming_queue
+            forwards.append(
+                (queue, asyncio.create_task(_forward_events(queue, sink)))
+            )
+        return ctx
+
+    async def stream_events(self) -> AsyncGenerator[Event, None]:
+        sink = self._event_sink
+        if sink is None or sink.consumer_attached:
+            # the run isn't started yet
+            sink = self._event_sink = EventSink()
+        async for event in sink.stream():
+            yield event
@@ -16,6 +16,7 @@ def create_choreography(chat_history: Optional[List[ChatMessage]] = None):
     return AgentCallingAgent(
         name="writer",
         agents=[researcher, reviewer],
+        max_calls_per_agent=2,
         role="expert in writing blog posts",
         system_prompt="""You are an expert in writing blog posts. You are given a task to write a blog post. Before starting to write the post, consult the researcher agent to get the information you need. Don't make up any information yourself.
         After creating a draft for the post, send it to the reviewer agent to receive some feedback and make sure to incorporate the feedback from the reviewer.
@@ -1,3 +1,4 @@
+import os
 from typing import List, Optional
 from app.agents.single import FunctionCallingAgent
 from app.agents.multi import AgentOrchestrator
@@ -24,4 +25,6 @@ def create_orchestrator(chat_history: Optional[List[ChatMessage]] = None):
     return AgentOrchestrator(
         agents=[writer, reviewer, researcher],
         refine_plan=False,
+        # parsing the partial tool calls of a streamed plan is only known to work for OpenAI
+        stream_plan=os.getenv("PLAN_STREAMING", "false").lower() == "true",
     )
@@ -3,6 +3,8 @@ from typing import List
 from llama_index.core.tools import QueryEngineTool, ToolMetadata
 from app.agents.single import FunctionCallingAgent
 from app.engine.index import get_index
+from app.engine.postprocessors import LowBudgetNodeLimiter
+from app.engine.query_cache import SemanticCacheQueryEngine
 
 from llama_index.core.chat_engine.types import ChatMessage
 
@@ -16,8 +18,12 @@ def get_query_engine_tool() -> QueryEngineTool:
         raise ValueError("Index not found. Please create an index first.")
     top_k = int(os.getenv("TOP_K", 0))
     query_engine = index.as_query_engine(
-        **({"similarity_top_k": top_k} if top_k != 0 else {})
+        **({"similarity_top_k": top_k} if top_k != 0 else {}),
+        # synthesize from fewer nodes if the deadline of the run is close
+        node_postprocessors=[LowBudgetNodeLimiter(top_k=max(top_k // 2, 1))],
     )
+    # answer similar research questions from the cache
+    query_engine = SemanticCacheQueryEngine(query_engine=query_engine, index=index)
     return QueryEngineTool(
         query_engine=query_engine,
         metadata=ToolMetadata(
@@ -1,5 +1,6 @@
-import asyncio
-from typing import AsyncGenerator, List, Optional
+import os
+import re
+from typing import Any, AsyncGenerator, Dict, List, Optional
 
 
 from llama_index.core.workflow import (
@@ -11,7 +12,12 @@ from llama_index.core.workflow import (
     step,
 )
 from llama_index.core.chat_engine.types import ChatMessage
+from pydantic import BaseModel, Field, ValidationError
+from app.agents.memory import CompactingChatMemory
 from app.agents.single import AgentRunEvent, AgentRunResult, FunctionCallingAgent
+from app.budget import is_token_budget_low
+from app.checkpoint import CheckpointWorkflow, checkpointed
+from app.deadline import is_low_budget
 from app.examples.researcher import create_researcher
 
 
@@ -19,19 +25,29 @@ def create_workflow(chat_history: Optional[List[ChatMessage]] = None):
     researcher = create_researcher(
         chat_history=chat_history,
     )
+    # writer and reviewer are called for each revision, so only keep the latest draft verbatim
+    memory_token_limit = os.getenv("REVISION_MEMORY_TOKEN_LIMIT")
+    memory_config = {
+        "memory_cls": CompactingChatMemory,
+        "memory_token_limit": int(memory_token_limit) if memory_token_limit else None,
+    }
     writer = FunctionCallingAgent(
         name="writer",
         role="expert in writing blog posts",
         system_prompt="""You are an expert in writing blog posts. You are given a task to write a blog post. Don't make up any information yourself.""",
         chat_history=chat_history,
+        **memory_config,
     )
     reviewer = FunctionCallingAgent(
         name="reviewer",
         role="expert in reviewing blog posts",
         system_prompt="You are an expert in reviewing blog posts. You are given a task to review a blog post. Review the post for logical inconsistencies, ask critical questions, and provide suggestions for improvement. Furthermore, proofread the post for grammar and spelling errors. Only if the post is good enough for publishing, then you MUST return 'The post is good.'. In all other cases return your review.",
         chat_history=chat_history,
+        **memory_config,
+    )
+    workflow = BlogPostWorkflow(
+        timeout=360, revision_mode=os.getenv("REVISION_MODE", "rewrite")
     )
-    workflow = BlogPostWorkflow(timeout=360)
     workflow.add_workflows(researcher=researcher, writer=writer, reviewer=reviewer)
     return workflow
 
@@ -40,16 +56,104 @@ class ResearchEvent(Event):
     input: str
 
 
+class Edit(BaseModel):
+    find: str = Field(description="Exact passage of the blog post to change")
+    replace: Optional[str] = Field(
+        default=None,
+        description="Replacement for the passage, if the fix can be given directly",
+    )
+    comment: Optional[str] = Field(
+        default=None,
+        description="Instruction for the writer to rewrite the passage, if the fix can't be given directly",
+    )
+
+
+class Review(BaseModel):
+    is_good: bool
+    edits: List[Edit] = []
+
+    @classmethod
+    def from_response(cls, response: str) -> Optional["Review"]:
+        """
+        Parse the review from the JSON object in the reviewer's response. Returns None if there is no valid review.
+        """
+        start, end = response.find("{"), response.rfind("}")
+        if start == -1 or end < start:
+            return None
+        try:
+            return cls.model_validate_json(response[start : end + 1])
+        except ValidationError:
+            return None
+
+
+REVIEW_EDITS_PROMPT = """Review the following blog post. Return your review as JSON object with the following format:
+{{"is_good": <true if the post is good enough for publishing, otherwise false>, "edits": [{{"find": "<exact passage of the post to change>", "replace": "<replacement of the passage>"}}, {{"find": "<exact passage of the post to change>", "comment": "<what the writer has to change in the passage>"}}]}}
+Use "replace" for fixes you can give directly, e.g. grammar and spelling errors, and "comment" for passages that the writer has to rewrite. Don't add any text outside of the JSON object.
+Blog post:
+```
+{post}
+```"""
+
+REVIEW_PROMPT = """Review the following blog post. Start your response with your verdict: 'The post is good.' if the post is good enough for publishing, otherwise 'The post needs improvements.' followed by your review.
+Blog post:
+```
+{post}
+```"""
+
+REWRITE_PASSAGE_PROMPT = """Rewrite the following passage of your blog post by using the given review comment. Only output the rewritten passage.
+Passage:
+```
+{passage}
+```
+
+Review comment:
+```
+{comment}
+```"""
+
+
 class WriteEvent(Event):
     input: str
     is_good: bool = False
+    # edits of the reviewer, only used in 'edits' revision mode
+    edits: Optional[List[Edit]] = None
 
 
 class ReviewEvent(Event):
     input: str
 
 
-class BlogPostWorkflow(Workflow):
+class BlogPostWorkflow(CheckpointWorkflow):
+    """
+    Workflow for writing a blog post with a researcher, a writer and a reviewer.
+    With `revision_mode="rewrite"` the writer rewrites the whole post for each review,
+    with `revision_mode="edits"` the reviewer returns edits that are applied to the draft and the writer
+    only rewrites the passages that the edits touch.
+    Runs started with a `run_id` can be resumed: the research, the drafts and the reviews of completed steps are reused.
+    """
+
+    def __init__(self, *args: Any, revision_mode: str = "rewrite", **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        if revision_mode not in ("rewrite", "edits"):
+            raise ValueError(
+                f"Invalid revision mode: {revision_mode}. Choose 'rewrite' or 'edits'."
+            )
+        self.revision_mode = revision_mode
+        self.agents: Dict[str, FunctionCallingAgent] = {}
+
+    def add_workflows(self, **workflows: Workflow) -> None:
+        super().add_workflows(**workflows)
+        self.agents.update(workflows)
+
+    def list_prompts(self) -> List[str]:
+        """
+        Prompts of the agents and of the steps, e.g. to detect answers recorded with other prompts
+        """
+        prompts = [REVIEW_EDITS_PROMPT, REVIEW_PROMPT, REWRITE_PASSAGE_PROMPT]
+        for name in sorted(self.agents):
+            prompts.extend(self.agents[name].list_prompts())
+        return prompts
+
     @step()
     async def start(self, ctx: Context, ev: StartEvent) -> ResearchEvent:
         # set streaming
@@ -62,7 +166,9 @@ class BlogPostWorkflow(Workflow):
     async def research(
         self, ctx: Context, ev: ResearchEvent, researcher: FunctionCallingAgent
     ) -> WriteEvent:
-        result: AgentRunResult = await self.run_agent(ctx, researcher, ev.input)
+        result: AgentRunResult = await self.run_agent(
+            ctx, researcher, ev.input, checkpoint_key="research"
+        )
         content = result.response.message.content
         return WriteEvent(
             input=f"Write a blog post given this task: {ctx.data['task']} using this research content: {content}"
@@ -75,6 +181,9 @@ class BlogPostWorkflow(Workflow):
         MAX_ATTEMPTS = 2
         ctx.data["attempts"] = ctx.data.get("attempts", 0) + 1
         too_many_attempts = ctx.data["attempts"] > MAX_ATTEMPTS
+        # reviews are optional, so they are skipped if the deadline of the run is close or the tokens are running out
+        out_of_time = not too_many_attempts and is_low_budget()
+        out_of_tokens = not too_many_attempts and not out_of_time and is_token_budget_low()
         if too_many_attempts:
             ctx.write_event_to_stream(
                 AgentRunEvent(
@@ -82,13 +191,42 @@ class BlogPostWorkflow(Workflow):
                     msg=f"Too many attempts ({MAX_ATTEMPTS}) to write the blog post. Proceeding with the current version.",
                 )
             )
-        if ev.is_good or too_many_attempts:
-            # too many attempts or the blog post is good - stream final response if requested
+        elif out_of_time:
+            ctx.write_event_to_stream(
+                AgentRunEvent(
+                    name=writer.name,
+                    msg="Not enough time left for a review of the blog post. Proceeding without a review.",
+                )
+            )
+        elif out_of_tokens:
+            ctx.write_event_to_stream(
+                AgentRunEvent(
+                    name=writer.name,
+                    msg="The token budget is almost used up. Proceeding without a review.",
+                )
+            )
+        skip_review = too_many_attempts or out_of_time or out_of_tokens
+        if ev.edits is not None:
+            content = await self.apply_edits(ctx, writer, ev.edits)
+            if not skip_review:
+                return ReviewEvent(input=content)
+            ev = WriteEvent(
+                input=f"You're blog post is ready for publication. Blog post: ```{content}```",
+                is_good=True,
+            )
+        if ev.is_good or skip_review:
+            # no more reviews or the blog post is good - stream final response if requested
             result = await self.run_agent(
-                ctx, writer, ev.input, streaming=ctx.data["streaming"]
+                ctx,
+                writer,
+                ev.input,
+                streaming=ctx.data["streaming"],
+                checkpoint_key="publish",
             )
             return StopEvent(result=result)
-        result: AgentRunResult = await self.run_agent(ctx, writer, ev.input)
+        result: AgentRunResult = await self.run_agent(
+            ctx, writer, ev.input, checkpoint_key=f"write:{ctx.data['attempts']}"
+        )
         ctx.data["result"] = result
         return ReviewEvent(input=result.response.message.content)
 
@@ -96,10 +234,31 @@ class BlogPostWorkflow(Workflow):
     async def review(
         self, ctx: Context, ev: ReviewEvent, reviewer: FunctionCallingAgent
     ) -> WriteEvent:
-        result: AgentRunResult = await self.run_agent(ctx, reviewer, ev.input)
-        review = result.response.message.content
+        edits_mode = self.revision_mode == "edits"
+        review_input = (REVIEW_EDITS_PROMPT if edits_mode else REVIEW_PROMPT).format(
+            post=ev.input
+        )
+
+        def load_review(value: list) -> tuple[str, bool]:
+            reviewer.restore_run(review_input, value[0])
+            return value[0], value[1]
+
+        review, is_verdict_only = await checkpointed(
+            f"review:{ctx.data['attempts']}",
+            lambda: self.run_reviewer(ctx, reviewer, review_input),
+            list,
+            load_review,
+        )
         old_content = ctx.data["result"].response.message.content
-        post_is_good = "post is good" in review.lower()
+        parsed_review = (
+            Review.from_response(review)
+            if edits_mode and not is_verdict_only
+            else None
+        )
+        if parsed_review is not None:
+            post_is_good = parsed_review.is_good
+        else:
+            post_is_good = is_verdict_only or "post is good" in review.lower()
         ctx.write_event_to_stream(
             AgentRunEvent(
                 name=reviewer.name,
@@ -108,8 +267,11 @@ class BlogPostWorkflow(Workflow):
         )
         if post_is_good:
             return WriteEvent(
-                input=f"You're blog post is ready for publication. Blog post: ```{old_content}```"
+                input=f"You're blog post is ready for publication. Blog post: ```{old_content}```",
+                is_good=True,
             )
+        elif parsed_review is not None and parsed_review.edits:
+            return WriteEvent(input=review, edits=parsed_review.edits)
         else:
             return WriteEvent(
                 input=f"""Improve the writing of a given blog post by using a given review.
@@ -124,15 +286,77 @@ Review:
 ```"""
             )
 
+    async def run_reviewer(
+        self, ctx: Context, reviewer: FunctionCallingAgent, input: str
+    ) -> tuple[str, bool]:
+        """
+        Stream the review and stop as soon as its leading verdict says that the post is good, as the rest of the critique isn't needed then.
+        Returns the (partial) review and whether it was stopped early.
+        """
+        result = await self.run_agent(ctx, reviewer, input, streaming=True)
+        if isinstance(result, AgentRunResult):
+            return result.response.message.content, False
+        review = ""
+        async for chunk in result:
+            review = chunk.message.content or ""
+            if _is_good_verdict(review):
+                await result.aclose()
+                return review, True
+        return review, False
+
+    async def apply_edits(
+        self, ctx: Context, writer: FunctionCallingAgent, edits: List[Edit]
+    ) -> str:
+        """
+        Apply the edits to the stored draft. Only passages with a comment are rewritten by the writer.
+        """
+        result: AgentRunResult = ctx.data["result"]
+        content = result.response.message.content
+        applied = 0
+        for index, edit in enumerate(edits):
+            if not edit.find or edit.find not in content:
+                # the reviewer didn't quote the post exactly
+                continue
+            replacement = edit.replace
+            if replacement is None and edit.comment:
+                rewritten: AgentRunResult = await self.run_agent(
+                    ctx,
+                    writer,
+                    REWRITE_PASSAGE_PROMPT.format(
+                        passage=edit.find, comment=edit.comment
+                    ),
+                    checkpoint_key=f"rewrite:{ctx.data['attempts']}:{index}",
+                )
+                replacement = rewritten.response.message.content
+            if replacement is None:
+                continue
+            content = content.replace(edit.find, replacement, 1)
+            applied += 1
+        ctx.write_event_to_stream(
+            AgentRunEvent(
+                name=writer.name,
+                msg=f"Applied {applied} of {len(edits)} edits of the review to the blog post.",
+            )
+        )
+        result.response.message.content = content
+        return content
+
     async def run_agent(
         self,
         ctx: Context,
         agent: FunctionCallingAgent,
         input: str,
         streaming: bool = False,
+        checkpoint_key: Optional[str] = None,
     ) -> AgentRunResult | AsyncGenerator:
-        task = asyncio.create_task(agent.run(input=input, streaming=streaming))
-        # bubble all events while running the executor to the planner
-        async for event in agent.stream_events():
-            ctx.write_event_to_stream(event)
-        return await task
+        # the agent publishes its events into the event sink of this run
+        if checkpoint_key is not None:
+            return await agent.run_checkpointed(checkpoint_key, input, streaming)
+        return await agent.run(input=input, streaming=streaming)
+
+
+def _is_good_verdict(partial_review: str) -> bool:
+    # the verdict is either the leading 'is_good' field of the JSON review or the first sentence of the review
+    if re.search(r'"is_good"\s*:\s*true', partial_review):
+        return True
+    return "post is good" in partial_review.lstrip()[:50].lower()
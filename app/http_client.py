@@ -0,0 +1,190 @@
+import importlib.util
+import logging
+import os
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+
+from app.observability import metrics
+from app.rate_limit import RateLimitedSyncTransport, RateLimitedTransport
+
+logger = logging.getLogger("uvicorn")
+
+_http_client: Optional[httpx.Client] = None
+_async_http_client: Optional[httpx.AsyncClient] = None
+_async_transport: Optional["PerHostAsyncTransport"] = None
+
+
+def get_http_limits() -> httpx.Limits:
+    # the limits apply to the pool of each host, so a busy provider doesn't block the requests to the others
+    max_connections = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+    return httpx.Limits(
+        max_connections=max_connections,
+        max_keepalive_connections=int(
+            os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", str(max_connections))
+        ),
+        keepalive_expiry=float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60")),
+    )
+
+
+def get_http_timeout() -> httpx.Timeout:
+    # generating long responses can take minutes, connecting shouldn't
+    return httpx.Timeout(
+        float(os.getenv("HTTP_TIMEOUT", "600")),
+        connect=float(os.getenv("HTTP_CONNECT_TIMEOUT", "5")),
+    )
+
+
+@lru_cache
+def use_http2() -> bool:
+    if os.getenv("HTTP2", "true").lower() != "true":
+        return False
+    if importlib.util.find_spec("h2") is None:
+        logger.info("HTTP/2 is disabled, install 'httpx[http2]' to enable it")
+        return False
+    return True
+
+
+def _get_host_key(url: httpx.URL) -> Tuple[str, str, Optional[int]]:
+    return url.scheme, url.host, url.port
+
+
+class PerHostTransport(httpx.BaseTransport):
+    """
+    Transport with a connection pool per host, e.g. per model provider, each with the limits of `get_http_limits`
+    """
+
+    def __init__(self, limits: httpx.Limits, http2: bool) -> None:
+        self._limits = limits
+        self._http2 = http2
+        self.transports: Dict[Tuple[str, str, Optional[int]], httpx.HTTPTransport] = {}
+
+    def get_transport(self, url: httpx.URL) -> httpx.HTTPTransport:
+        key = _get_host_key(url)
+        transport = self.transports.get(key)
+        if transport is None:
+            transport = self.transports[key] = httpx.HTTPTransport(
+                limits=self._limits, http2=self._http2
+            )
+        return transport
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        return self.get_transport(request.url).handle_request(request)
+
+    def close(self) -> None:
+        for transport in self.transports.values():
+            transport.close()
+
+
+class PerHostAsyncTransport(httpx.AsyncBaseTransport):
+    """
+    Async variant of `PerHostTransport`
+    """
+
+    def __init__(self, limits: httpx.Limits, http2: bool) -> None:
+        self._limits = limits
+        self._http2 = http2
+        self.transports: Dict[
+            Tuple[str, str, Optional[int]], httpx.AsyncHTTPTransport
+        ] = {}
+
+    def get_transport(self, url: httpx.URL) -> httpx.AsyncHTTPTransport:
+        key = _get_host_key(url)
+        transport = self.transports.get(key)
+        if transport is None:
+            transport = self.transports[key] = httpx.AsyncHTTPTransport(
+                limits=self._limits, http2=self._http2
+            )
+        return transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        return await self.get_transport(request.url).handle_async_request(request)
+
+    async def aclose(self) -> None:
+        for transport in self.transports.values():
+            await transport.aclose()
+
+
+def get_http_client() -> httpx.Client:
+    """
+    Get the process-wide HTTP client, so the connections to the model providers are reused
+    """
+    global _http_client
+    if _http_client is None:
+        transport = PerHostTransport(get_http_limits(), use_http2())
+        _http_client = httpx.Client(
+            transport=RateLimitedSyncTransport(transport), timeout=get_http_timeout()
+        )
+    return _http_client
+
+
+def get_async_http_client() -> httpx.AsyncClient:
+    """
+    Get the process-wide async HTTP client, so the connections to the model providers are reused.
+    Requests to models are scheduled by their rate limiter (see `app.rate_limit`).
+    Each host has its own connection pool, the saturation of the busiest pool is exposed as `http_pool.*` metrics.
+    """
+    global _async_http_client, _async_transport
+    if _async_http_client is None:
+        limits = get_http_limits()
+
+        async def count_request(request: httpx.Request) -> None:
+            metrics.incr("http_pool.requests")
+            transport = _async_transport.get_transport(request.url)
+            if _count_active(transport) >= limits.max_connections:
+                # all connections are in use, the request waits for a free connection
+                metrics.incr("http_pool.saturated_requests")
+
+        _async_transport = PerHostAsyncTransport(limits, use_http2())
+        _async_http_client = httpx.AsyncClient(
+            transport=RateLimitedTransport(_async_transport),
+            timeout=get_http_timeout(),
+            event_hooks={"request": [count_request]},
+        )
+        metrics.register_gauge(
+            "http_pool.max_connections", lambda: limits.max_connections
+        )
+        metrics.register_gauge(
+            "http_pool.connections",
+            lambda: sum(len(_get_connections(t)) for t in _get_transports()),
+        )
+        metrics.register_gauge(
+            "http_pool.active_connections",
+            lambda: sum(_count_active(t) for t in _get_transports()),
+        )
+        metrics.register_gauge(
+            "http_pool.saturation",
+            lambda: max(
+                (_count_active(t) for t in _get_transports()),
+                default=0,
+            )
+            / limits.max_connections,
+        )
+    return _async_http_client
+
+
+def get_openai_http_clients() -> Dict:
+    """
+    Arguments for OpenAI based LLMs and embeddings to use the shared HTTP clients
+    """
+    return {
+        "http_client": get_http_client(),
+        "async_http_client": get_async_http_client(),
+    }
+
+
+def _get_transports() -> List[httpx.AsyncHTTPTransport]:
+    if _async_transport is None:
+        return []
+    return list(_async_transport.transports.values())
+
+
+def _get_connections(transport: httpx.AsyncHTTPTransport) -> list:
+    # httpx doesn't expose its connection pool, so the pool of the transport is used
+    pool = getattr(transport, "_pool", None)
+    return list(pool.connections) if pool is not None else []
+
+
+def _count_active(transport: httpx.AsyncHTTPTransport) -> int:
+    return sum(not connection.is_idle() for connection in _get_connections(transport))
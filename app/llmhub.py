@@ -3,6 +3,8 @@ from llama_index.core.settings import Settings
 from typing import Dict
 import os
 
+from app.http_client import get_openai_http_clients
+
 DEFAULT_MODEL = "gpt-3.5-turbo"
 DEFAULT_EMBEDDING_MODEL = "text-embedding-3-large"
 
@@ -55,9 +57,12 @@ def init_llmhub():
     llm_configs = llm_config_from_env()
     embedding_configs = embedding_config_from_env()
 
-    Settings.embed_model = TSIEmbedding(**embedding_configs)
+    Settings.embed_model = TSIEmbedding(
+        **embedding_configs, **get_openai_http_clients()
+    )
     Settings.llm = OpenAILike(
         **llm_configs,
+        **get_openai_http_clients(),
         is_chat_model=True,
         is_function_calling_model=False,
         context_window=4096,
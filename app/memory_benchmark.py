@@ -0,0 +1,127 @@
+# flake8: noqa: E402
+from dotenv import load_dotenv
+
+load_dotenv()
+
+import argparse
+import asyncio
+import resource
+import time
+from typing import List, Type
+
+from llama_index.core.llms import ChatMessage, MessageRole
+from llama_index.core.memory import ChatMemoryBuffer
+
+from app.agents.memory import CompactingChatMemory, TokenCountingChatMemory
+from app.benchmark import DEFAULT_TASKS
+from app.examples.factory import create_agent
+from app.rate_limit import Priority, llm_priority
+from app.settings import init_settings
+
+MEMORY_CLASSES: List[Type[ChatMemoryBuffer]] = [
+    ChatMemoryBuffer,
+    TokenCountingChatMemory,
+    CompactingChatMemory,
+]
+
+
+def _tool_round(index: int, tool_output_words: int) -> List[ChatMessage]:
+    # an agent turn with a tool call returning a retrieved document and the answer
+    return [
+        ChatMessage(role=MessageRole.USER, content=f"Question {index}?"),
+        ChatMessage(
+            role=MessageRole.ASSISTANT,
+            content="",
+            additional_kwargs={"tool_calls": [{"id": str(index)}]},
+        ),
+        ChatMessage(
+            role=MessageRole.TOOL,
+            content=" ".join(
+                f"document{index} word{i}" for i in range(tool_output_words)
+            ),
+        ),
+        ChatMessage(role=MessageRole.ASSISTANT, content=f"Answer {index}."),
+    ]
+
+
+def benchmark_memory(
+    memory_cls: Type[ChatMemoryBuffer],
+    turns: int,
+    tool_output_words: int,
+    token_limit: int,
+) -> float:
+    """
+    Put the messages of `turns` tool rounds into the memory and get the history after each message like an agent does,
+    returns the seconds spent in the memory
+    """
+    memory = memory_cls.from_defaults(token_limit=token_limit)
+    start = time.perf_counter()
+    for index in range(turns):
+        for message in _tool_round(index, tool_output_words):
+            memory.put(message)
+            memory.get()
+    return time.perf_counter() - start
+
+
+def run_memory_benchmark():
+    """
+    Compare the time the chat memories spend on long agent histories, e.g. with retrieved documents as tool outputs.
+    """
+    parser = argparse.ArgumentParser(description=run_memory_benchmark.__doc__)
+    parser.add_argument("--turns", type=int, default=20)
+    parser.add_argument("--tool-output-words", type=int, default=1000)
+    parser.add_argument("--token-limit", type=int, default=24000)
+    args = parser.parse_args()
+
+    print(f"{'memory':<28}{'turns':>8}{'total (s)':>12}{'per get (ms)':>15}")
+    for memory_cls in MEMORY_CLASSES:
+        seconds = benchmark_memory(
+            memory_cls, args.turns, args.tool_output_words, args.token_limit
+        )
+        gets = args.turns * 4
+        print(
+            f"{memory_cls.__name__:<28}{args.turns:>8}{seconds:>12.2f}{seconds / gets * 1000:>15.2f}"
+        )
+
+
+async def run_concurrently(runs: int, task: str) -> List[int]:
+    """
+    Run the agent `runs` times concurrently and keep all results alive like concurrent chats do,
+    returns the size of each result in bytes
+    """
+
+    async def run_agent():
+        return await create_agent().run(input=task)
+
+    results = await asyncio.gather(
+        *(run_agent() for _ in range(runs)), return_exceptions=True
+    )
+    return [
+        len(result.model_dump_json()) if hasattr(result, "model_dump_json") else 0
+        for result in results
+    ]
+
+
+def run_rss_benchmark():
+    """
+    Measure the peak memory (RSS) per run of the agents for concurrent runs of the same task.
+    """
+    parser = argparse.ArgumentParser(description=run_rss_benchmark.__doc__)
+    parser.add_argument("--runs", type=int, default=20, help="Concurrent runs")
+    parser.add_argument("--task", default=DEFAULT_TASKS[0], help="Task to run")
+    args = parser.parse_args()
+
+    init_settings()
+    # the peak RSS of the process after loading the settings, in KiB on Linux
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    with llm_priority(Priority.BATCH):
+        result_sizes = asyncio.run(run_concurrently(args.runs, args.task))
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    print(
+        f"{'runs':>6}{'failed':>8}{'peak RSS per run (KiB)':>24}{'result size (KiB)':>19}"
+    )
+    print(
+        f"{args.runs:>6}{result_sizes.count(0):>8}{(peak - baseline) / args.runs:>24.1f}"
+        f"{sum(result_sizes) / max(len(result_sizes), 1) / 1024:>19.1f}"
+    )
@@ -1,2 +1,49 @@
+import threading
+from collections import defaultdict
+from typing import Callable, Dict
+
+
 def init_observability():
     pass
+
+
+class Metrics:
+    """
+    Process-wide counters, e.g. for cache hits and misses.
+    Counters named `<prefix>.hits` and `<prefix>.misses` get a derived `<prefix>.hit_rate`.
+    Gauges are read when taking a snapshot.
+    """
+
+    def __init__(self) -> None:
+        self._counters: Dict[str, float] = defaultdict(float)
+        self._gauges: Dict[str, Callable[[], float]] = {}
+        self._lock = threading.Lock()
+
+    def incr(self, name: str, value: float = 1) -> None:
+        with self._lock:
+            self._counters[name] += value
+
+    def get(self, name: str) -> float:
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def register_gauge(self, name: str, read: Callable[[], float]) -> None:
+        with self._lock:
+            self._gauges[name] = read
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+        for name in list(counters):
+            if name.endswith(".hits"):
+                prefix = name[: -len(".hits")]
+                hits = counters[name]
+                total = hits + counters.get(f"{prefix}.misses", 0)
+                counters[f"{prefix}.hit_rate"] = hits / total if total else 0.0
+        for name, read in gauges.items():
+            counters[name] = read()
+        return counters
+
+
+metrics = Metrics()
@@ -0,0 +1,479 @@
+import asyncio
+import itertools
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from contextvars import ContextVar
+from email.utils import parsedate_to_datetime
+from enum import IntEnum
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import httpx
+
+from app.observability import metrics
+
+logger = logging.getLogger("uvicorn")
+
+
+class Priority(IntEnum):
+    """
+    Priority of LLM requests, requests with a lower value are sent first
+    """
+
+    INTERACTIVE = 0
+    BATCH = 1
+    INGESTION = 2
+
+
+_priority: ContextVar[Priority] = ContextVar(
+    "llm_priority", default=Priority.INTERACTIVE
+)
+
+
+@contextmanager
+def llm_priority(priority: Priority) -> Iterator[None]:
+    """
+    Set the priority of the LLM requests made in this context (and the tasks started from it)
+    """
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously up to its capacity per minute
+    """
+
+    def __init__(self, per_minute: float) -> None:
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated) * self.capacity / 60
+        )
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        self._refill()
+        # a request larger than the bucket only waits for a full bucket
+        missing = min(amount, self.capacity) - self.tokens
+        return max(missing, 0) * 60 / self.capacity
+
+    def take(self, amount: float) -> None:
+        self.tokens -= amount
+
+    def limit(self, remaining: float) -> None:
+        # the provider knows the real usage, e.g. of other processes with the same key
+        self._refill()
+        self.tokens = min(self.tokens, remaining)
+
+
+class _Waiter:
+    def __init__(self, priority: Priority, seq: int, tokens: int, wake: Callable):
+        self.key = (priority, seq)
+        self.tokens = tokens
+        self.wake = wake
+
+
+class RateLimiter:
+    """
+    Limits the requests to a model of a provider: the number of requests in flight, requests per minute and tokens per minute.
+    Waiting requests are sent by priority, then in order of arrival. Works for both threads and asyncio tasks.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_concurrency: int,
+        rpm: Optional[float] = None,
+        tpm: Optional[float] = None,
+    ) -> None:
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.in_flight = 0
+        self._paused_until = 0.0
+        self._waiters: List[_Waiter] = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self, priority: Priority, tokens: int) -> None:
+        release_abandoned_streams()
+        loop = asyncio.get_running_loop()
+        event = asyncio.Event()
+        waiter = self._enqueue(
+            priority, tokens, lambda: loop.call_soon_threadsafe(event.set)
+        )
+        start = time.monotonic()
+        try:
+            while True:
+                # clear before trying, so a wake up in between isn't lost
+                event.clear()
+                delay = self._try_acquire(waiter)
+                if delay == 0:
+                    break
+                try:
+                    await asyncio.wait_for(event.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+        except BaseException:
+            self._dequeue(waiter)
+            raise
+        metrics.incr("rate_limit.wait_seconds", time.monotonic() - start)
+
+    def acquire_sync(self, priority: Priority, tokens: int) -> None:
+        release_abandoned_streams()
+        event = threading.Event()
+        waiter = self._enqueue(priority, tokens, event.set)
+        start = time.monotonic()
+        try:
+            while True:
+                event.clear()
+                delay = self._try_acquire(waiter)
+                if delay == 0:
+                    break
+                event.wait(delay)
+        except BaseException:
+            self._dequeue(waiter)
+            raise
+        metrics.incr("rate_limit.wait_seconds", time.monotonic() - start)
+
+    def release(self) -> None:
+        with self._lock:
+            self.in_flight -= 1
+        self._wake_all()
+
+    def pause(self, seconds: float) -> None:
+        """
+        Stop sending requests for the given time, e.g. after the provider returned a rate limit error
+        """
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def update(self, headers: httpx.Headers) -> None:
+        # OpenAI compatible providers return their remaining quota
+        with self._lock:
+            for bucket, header in (
+                (self.requests, "x-ratelimit-remaining-requests"),
+                (self.tokens, "x-ratelimit-remaining-tokens"),
+            ):
+                remaining = headers.get(header)
+                if bucket is not None and remaining is not None:
+                    try:
+                        bucket.limit(float(remaining))
+                    except ValueError:
+                        pass
+
+    def _enqueue(self, priority: Priority, tokens: int, wake: Callable) -> _Waiter:
+        waiter = _Waiter(priority, next(self._seq), tokens, wake)
+        with self._lock:
+            self._waiters.append(waiter)
+            self._waiters.sort(key=lambda w: w.key)
+        return waiter
+
+    def _dequeue(self, waiter: _Waiter) -> None:
+        with self._lock:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+        self._wake_all()
+
+    def _try_acquire(self, waiter: _Waiter) -> Optional[float]:
+        """
+        Returns 0 if the request can be sent, otherwise the seconds to wait (None to wait until woken up)
+        """
+        with self._lock:
+            is_next = self._waiters[0] is waiter
+            if not is_next or self.in_flight >= self.max_concurrency:
+                return None
+            delay = max(
+                self._paused_until - time.monotonic(),
+                self.requests.wait_time(1) if self.requests else 0,
+                self.tokens.wait_time(waiter.tokens) if self.tokens else 0,
+            )
+            if delay > 0:
+                return delay
+            self._waiters.pop(0)
+            if self.requests:
+                self.requests.take(1)
+            if self.tokens:
+                self.tokens.take(waiter.tokens)
+            self.in_flight += 1
+        # the next waiter might be sent as well
+        self._wake_all()
+        return 0
+
+    def _wake_all(self) -> None:
+        with self._lock:
+            waiters = list(self._waiters)
+        for waiter in waiters:
+            waiter.wake()
+
+
+_rate_limiters: Dict[Tuple[str, str], RateLimiter] = {}
+_rate_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(host: str, model: str) -> RateLimiter:
+    """
+    Get the process-wide rate limiter for a model of a provider.
+    The limits are configured per model in config/models.yaml, otherwise by the `LLM_*` env variables.
+    """
+    from app.settings import load_models_config
+
+    with _rate_limiters_lock:
+        key = (host, model)
+        if key not in _rate_limiters:
+            limits = (load_models_config().get("rate_limits") or {}).get(model) or {}
+            rpm = limits.get("rpm", os.getenv("LLM_RPM"))
+            tpm = limits.get("tpm", os.getenv("LLM_TPM"))
+            _rate_limiters[key] = RateLimiter(
+                name=f"{host}/{model}",
+                max_concurrency=int(
+                    limits.get(
+                        "max_concurrency", os.getenv("LLM_MAX_CONCURRENCY", "32")
+                    )
+                ),
+                rpm=float(rpm) if rpm else None,
+                tpm=float(tpm) if tpm else None,
+            )
+        return _rate_limiters[key]
+
+
+def _sum_limiters(attribute: str) -> Callable[[], float]:
+    return lambda: sum(
+        getattr(limiter, attribute) for limiter in list(_rate_limiters.values())
+    )
+
+
+metrics.register_gauge("rate_limit.in_flight", _sum_limiters("in_flight"))
+metrics.register_gauge("rate_limit.queued", _sum_limiters("queued"))
+
+
+def _parse_request(request: httpx.Request) -> Tuple[Optional[str], int]:
+    """
+    Get the model and the estimated number of tokens of a request to an OpenAI compatible API
+    """
+    try:
+        body = json.loads(request.content)
+    except (httpx.RequestNotRead, ValueError):
+        return None, 0
+    if not isinstance(body, dict) or "model" not in body:
+        return None, 0
+    prompt = json.dumps(body.get("messages") or body.get("input") or "")
+    # about four characters per token for the prompt plus the maximal completion
+    return str(body["model"]), len(prompt) // 4 + int(body.get("max_tokens") or 0)
+
+
+def _retry_delay(response: httpx.Response, attempt: int) -> float:
+    headers = response.headers
+    if "retry-after-ms" in headers:
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    if "retry-after" in headers:
+        retry_after = headers["retry-after"]
+        try:
+            return float(retry_after)
+        except ValueError:
+            try:
+                retry_at = parsedate_to_datetime(retry_after).timestamp()
+                return max(retry_at - time.time(), 0)
+            except (TypeError, ValueError):
+                pass
+    # exponential backoff with jitter
+    return min(2**attempt, 60) * (0.5 + random.random() / 2)
+
+
+def _get_max_retries() -> int:
+    return int(os.getenv("LLM_RATE_LIMIT_RETRIES", "5"))
+
+
+class _ReleaseOnce:
+    def __init__(self, release: Callable[[], None]) -> None:
+        self.released = False
+        self._release = release
+        self._lock = threading.Lock()
+
+    def __call__(self) -> None:
+        with self._lock:
+            if self.released:
+                return
+            self.released = True
+        self._release()
+
+
+class _ReleasingStream(httpx.AsyncByteStream, httpx.SyncByteStream):
+    # the request is in flight until its (streamed) response is read, closed or abandoned
+    def __init__(
+        self,
+        stream,
+        release: Callable[[], None],
+        loop: Optional[asyncio.AbstractEventLoop] = None,
+    ) -> None:
+        self._stream = stream
+        self._release_once = _ReleaseOnce(release)
+        # fallback if the response is dropped without being read or closed, e.g. by the SDK for an abandoned stream
+        weakref.finalize(self, _release_abandoned, self._release_once, loop)
+
+    async def __aiter__(self):
+        try:
+            async for chunk in self._stream:
+                yield chunk
+        finally:
+            # also on GeneratorExit and cancellation of an abandoned stream
+            self._release_once()
+
+    async def aclose(self) -> None:
+        try:
+            await self._stream.aclose()
+        finally:
+            self._release_once()
+
+    def __iter__(self):
+        try:
+            yield from self._stream
+        finally:
+            self._release_once()
+
+    def close(self) -> None:
+        try:
+            self._stream.close()
+        finally:
+            self._release_once()
+
+
+# releases of abandoned streams, queued by their finalizers
+_abandoned_releases: "queue.SimpleQueue[_ReleaseOnce]" = queue.SimpleQueue()
+
+
+def _release_abandoned(
+    release_once: _ReleaseOnce, loop: Optional[asyncio.AbstractEventLoop]
+) -> None:
+    if release_once.released:
+        return
+    # finalizers can run during garbage collection while a lock of the limiter or the metrics is held by the same thread,
+    # so the slot is only queued here and released by the event loop or the next request to a limiter
+    _abandoned_releases.put(release_once)
+    if loop is not None:
+        try:
+            loop.call_soon_threadsafe(release_abandoned_streams)
+        except RuntimeError:
+            # the loop is closed
+            pass
+
+
+def release_abandoned_streams() -> None:
+    """
+    Release the slots of the responses that were dropped without being read or closed
+    """
+    while True:
+        try:
+            release_once = _abandoned_releases.get_nowait()
+        except queue.Empty:
+            return
+        if not release_once.released:
+            metrics.incr("rate_limit.abandoned_streams")
+            release_once()
+
+
+class RateLimitedTransport(httpx.AsyncBaseTransport):
+    """
+    Transport scheduling the requests to models by their rate limiter.
+    Rate limited requests (429) pause the limiter for the time given by the provider and are retried.
+    """
+
+    def __init__(self, transport: httpx.AsyncBaseTransport) -> None:
+        self._transport = transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        model, tokens = _parse_request(request)
+        if model is None:
+            return await self._transport.handle_async_request(request)
+        limiter = get_rate_limiter(request.url.host, model)
+        max_retries = _get_max_retries()
+        attempt = 0
+        while True:
+            await limiter.acquire(_priority.get(), tokens)
+            try:
+                response = await self._transport.handle_async_request(request)
+            except BaseException:
+                limiter.release()
+                raise
+            limiter.update(response.headers)
+            if response.status_code != 429 or attempt >= max_retries:
+                response.stream = _ReleasingStream(
+                    response.stream, limiter.release, asyncio.get_running_loop()
+                )
+                return response
+            await response.aclose()
+            limiter.release()
+            _on_rate_limited(limiter, response, attempt)
+            attempt += 1
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
+
+
+class RateLimitedSyncTransport(httpx.BaseTransport):
+    """
+    Synchronous variant of `RateLimitedTransport`, e.g. for ingestion
+    """
+
+    def __init__(self, transport: httpx.BaseTransport) -> None:
+        self._transport = transport
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        model, tokens = _parse_request(request)
+        if model is None:
+            return self._transport.handle_request(request)
+        limiter = get_rate_limiter(request.url.host, model)
+        max_retries = _get_max_retries()
+        attempt = 0
+        while True:
+            limiter.acquire_sync(_priority.get(), tokens)
+            try:
+                response = self._transport.handle_request(request)
+            except BaseException:
+                limiter.release()
+                raise
+            limiter.update(response.headers)
+            if response.status_code != 429 or attempt >= max_retries:
+                response.stream = _ReleasingStream(response.stream, limiter.release)
+                return response
+            response.close()
+            limiter.release()
+            _on_rate_limited(limiter, response, attempt)
+            attempt += 1
+
+    def close(self) -> None:
+        self._transport.close()
+
+
+def _on_rate_limited(
+    limiter: RateLimiter, response: httpx.Response, attempt: int
+) -> None:
+    delay = _retry_delay(response, attempt)
+    logger.warning(
+        f"Rate limited by {limiter.name}, pausing requests for {delay:.1f}s"
+    )
+    metrics.incr("rate_limit.retries")
+    # pause all requests to the model instead of letting each of them run into the limit
+    limiter.pause(delay)
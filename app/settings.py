@@ -1,7 +1,87 @@
+import logging
 import os
-from typing import Dict
+from typing import Dict, List, Optional
 
+import yaml
+from llama_index.core.llms import LLM, ChatMessage, MessageRole
 from llama_index.core.settings import Settings
+from pydantic import BaseModel, Field
+
+from app.http_client import get_openai_http_clients
+
+logger = logging.getLogger("uvicorn")
+
+MODELS_CONFIG_FILE = "config/models.yaml"
+
+# the agents that can use their own model, see config/models.yaml
+AGENT_NAMES = ("planner", "executor", "researcher", "writer", "reviewer")
+
+GROQ_MODELS: Dict[str, str] = {
+    "llama3-8b": "llama3-8b-8192",
+    "llama3-70b": "llama3-70b-8192",
+    "mixtral-8x7b": "mixtral-8x7b-32768",
+}
+
+ANTHROPIC_MODELS: Dict[str, str] = {
+    "claude-3-opus": "claude-3-opus-20240229",
+    "claude-3-sonnet": "claude-3-sonnet-20240229",
+    "claude-3-haiku": "claude-3-haiku-20240307",
+    "claude-2.1": "claude-2.1",
+    "claude-instant-1.2": "claude-instant-1.2",
+}
+
+# prompt caching of the Anthropic API, see `add_prompt_cache_breakpoint`
+ANTHROPIC_PROMPT_CACHING_HEADERS: Dict[str, str] = {
+    "anthropic-beta": "prompt-caching-2024-07-31"
+}
+
+
+def use_anthropic_prompt_caching(model: str) -> bool:
+    # the claude 2 models don't support prompt caching
+    return os.getenv(
+        "ANTHROPIC_PROMPT_CACHING", "true"
+    ).lower() == "true" and not model.startswith(("claude-2", "claude-instant"))
+
+
+def get_anthropic_config(model: str) -> Dict:
+    model = ANTHROPIC_MODELS.get(model, model)
+    config: Dict = {"model": model}
+    if use_anthropic_prompt_caching(model):
+        config["default_headers"] = ANTHROPIC_PROMPT_CACHING_HEADERS
+    return config
+
+
+def add_prompt_cache_breakpoint(
+    llm: LLM, messages: List[ChatMessage]
+) -> List[ChatMessage]:
+    """
+    Mark the end of the prompt prefix to cache for providers that only cache marked prefixes (Anthropic),
+    OpenAI compatible providers cache the prefixes automatically.
+    The last user or assistant message is marked, so the tools, the system prompt and the history up to it are cached
+    and the next LLM call of the agent, e.g. after a tool call, reads them from the cache.
+    """
+    if llm.class_name() != "Anthropic_LLM" or not use_anthropic_prompt_caching(
+        llm.metadata.model_name
+    ):
+        return messages
+    for index in range(len(messages) - 1, -1, -1):
+        message = messages[index]
+        # the system prompt and tool results can't be marked, empty messages (only tool calls) aren't sent as text
+        if (
+            message.role in (MessageRole.USER, MessageRole.ASSISTANT)
+            and isinstance(message.content, str)
+            and message.content
+        ):
+            marked = message.model_copy(
+                update={
+                    "additional_kwargs": {
+                        **message.additional_kwargs,
+                        "cache_control": {"type": "ephemeral"},
+                    }
+                }
+            )
+            return [*messages[:index], marked, *messages[index + 1 :]]
+    return messages
 
 
 def init_settings():
@@ -31,22 +111,163 @@ def init_settings():
     Settings.chunk_size = int(os.getenv("CHUNK_SIZE", "1024"))
     Settings.chunk_overlap = int(os.getenv("CHUNK_OVERLAP", "20"))
 
+    init_model_routing()
+    init_embedding_cache()
+
+
+class ModelConfig(BaseModel):
+    """
+    Model of an agent, see config/models.yaml
+    """
+
+    provider: str = Field(default_factory=lambda: os.getenv("MODEL_PROVIDER"))
+    model: str
+    temperature: Optional[float] = None
+    max_tokens: Optional[int] = None
+    # name of the deployment, only used by Azure OpenAI (defaults to the model name)
+    deployment: Optional[str] = None
+
+
+_agent_llms: Dict[str, LLM] = {}
+_low_budget_llms: Dict[str, Optional[LLM]] = {}
+
+
+def load_models_config() -> Dict:
+    if not os.path.exists(MODELS_CONFIG_FILE):
+        return {}
+    with open(MODELS_CONFIG_FILE) as f:
+        return yaml.safe_load(f) or {}
+
+
+def init_model_routing(routing: Optional[str] = None):
+    """
+    Create the models of the agents for a routing of config/models.yaml (selected by `MODEL_ROUTING`).
+    Agents without a model in the routing use `Settings.llm`.
+    """
+    routing = routing or os.getenv("MODEL_ROUTING", "default")
+    routings = load_models_config().get("routings") or {}
+    if routing not in routings and routing != "default":
+        raise ValueError(
+            f"Invalid model routing: {routing}. Choose one of: {', '.join(routings)}"
+        )
+    _agent_llms.clear()
+    for name, config in (routings.get(routing) or {}).items():
+        if name not in AGENT_NAMES:
+            logger.warning(f"Model configured for unknown agent: {name}")
+        model_config = ModelConfig(**config)
+        _agent_llms[name] = create_llm(model_config)
+        logger.info(
+            f"Agent {name} uses model {model_config.model} of {model_config.provider}"
+        )
+
+
+def get_agent_llm(name: str) -> LLM:
+    """
+    Get the model of an agent, `Settings.llm` if the agent has no model of its own.
+    """
+    return _agent_llms.get(name, Settings.llm)
+
+
+def get_low_budget_llm(name: str) -> Optional[LLM]:
+    """
+    Get the cheaper model an agent switches to if the deadline of its run is close, None if not configured
+    """
+    if name not in _low_budget_llms:
+        config = (load_models_config().get("low_budget_models") or {}).get(name)
+        _low_budget_llms[name] = (
+            create_llm(ModelConfig(**config)) if config is not None else None
+        )
+    return _low_budget_llms[name]
+
+
+def create_llm(config: ModelConfig) -> LLM:
+    kwargs = {
+        key: value
+        for key, value in {
+            "temperature": config.temperature,
+            "max_tokens": config.max_tokens,
+        }.items()
+        if value is not None
+    }
+    match config.provider:
+        case "openai":
+            from llama_index.llms.openai import OpenAI
+
+            return OpenAI(model=config.model, **get_openai_http_clients(), **kwargs)
+        case "azure-openai":
+            from llama_index.llms.azure_openai import AzureOpenAI
+
+            return AzureOpenAI(
+                model=config.model,
+                deployment_name=config.deployment or config.model,
+                **get_azure_openai_config(),
+                **kwargs,
+            )
+        case "groq":
+            from llama_index.llms.groq import Groq
+
+            return Groq(
+                model=GROQ_MODELS.get(config.model, config.model),
+                **get_openai_http_clients(),
+                **kwargs,
+            )
+        case "ollama":
+            from llama_index.llms.ollama.base import Ollama
+
+            return Ollama(model=config.model, **get_ollama_config(), **kwargs)
+        case "anthropic":
+            from llama_index.llms.anthropic import Anthropic
+
+            return Anthropic(**get_anthropic_config(config.model), **kwargs)
+        case "gemini":
+            from llama_index.llms.gemini import Gemini
+
+            return Gemini(model=f"models/{config.model}", **kwargs)
+        case "mistral":
+            from llama_index.llms.mistralai import MistralAI
+
+            return MistralAI(model=config.model, **kwargs)
+        case _:
+            raise ValueError(f"Invalid model provider for an agent: {config.provider}")
+
+
+def init_embedding_cache():
+    """
+    Cache the embeddings of the configured provider, so repeated queries don't call the provider again.
+    """
+    from app.cache import CachedEmbedding
+
+    max_size = int(os.getenv("EMBEDDING_CACHE_SIZE", "1024"))
+    if max_size <= 0 or isinstance(Settings.embed_model, CachedEmbedding):
+        return
+    Settings.embed_model = CachedEmbedding(
+        embed_model=Settings.embed_model,
+        max_size=max_size,
+        cache_dir=os.getenv("EMBEDDING_CACHE_DIR"),
+    )
+
+
+def get_ollama_config() -> Dict:
+    from llama_index.llms.ollama.base import DEFAULT_REQUEST_TIMEOUT
+
+    return {
+        "base_url": os.getenv("OLLAMA_BASE_URL") or "http://127.0.0.1:11434",
+        "request_timeout": float(
+            os.getenv("OLLAMA_REQUEST_TIMEOUT", DEFAULT_REQUEST_TIMEOUT)
+        ),
+    }
+
 
 def init_ollama():
     from llama_index.embeddings.ollama import OllamaEmbedding
-    from llama_index.llms.ollama.base import DEFAULT_REQUEST_TIMEOUT, Ollama
+    from llama_index.llms.ollama.base import Ollama
 
-    base_url = os.getenv("OLLAMA_BASE_URL") or "http://127.0.0.1:11434"
-    request_timeout = float(
-        os.getenv("OLLAMA_REQUEST_TIMEOUT", DEFAULT_REQUEST_TIMEOUT)
-    )
+    ollama_config = get_ollama_config()
     Settings.embed_model = OllamaEmbedding(
-        base_url=base_url,
+        base_url=ollama_config["base_url"],
         model_name=os.getenv("EMBEDDING_MODEL"),
     )
-    Settings.llm = Ollama(
-        base_url=base_url, model=os.getenv("MODEL"), request_timeout=request_timeout
-    )
+    Settings.llm = Ollama(model=os.getenv("MODEL"), **ollama_config)
 
 
 def init_openai():
@@ -60,14 +281,24 @@ def init_openai():
         "temperature": float(os.getenv("LLM_TEMPERATURE", DEFAULT_TEMPERATURE)),
         "max_tokens": int(max_tokens) if max_tokens is not None else None,
     }
-    Settings.llm = OpenAI(**config)
+    Settings.llm = OpenAI(**config, **get_openai_http_clients())
 
     dimensions = os.getenv("EMBEDDING_DIM")
     config = {
         "model": os.getenv("EMBEDDING_MODEL"),
         "dimensions": int(dimensions) if dimensions is not None else None,
     }
-    Settings.embed_model = OpenAIEmbedding(**config)
+    Settings.embed_model = OpenAIEmbedding(**config, **get_openai_http_clients())
+
+
+def get_azure_openai_config() -> Dict:
+    return {
+        "api_key": os.environ["AZURE_OPENAI_API_KEY"],
+        "azure_endpoint": os.environ["AZURE_OPENAI_ENDPOINT"],
+        "api_version": os.getenv("AZURE_OPENAI_API_VERSION")
+        or os.getenv("OPENAI_API_VERSION"),
+        **get_openai_http_clients(),
+    }
 
 
 def init_azure_openai():
@@ -81,12 +312,7 @@ def init_azure_openai():
     temperature = os.getenv("LLM_TEMPERATURE", DEFAULT_TEMPERATURE)
     dimensions = os.getenv("EMBEDDING_DIM")
 
-    azure_config = {
-        "api_key": os.environ["AZURE_OPENAI_API_KEY"],
-        "azure_endpoint": os.environ["AZURE_OPENAI_ENDPOINT"],
-        "api_version": os.getenv("AZURE_OPENAI_API_VERSION")
-        or os.getenv("OPENAI_API_VERSION"),
-    }
+    azure_config = get_azure_openai_config()
 
     Settings.llm = AzureOpenAI(
         model=os.getenv("MODEL"),
@@ -126,13 +352,9 @@ def init_fastembed():
 def init_groq():
     from llama_index.llms.groq import Groq
 
-    model_map: Dict[str, str] = {
-        "llama3-8b": "llama3-8b-8192",
-        "llama3-70b": "llama3-70b-8192",
-        "mixtral-8x7b": "mixtral-8x7b-32768",
-    }
-
-    Settings.llm = Groq(model=model_map[os.getenv("MODEL")])
+    Settings.llm = Groq(
+        model=GROQ_MODELS[os.getenv("MODEL")], **get_openai_http_clients()
+    )
     # Groq does not provide embeddings, so we use FastEmbed instead
     init_fastembed()
 
@@ -140,15 +362,7 @@ def init_groq():
 def init_anthropic():
     from llama_index.llms.anthropic import Anthropic
 
-    model_map: Dict[str, str] = {
-        "claude-3-opus": "claude-3-opus-20240229",
-        "claude-3-sonnet": "claude-3-sonnet-20240229",
-        "claude-3-haiku": "claude-3-haiku-20240307",
-        "claude-2.1": "claude-2.1",
-        "claude-instant-1.2": "claude-instant-1.2",
-    }
-
-    Settings.llm = Anthropic(model=model_map[os.getenv("MODEL")])
+    Settings.llm = Anthropic(**get_anthropic_config(os.getenv("MODEL")))
     # Anthropic does not provide embeddings, so we use FastEmbed instead
     init_fastembed()
 
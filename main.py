@@ -2,28 +2,54 @@
 import asyncio
 import os
 import textwrap
+import uuid
 from typing import AsyncGenerator
 from dotenv import load_dotenv
 
+from app.agents.single import AgentRunEvent, AgentRunResult
 from app.config import DATA_DIR
 from app.examples.factory import create_agent
 
 load_dotenv()
 
 import logging
+from contextlib import asynccontextmanager
 
 import uvicorn
 from app.api.routers.chat import chat_router
 from app.api.routers.chat_config import config_router
+from app.api.routers.metrics import metrics_router
 from app.api.routers.upload import file_upload_router
+from app.api.services.starters import get_starter_answers
+from app.budget import RunBudget
 from app.observability import init_observability
+from app.rate_limit import Priority, llm_priority
 from app.settings import init_settings
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import RedirectResponse
 from fastapi.staticfiles import StaticFiles
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # precompute the answers of the conversation starters and recompute them once the index changes
+    starter_answers = get_starter_answers()
+    warm_up = (
+        asyncio.create_task(
+            starter_answers.keep_warm(
+                float(os.getenv("STARTER_ANSWERS_REFRESH_INTERVAL", "60"))
+            )
+        )
+        if starter_answers is not None
+        else None
+    )
+    yield
+    if warm_up is not None:
+        warm_up.cancel()
+
+
+app = FastAPI(lifespan=lifespan)
 
 init_settings()
 init_observability()
@@ -66,6 +92,7 @@ mount_static_files("output", "/api/files/output")
 app.include_router(chat_router, prefix="/api/chat")
 app.include_router(config_router, prefix="/api/chat/config")
 app.include_router(file_upload_router, prefix="/api/chat/upload")
+app.include_router(metrics_router, prefix="/api/metrics")
 
 
 def run_api():
@@ -82,20 +109,38 @@ async def main():
         print(f"[{prefix}] {truncated}")
 
     agent = create_agent()
-
-    task = asyncio.create_task(
-        agent.run(
-            input="Write a blog post about physical standards for letters",
-            streaming=True,
+    budget = RunBudget.from_env()
+    # set RUN_ID to the id of an interrupted run to resume it, its completed steps are skipped
+    run_id = os.getenv("RUN_ID") or str(uuid.uuid4())
+    info("run", run_id)
+
+    # not interactive, so requests of chats served by the same process go first
+    with llm_priority(Priority.BATCH):
+        task = asyncio.create_task(
+            agent.run(
+                input="Write a blog post about physical standards for letters",
+                streaming=True,
+                budget=budget,
+                run_id=run_id,
+            )
         )
-    )
 
     async for ev in agent.stream_events():
-        info(ev.name, ev.msg)
+        if isinstance(ev, AgentRunEvent):
+            info(ev.name, ev.msg)
 
-    ret: AsyncGenerator = await task
-    async for token in ret:
-        print(token.delta, end="", flush=True)
+    ret: AsyncGenerator | AgentRunResult = await task
+    if isinstance(ret, AgentRunResult):
+        # the final step was completed by the resumed run
+        print(ret.response.message.content, end="", flush=True)
+    else:
+        async for token in ret:
+            print(token.delta, end="", flush=True)
+    usage = budget.usage
+    print(
+        f"\n\n[usage] {usage.total_tokens} tokens ({usage.prompt_tokens} prompt, {usage.completion_tokens} completion) "
+        f"in {usage.llm_calls} LLM calls, {usage.cost:.4f} USD"
+    )
 
     # ret: AgentRunResult = await task
     # print(ret.response.message.content)
@@ -0,0 +1,138 @@
+import asyncio
+
+import pytest
+from llama_index.core.workflow import StartEvent, StopEvent, step
+
+from app import budget as budget_module
+from app.budget import (
+    BudgetedWorkflow,
+    BudgetExceededError,
+    RunBudget,
+    check_budget,
+    get_run_budget,
+    is_token_budget_low,
+)
+
+
+@pytest.fixture(autouse=True)
+def costs(monkeypatch):
+    monkeypatch.setattr(
+        budget_module,
+        "_costs",
+        [
+            ("gpt-4o-mini", {"input": 0.15, "output": 0.6}),
+            ("gpt-4o", {"input": 2.5, "output": 10}),
+        ],
+    )
+
+
+def test_run_budget_without_limits_is_never_used_up():
+    budget = RunBudget()
+    budget.record(1_000_000, 1_000_000, "gpt-4o")
+    assert budget.used() == 0
+    assert not budget.is_low()
+    budget.check()
+
+
+def test_run_budget_token_limit():
+    budget = RunBudget(max_tokens=1000, soft_limit=0.8)
+    budget.record(700, 50)
+    assert budget.usage.total_tokens == 750
+    assert budget.usage.llm_calls == 1
+    assert not budget.is_low()
+    budget.check()
+
+    budget.record(40, 10)
+    assert budget.is_low()
+    budget.check()
+
+    budget.record(200, 0)
+    with pytest.raises(BudgetExceededError):
+        budget.check()
+
+
+def test_run_budget_cost_limit_uses_the_price_of_the_model():
+    budget = RunBudget(max_cost=1.0)
+    # versioned model names get the price of the longest matching model
+    budget.record(100_000, 10_000, "gpt-4o-mini-2024-07-18")
+    assert budget.usage.cost == pytest.approx(0.021)
+    budget.record(100_000, 10_000, "gpt-4o-2024-08-06")
+    assert budget.usage.cost == pytest.approx(0.371)
+    # models without a price don't count
+    budget.record(1_000_000, 0, "unknown")
+    assert budget.used() == pytest.approx(0.371)
+
+    budget.record(200_000, 30_000, "gpt-4o")
+    with pytest.raises(BudgetExceededError):
+        budget.check()
+
+
+def test_run_budget_from_env(monkeypatch):
+    monkeypatch.setenv("RUN_TOKEN_BUDGET", "5000")
+    monkeypatch.setenv("RUN_COST_BUDGET", "")
+    monkeypatch.setenv("RUN_BUDGET_SOFT_LIMIT", "0.5")
+    budget = RunBudget.from_env()
+    assert budget.max_tokens == 5000
+    assert budget.max_cost is None
+    assert budget.soft_limit == 0.5
+
+
+def test_run_budget_counts_the_delegations_per_agent():
+    budget = RunBudget()
+    assert budget.count_delegation("researcher") == 1
+    assert budget.count_delegation("researcher") == 2
+    assert budget.count_delegation("writer") == 1
+
+
+@pytest.mark.parametrize(
+    "raw, additional_kwargs, expected",
+    [
+        ({}, {"prompt_tokens": 10, "completion_tokens": 5}, (10, 5)),
+        ({"usage": {"prompt_tokens": 7, "completion_tokens": 3}}, {}, (7, 3)),
+        ({"usage": {"prompt_tokens": 7}}, {}, (7, 0)),
+        (None, {}, (None, None)),
+    ],
+)
+def test_token_counts_reported_by_the_provider(raw, additional_kwargs, expected):
+    assert budget_module._get_token_counts(raw, additional_kwargs) == expected
+
+
+class RecordingWorkflow(BudgetedWorkflow):
+    def __init__(self, inner=None, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.inner = inner
+
+    @step()
+    async def record(self, ev: StartEvent) -> StopEvent:
+        budget = get_run_budget()
+        budget.record(ev.get("tokens"), 0)
+        if self.inner is not None:
+            await self.inner.run(tokens=ev.get("tokens"))
+        return StopEvent(result=(budget, is_token_budget_low()))
+
+
+def test_budgeted_workflow_shares_the_budget_with_nested_runs(monkeypatch):
+    monkeypatch.setenv("RUN_TOKEN_BUDGET", "100")
+    monkeypatch.setenv("RUN_BUDGET_SOFT_LIMIT", "0.5")
+    workflow = RecordingWorkflow(inner=RecordingWorkflow(timeout=None), timeout=None)
+
+    budget, is_low = asyncio.run(workflow.run(tokens=30))
+    assert budget.usage.total_tokens == 60
+    assert budget.usage.llm_calls == 2
+    assert is_low
+    # outside of a run there is no budget
+    assert get_run_budget() is None
+    assert not is_token_budget_low()
+    check_budget()
+
+
+def test_budgeted_workflow_runs_use_their_own_budgets():
+    workflow = RecordingWorkflow(timeout=None)
+    passed = RunBudget(max_tokens=1000)
+
+    first, _ = asyncio.run(workflow.run(tokens=10, budget=passed))
+    second, _ = asyncio.run(workflow.run(tokens=10))
+    assert first is passed
+    assert second is not passed
+    assert passed.usage.total_tokens == 10
+    assert second.usage.total_tokens == 10
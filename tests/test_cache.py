@@ -0,0 +1,107 @@
+import pytest
+
+from app import cache as cache_module
+from app.cache import SemanticCache, TieredCache, hash_key
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache_module.time, "monotonic", clock)
+    monkeypatch.setattr(cache_module.time, "time", clock)
+    return clock
+
+
+def test_semantic_cache_hits_similar_embeddings():
+    cache = SemanticCache(name="test", similarity_threshold=0.9)
+    cache.lookup([1, 0], version="v1")
+    cache.store([1, 0], "answer", version="v1")
+
+    value, similarity = cache.lookup([0.99, 0.05], version="v1")
+    assert value == "answer"
+    assert similarity == pytest.approx(0.9987, abs=1e-3)
+    assert cache.lookup([0, 1], version="v1") is None
+
+
+def test_semantic_cache_returns_the_most_similar_entry():
+    cache = SemanticCache(name="test", similarity_threshold=0.5)
+    cache.lookup([1, 0])
+    cache.store([1, 0], "x")
+    cache.store([0.6, 0.8], "diagonal")
+
+    assert cache.lookup([0.5, 0.8])[0] == "diagonal"
+    assert cache.lookup([0.9, 0.1])[0] == "x"
+
+
+def test_semantic_cache_expires_entries(clock):
+    cache = SemanticCache(name="test", ttl=60)
+    cache.lookup([1, 0])
+    cache.store([1, 0], "answer")
+
+    clock.now += 59
+    assert cache.lookup([1, 0]) is not None
+    clock.now += 2
+    assert cache.lookup([1, 0]) is None
+    assert len(cache) == 0
+
+
+def test_semantic_cache_is_cleared_on_a_new_version():
+    cache = SemanticCache(name="test")
+    cache.lookup([1, 0], version="v1")
+    cache.store([1, 0], "answer", version="v1")
+
+    assert cache.lookup([1, 0], version="v2") is None
+    assert len(cache) == 0
+    # an answer computed for the outdated version isn't stored
+    cache.store([1, 0], "outdated", version="v1")
+    assert cache.lookup([1, 0], version="v2") is None
+
+
+def test_semantic_cache_evicts_the_least_recently_used_entry():
+    cache = SemanticCache(name="test", max_size=2, similarity_threshold=0.99)
+    cache.lookup([1, 0, 0])
+    cache.store([1, 0, 0], "a")
+    cache.store([0, 1, 0], "b")
+    assert cache.lookup([1, 0, 0])[0] == "a"
+    cache.store([0, 0, 1], "c")
+
+    assert cache.lookup([0, 1, 0]) is None
+    assert cache.lookup([1, 0, 0])[0] == "a"
+    assert cache.lookup([0, 0, 1])[0] == "c"
+
+
+def test_semantic_cache_with_size_zero_is_disabled():
+    cache = SemanticCache(name="test", max_size=0)
+    cache.store([1, 0], "answer")
+    assert not cache.enabled
+    assert cache.lookup([1, 0]) is None
+
+
+def test_tiered_cache_reads_from_disk_after_a_restart(tmp_path):
+    path = str(tmp_path / "cache.db")
+    TieredCache(name="test", path=path).set("key", {"value": [1, 2]})
+
+    restarted = TieredCache(name="test", path=path)
+    assert restarted.get("key") == {"value": [1, 2]}
+    assert restarted.get("missing") is None
+
+
+def test_tiered_cache_expires_entries_on_disk(tmp_path, clock):
+    path = str(tmp_path / "cache.db")
+    TieredCache(name="test", ttl=60, path=path).set("key", "value")
+
+    clock.now += 61
+    assert TieredCache(name="test", ttl=60, path=path).get("key") is None
+
+
+def test_hash_key_is_stable_and_order_sensitive():
+    assert hash_key("a", {"x": 1, "y": 2}) == hash_key("a", {"y": 2, "x": 1})
+    assert hash_key("a", "b") != hash_key("b", "a")
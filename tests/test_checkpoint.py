@@ -0,0 +1,121 @@
+import asyncio
+from typing import List
+
+import pytest
+from llama_index.core.workflow import StartEvent, StopEvent, step
+
+from app import checkpoint as checkpoint_module
+from app.checkpoint import (
+    CheckpointStore,
+    CheckpointWorkflow,
+    checkpointed,
+    get_checkpoint_store,
+)
+
+
+@pytest.fixture
+def store(monkeypatch):
+    store = CheckpointStore()
+    monkeypatch.setenv("CHECKPOINTS", "true")
+    monkeypatch.setattr(checkpoint_module, "_checkpoint_store", store)
+    return store
+
+
+class Interrupted(Exception):
+    pass
+
+
+class StepsWorkflow(CheckpointWorkflow):
+    """
+    Runs three steps, failing at the step given by `fail_at`
+    """
+
+    def __init__(self, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.computed: List[str] = []
+
+    @step()
+    async def run_steps(self, ev: StartEvent) -> StopEvent:
+        results = []
+        for name in ("research", "draft", "review"):
+
+            async def compute(name=name):
+                if name == ev.get("fail_at"):
+                    raise Interrupted(name)
+                self.computed.append(name)
+                return {"output": f"{name} {len(self.computed)}"}
+
+            results.append(
+                await checkpointed(
+                    name,
+                    compute,
+                    dump=lambda value: value["output"],
+                    load=lambda stored: {"output": stored},
+                )
+            )
+        return StopEvent(result=[result["output"] for result in results])
+
+
+def test_resumed_runs_skip_the_completed_steps(store):
+    workflow = StepsWorkflow(timeout=None)
+    with pytest.raises(Interrupted):
+        asyncio.run(workflow.run(run_id="run", fail_at="review"))
+    assert workflow.computed == ["research", "draft"]
+
+    result = asyncio.run(workflow.run(run_id="run"))
+    assert workflow.computed == ["research", "draft", "review"]
+    assert result == ["research 1", "draft 2", "review 3"]
+    assert store.get("run", "review") == {"value": "review 3"}
+
+
+def test_runs_are_checkpointed_by_their_id(store):
+    workflow = StepsWorkflow(timeout=None)
+    asyncio.run(workflow.run(run_id="first"))
+    asyncio.run(workflow.run(run_id="second"))
+    assert workflow.computed == ["research", "draft", "review"] * 2
+
+
+def test_runs_without_an_id_are_not_checkpointed(store):
+    workflow = StepsWorkflow(timeout=None)
+    asyncio.run(workflow.run())
+    asyncio.run(workflow.run())
+    assert workflow.computed == ["research", "draft", "review"] * 2
+
+
+def test_checkpoints_are_opt_in(monkeypatch):
+    monkeypatch.delenv("CHECKPOINTS", raising=False)
+    assert get_checkpoint_store() is None
+
+    workflow = StepsWorkflow(timeout=None)
+    asyncio.run(workflow.run(run_id="run"))
+    asyncio.run(workflow.run(run_id="run"))
+    assert workflow.computed == ["research", "draft", "review"] * 2
+
+
+def test_streamed_steps_are_not_checkpointed(store):
+    async def stream():
+        yield "token"
+
+    async def compute():
+        return stream()
+
+    async def main():
+        checkpoint = checkpoint_module.RunCheckpoint(store, "run")
+        token = checkpoint_module._run_checkpoint.set(checkpoint)
+        try:
+            result = await checkpointed("answer", compute)
+        finally:
+            checkpoint_module._run_checkpoint.reset(token)
+        return [chunk async for chunk in result]
+
+    # a streamed result is consumed by the caller, so the step is not done yet
+    assert asyncio.run(main()) == ["token"]
+    assert store.get("run", "answer") is None
+
+
+def test_checkpoints_are_kept_across_restarts(tmp_path):
+    store = CheckpointStore(cache_dir=str(tmp_path))
+    store.set("run", "research", {"value": "facts"})
+    assert CheckpointStore(cache_dir=str(tmp_path)).get("run", "research") == {
+        "value": "facts"
+    }
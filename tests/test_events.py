@@ -0,0 +1,150 @@
+import asyncio
+from typing import List
+
+from llama_index.core.workflow import Context, Event, StartEvent, StopEvent, step
+
+from app.agents.single import AgentRunEvent
+from app.events import EventSink, EventSinkWorkflow, wait_for_event_consumer
+from app.observability import metrics
+
+
+class ResultEvent(Event):
+    name: str
+
+
+def progress(name: str, msg: str) -> AgentRunEvent:
+    return AgentRunEvent(name=name, msg=msg)
+
+
+async def collect(sink: EventSink) -> List[Event]:
+    return [event async for event in sink.stream()]
+
+
+def test_publishes_the_events_in_order():
+    sink = EventSink(max_size=10)
+    events = [
+        progress("writer", "start"),
+        ResultEvent(name="writer"),
+        None,
+        StopEvent(),
+    ]
+    for event in events:
+        sink.publish(event)
+    sink.close()
+
+    assert asyncio.run(collect(sink)) == events[:2]
+
+
+def test_coalesces_progress_events_to_the_latest_per_agent():
+    sink = EventSink(max_size=2)
+    coalesced = metrics.get("event_sink.coalesced")
+    for index in range(5):
+        sink.publish(progress("writer", f"writer {index}"))
+        sink.publish(progress("reviewer", f"reviewer {index}"))
+    sink.close()
+
+    assert [event.msg for event in asyncio.run(collect(sink))] == [
+        "writer 0",
+        "reviewer 0",
+        "writer 4",
+        "reviewer 4",
+    ]
+    assert metrics.get("event_sink.coalesced") == coalesced + 8
+
+
+def test_drops_other_events_without_a_consumer():
+    sink = EventSink(max_size=2)
+    dropped = metrics.get("event_sink.dropped")
+    for index in range(3):
+        sink.publish(ResultEvent(name=f"agent {index}"))
+    sink.close()
+
+    assert [event.name for event in asyncio.run(collect(sink))] == [
+        "agent 0",
+        "agent 1",
+    ]
+    assert metrics.get("event_sink.dropped") == dropped + 1
+
+
+def test_publishers_wait_for_the_consumer():
+    async def main():
+        sink = EventSink(max_size=2)
+        stream = sink.stream()
+        sink.publish(ResultEvent(name="first"))
+        assert (await stream.__anext__()).name == "first"
+
+        # with a consumer, events exceeding the bound are kept
+        for index in range(3):
+            sink.publish(ResultEvent(name=f"agent {index}"))
+        waiting = asyncio.create_task(sink.wait_for_space())
+        await asyncio.sleep(0.01)
+        assert not waiting.done()
+
+        names = [(await stream.__anext__()).name for _ in range(2)]
+        await asyncio.wait_for(waiting, 1)
+        assert names == ["agent 0", "agent 1"]
+        assert (await stream.__anext__()).name == "agent 2"
+
+    asyncio.run(main())
+
+
+def test_publishers_dont_wait_without_a_consumer():
+    async def main():
+        sink = EventSink(max_size=1)
+        sink.publish(ResultEvent(name="first"))
+        sink.publish(ResultEvent(name="second"))
+        await asyncio.wait_for(sink.wait_for_space(), 1)
+
+    asyncio.run(main())
+
+
+class InnerWorkflow(EventSinkWorkflow):
+    @step()
+    async def work(self, ctx: Context, ev: StartEvent) -> StopEvent:
+        for index in range(3):
+            await wait_for_event_consumer()
+            ctx.write_event_to_stream(progress("inner", f"inner {index}"))
+        ctx.write_event_to_stream(ResultEvent(name="inner"))
+        return StopEvent(result="inner result")
+
+
+class OuterWorkflow(EventSinkWorkflow):
+    def __init__(self, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.inner = InnerWorkflow(timeout=None)
+
+    @step()
+    async def work(self, ctx: Context, ev: StartEvent) -> StopEvent:
+        ctx.write_event_to_stream(progress("outer", "start"))
+        result = await self.inner.run()
+        ctx.write_event_to_stream(progress("outer", "done"))
+        return StopEvent(result=result)
+
+
+def test_streams_the_events_of_nested_runs():
+    async def main():
+        workflow = OuterWorkflow(timeout=None)
+        task = asyncio.create_task(workflow.run())
+        events = [event async for event in workflow.stream_events()]
+        return await task, events
+
+    result, events = asyncio.run(main())
+    assert result == "inner result"
+    assert [
+        (event.name, event.msg if isinstance(event, AgentRunEvent) else None)
+        for event in events
+    ] == [
+        ("outer", "start"),
+        ("inner", "inner 0"),
+        ("inner", "inner 1"),
+        ("inner", "inner 2"),
+        ("inner", None),
+        ("outer", "done"),
+    ]
+
+
+def test_nested_runs_publish_into_the_sink_of_the_outer_run():
+    workflow = OuterWorkflow(timeout=None)
+    assert asyncio.run(workflow.run()) == "inner result"
+    assert workflow.inner._event_sink is None
+    assert workflow._event_sink is not None
@@ -0,0 +1,51 @@
+import inspect
+
+import httpx
+import pytest
+
+from app.http_client import PerHostAsyncTransport, PerHostTransport
+
+
+def test_per_host_transport_has_a_pool_per_host():
+    transport = PerHostTransport(httpx.Limits(max_connections=2), http2=False)
+    openai = transport.get_transport(httpx.URL("https://api.openai.com/v1/chat"))
+    assert (
+        transport.get_transport(httpx.URL("https://api.openai.com/v1/embeddings"))
+        is openai
+    )
+    assert (
+        transport.get_transport(httpx.URL("https://api.groq.com/v1/chat"))
+        is not openai
+    )
+    assert (
+        transport.get_transport(httpx.URL("http://api.openai.com/v1/chat"))
+        is not openai
+    )
+    assert len(transport.transports) == 3
+    transport.close()
+
+
+def test_per_host_async_transport_has_a_pool_per_host():
+    transport = PerHostAsyncTransport(httpx.Limits(max_connections=2), http2=False)
+    openai = transport.get_transport(httpx.URL("https://api.openai.com/v1/chat"))
+    assert (
+        transport.get_transport(httpx.URL("https://api.openai.com/v1/models"))
+        is openai
+    )
+    assert transport.get_transport(httpx.URL("https://localhost:8000/v1")) is not openai
+
+
+@pytest.mark.parametrize(
+    "module, name",
+    [
+        ("llama_index.llms.openai", "OpenAI"),
+        ("llama_index.llms.openai_like", "OpenAILike"),
+        ("llama_index.embeddings.openai", "OpenAIEmbedding"),
+    ],
+)
+def test_providers_accept_the_shared_http_clients(module, name):
+    # the shared clients are passed to these classes (see `get_openai_http_clients`)
+    cls = getattr(pytest.importorskip(module), name)
+    parameters = inspect.signature(cls.__init__).parameters
+    assert "http_client" in parameters
+    assert "async_http_client" in parameters
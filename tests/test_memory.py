@@ -0,0 +1,163 @@
+from typing import List
+
+import pytest
+from llama_index.core.llms import ChatMessage, MessageRole
+from llama_index.core.memory import ChatMemoryBuffer
+
+from app.agents.memory import CompactingChatMemory, TokenCountingChatMemory
+
+
+class CountingTokenizer:
+    # one token per word, counting the tokenized texts
+    def __init__(self) -> None:
+        self.calls = 0
+
+    def __call__(self, text: str) -> List[str]:
+        self.calls += 1
+        return text.split()
+
+
+def message(role: MessageRole, words: int, name: str = "") -> ChatMessage:
+    return ChatMessage(role=role, content=" ".join([name or role.value] * words))
+
+
+def tool_call_turn(index: int) -> List[ChatMessage]:
+    return [
+        message(MessageRole.USER, 10, f"user{index}"),
+        message(MessageRole.ASSISTANT, 5, f"call{index}"),
+        message(MessageRole.TOOL, 20, f"result{index}"),
+        message(MessageRole.TOOL, 20, f"result{index}"),
+        message(MessageRole.ASSISTANT, 10, f"answer{index}"),
+    ]
+
+
+def create_memory(cls, token_limit: int, messages: List[ChatMessage]):
+    tokenizer = CountingTokenizer()
+    memory = cls.from_defaults(token_limit=token_limit, tokenizer_fn=tokenizer)
+    for msg in messages:
+        memory.put(msg)
+    return memory, tokenizer
+
+
+@pytest.mark.parametrize("token_limit", [20, 65, 100, 130, 200, 1000])
+def test_trims_the_history_like_the_chat_memory_buffer(token_limit):
+    messages = [
+        message(MessageRole.USER, 10, "user0"),
+        message(MessageRole.ASSISTANT, 15, "answer0"),
+        message(MessageRole.USER, 10, "user1"),
+        message(MessageRole.ASSISTANT, 15, "answer1"),
+        message(MessageRole.USER, 10, "user2"),
+    ]
+    memory, _ = create_memory(TokenCountingChatMemory, token_limit, messages)
+    buffer, _ = create_memory(ChatMemoryBuffer, token_limit, messages)
+
+    assert memory.get() == buffer.get()
+    assert memory.get(initial_token_count=15) == buffer.get(initial_token_count=15)
+
+
+def test_trimmed_history_never_starts_with_a_tool_result():
+    messages = tool_call_turn(0) + tool_call_turn(1)
+    memory, _ = create_memory(TokenCountingChatMemory, 40, messages)
+
+    # the limit is reached within the tool results or at the tool call of turn 1
+    assert memory.get() == []
+    memory.token_limit = 60
+    assert memory.get() == []
+    memory.token_limit = 70
+    assert memory.get() == messages[5:]
+
+
+def test_tokenizes_each_message_once():
+    messages = tool_call_turn(0) + tool_call_turn(1)
+    memory, tokenizer = create_memory(TokenCountingChatMemory, 100, messages)
+
+    memory.get()
+    assert tokenizer.calls == len(messages)
+    memory.put(message(MessageRole.USER, 10, "user2"))
+    memory.get()
+    memory.get()
+    assert tokenizer.calls == len(messages) + 1
+
+
+def test_recounts_changed_messages():
+    memory, tokenizer = create_memory(
+        TokenCountingChatMemory,
+        30,
+        [message(MessageRole.USER, 10), message(MessageRole.ASSISTANT, 10)],
+    )
+    assert len(memory.get()) == 2
+
+    # e.g. a draft with applied edits
+    memory.get_all()[1].content = " ".join(["draft"] * 25)
+    assert memory.get() == []
+    memory.set([message(MessageRole.USER, 5)])
+    assert len(memory.get()) == 1
+    assert tokenizer.calls == 4
+
+
+def test_initial_token_count_above_the_limit_raises():
+    memory, _ = create_memory(TokenCountingChatMemory, 10, [])
+    with pytest.raises(ValueError):
+        memory.get(initial_token_count=11)
+
+
+def test_compacts_superseded_turns_to_the_task_and_the_answer():
+    system = message(MessageRole.SYSTEM, 10)
+    memory, _ = create_memory(CompactingChatMemory, 1000, [])
+    memory.summary_tokens = 5
+    for msg in [system, *tool_call_turn(0), system, *tool_call_turn(1)]:
+        memory.put(msg)
+
+    memory.put(message(MessageRole.USER, 10, "user2"))
+    history = memory.get_all()
+    # the system prompt is kept once, the tool calls and their results are dropped
+    assert [msg.content for msg in history] == [
+        system.content,
+        "user0 user0 [...]",
+        "answer0 [...]",
+        "user1 user1 [...]",
+        "answer1 [...]",
+        " ".join(["user2"] * 10),
+    ]
+    assert memory.get() == history
+
+
+def test_keeps_the_latest_turn_verbatim():
+    memory, _ = create_memory(
+        CompactingChatMemory,
+        1000,
+        [message(MessageRole.SYSTEM, 10), *tool_call_turn(0)],
+    )
+    memory.put(message(MessageRole.USER, 10, "user1"))
+    memory.put(message(MessageRole.ASSISTANT, 5, "call1"))
+    memory.put(message(MessageRole.TOOL, 20, "result1"))
+
+    assert [msg.content.split()[0] for msg in memory.get()] == [
+        "system",
+        "user0",
+        "answer0",
+        "user1",
+        "call1",
+        "result1",
+    ]
+
+
+def test_drops_the_oldest_compacted_turns_and_keeps_the_system_prompt():
+    system = message(MessageRole.SYSTEM, 10)
+    memory, _ = create_memory(CompactingChatMemory, 1000, [system])
+    for index in range(3):
+        memory.put(message(MessageRole.USER, 10, f"user{index}"))
+        memory.put(message(MessageRole.ASSISTANT, 10, f"answer{index}"))
+
+    # system prompt, the compacted turn 1 and the latest turn
+    memory.token_limit = 55
+    assert [msg.content.split()[0] for msg in memory.get()] == [
+        "system",
+        "user1",
+        "answer1",
+        "user2",
+        "answer2",
+    ]
+    # the latest turn alone is too long
+    memory.token_limit = 15
+    assert memory.get() == [system]
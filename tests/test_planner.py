@@ -0,0 +1,79 @@
+from llama_index.core.agent.runner.planner import Plan, SubTask
+
+from app.agents.planner import CachedPlan, reparameterize_plan
+
+
+def cached_plan(task: str, *sub_tasks: tuple) -> CachedPlan:
+    return CachedPlan(
+        task=task,
+        plan=Plan(
+            sub_tasks=[
+                SubTask(
+                    name=f"step_{index}",
+                    input=input,
+                    expected_output=expected_output,
+                    dependencies=[f"step_{index - 1}"] if index else [],
+                )
+                for index, (input, expected_output) in enumerate(sub_tasks)
+            ]
+        ),
+    )
+
+
+BLOG_POST_PLAN = cached_plan(
+    "Write a blog post about Go",
+    ("Research the history of Go", "Facts about Go"),
+    ("Write a blog post about Go", "A blog post"),
+)
+
+
+def test_reparameterize_plan_replaces_the_parameter_of_the_task():
+    plan = reparameterize_plan(BLOG_POST_PLAN, "Write a blog post about Rust")
+
+    assert [
+        (sub_task.input, sub_task.expected_output) for sub_task in plan.sub_tasks
+    ] == [
+        ("Research the history of Rust", "Facts about Rust"),
+        ("Write a blog post about Rust", "A blog post"),
+    ]
+    assert [sub_task.dependencies for sub_task in plan.sub_tasks] == [[], ["step_0"]]
+    # the cached plan is unchanged
+    assert BLOG_POST_PLAN.plan.sub_tasks[0].input == "Research the history of Go"
+
+
+def test_reparameterize_plan_replaces_parameters_of_several_words():
+    plan = reparameterize_plan(
+        BLOG_POST_PLAN, "Write a blog post about physical AI in Europe"
+    )
+    assert plan.sub_tasks[1].input == "Write a blog post about physical AI in Europe"
+
+
+def test_reparameterize_plan_returns_a_copy_for_the_same_task():
+    plan = reparameterize_plan(BLOG_POST_PLAN, "Write  a blog post about Go")
+    assert plan == BLOG_POST_PLAN.plan
+    assert plan is not BLOG_POST_PLAN.plan
+
+
+def test_reparameterize_plan_rejects_parameters_within_other_words():
+    cached = cached_plan(
+        "Write a blog post about Go",
+        ("Research how Google uses Go", "Facts"),
+    )
+    # "Go" in "Google" isn't replaced, so the sub task would mix both tasks
+    assert reparameterize_plan(cached, "Write a blog post about Rust") is None
+
+
+def test_reparameterize_plan_rejects_plans_not_mentioning_the_parameter():
+    cached = cached_plan(
+        "Write a blog post about Go",
+        ("Research the topic", "Facts"),
+    )
+    assert reparameterize_plan(cached, "Write a blog post about Rust") is None
+
+
+def test_reparameterize_plan_rejects_tasks_only_adding_words():
+    cached = cached_plan(
+        "Write a blog post",
+        ("Write a blog post", "A blog post"),
+    )
+    assert reparameterize_plan(cached, "Write a short blog post") is None
@@ -0,0 +1,225 @@
+import asyncio
+import json
+import time
+
+import httpx
+import pytest
+
+from app import rate_limit
+from app.rate_limit import (
+    Priority,
+    RateLimitedSyncTransport,
+    RateLimitedTransport,
+    RateLimiter,
+    TokenBucket,
+    llm_priority,
+)
+
+
+class Clock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(rate_limit.time, "monotonic", clock)
+    return clock
+
+
+@pytest.fixture(autouse=True)
+def rate_limiters(monkeypatch):
+    monkeypatch.setattr(rate_limit, "_rate_limiters", {})
+    monkeypatch.setenv("LLM_MAX_CONCURRENCY", "32")
+    monkeypatch.delenv("LLM_RPM", raising=False)
+    monkeypatch.delenv("LLM_TPM", raising=False)
+    return rate_limit._rate_limiters
+
+
+def chat_request(model: str = "test-model") -> dict:
+    return {"model": model, "messages": [{"role": "user", "content": "hi"}]}
+
+
+def test_token_bucket_refills_per_minute(clock):
+    bucket = TokenBucket(per_minute=60)
+    assert bucket.wait_time(60) == 0
+    bucket.take(60)
+    assert bucket.wait_time(1) == pytest.approx(1)
+
+    clock.now += 30
+    assert bucket.wait_time(30) == 0
+    assert bucket.wait_time(31) == pytest.approx(1)
+    # a request larger than the bucket only waits for a full bucket
+    assert bucket.wait_time(1000) == pytest.approx(30)
+
+
+def test_token_bucket_is_limited_by_the_remaining_quota(clock):
+    bucket = TokenBucket(per_minute=600)
+    bucket.limit(10)
+    assert bucket.wait_time(10) == 0
+    assert bucket.wait_time(20) == pytest.approx(1)
+
+
+def test_rate_limiter_limits_the_requests_in_flight():
+    async def main():
+        limiter = RateLimiter(name="test", max_concurrency=1)
+        await limiter.acquire(Priority.INTERACTIVE, 0)
+        waiting = asyncio.create_task(limiter.acquire(Priority.INTERACTIVE, 0))
+        await asyncio.sleep(0.01)
+        assert not waiting.done()
+        assert limiter.queued == 1
+
+        limiter.release()
+        await asyncio.wait_for(waiting, 1)
+        assert limiter.in_flight == 1
+        assert limiter.queued == 0
+
+    asyncio.run(main())
+
+
+def test_rate_limiter_sends_by_priority_then_in_order():
+    async def main():
+        limiter = RateLimiter(name="test", max_concurrency=1)
+        await limiter.acquire(Priority.INTERACTIVE, 0)
+        order = []
+
+        async def request(name, priority):
+            await limiter.acquire(priority, 0)
+            order.append(name)
+            limiter.release()
+
+        tasks = []
+        for name, priority in (
+            ("batch", Priority.BATCH),
+            ("ingestion", Priority.INGESTION),
+            ("interactive 1", Priority.INTERACTIVE),
+            ("interactive 2", Priority.INTERACTIVE),
+        ):
+            tasks.append(asyncio.create_task(request(name, priority)))
+            await asyncio.sleep(0)
+        limiter.release()
+        await asyncio.wait_for(asyncio.gather(*tasks), 1)
+        return order
+
+    assert asyncio.run(main()) == [
+        "interactive 1",
+        "interactive 2",
+        "batch",
+        "ingestion",
+    ]
+
+
+def test_rate_limiter_dequeues_cancelled_requests():
+    async def main():
+        limiter = RateLimiter(name="test", max_concurrency=1)
+        await limiter.acquire(Priority.INTERACTIVE, 0)
+        waiting = asyncio.create_task(limiter.acquire(Priority.INTERACTIVE, 0))
+        await asyncio.sleep(0.01)
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        assert limiter.queued == 0
+
+    asyncio.run(main())
+
+
+def test_rate_limiter_takes_the_limits_from_the_response_headers(clock):
+    limiter = RateLimiter(name="test", max_concurrency=1, rpm=100, tpm=1000)
+    limiter.update(
+        httpx.Headers(
+            {
+                "x-ratelimit-remaining-requests": "0",
+                "x-ratelimit-remaining-tokens": "invalid",
+            }
+        )
+    )
+    assert limiter.requests.wait_time(1) == pytest.approx(0.6)
+    assert limiter.tokens.wait_time(1000) == 0
+
+
+@pytest.mark.parametrize(
+    "headers, expected",
+    [
+        ({"retry-after-ms": "1500"}, 1.5),
+        ({"retry-after": "2"}, 2),
+        ({"retry-after": "Thu, 01 Jan 1970 00:00:00 GMT"}, 0),
+    ],
+)
+def test_retry_delay_is_given_by_the_provider(headers, expected):
+    response = httpx.Response(429, headers=headers)
+    assert rate_limit._retry_delay(response, attempt=0) == pytest.approx(expected)
+
+
+def test_retry_delay_backs_off_exponentially():
+    response = httpx.Response(429)
+    assert 2 <= rate_limit._retry_delay(response, attempt=2) <= 4
+    assert 30 <= rate_limit._retry_delay(response, attempt=10) <= 60
+
+
+def test_rate_limited_requests_pause_the_limiter_and_are_retried(rate_limiters):
+    sent = []
+
+    def handler(request):
+        sent.append(time.monotonic())
+        if len(sent) < 3:
+            return httpx.Response(429, headers={"retry-after-ms": "50"})
+        # a stream like the one of a real transport, the client reads and closes it
+        return httpx.Response(200, stream=httpx.ByteStream(b'{"ok": true}'))
+
+    async def main():
+        transport = RateLimitedTransport(httpx.MockTransport(handler))
+        async with httpx.AsyncClient(transport=transport) as client:
+            response = await client.post(
+                "https://api.test/v1/chat/completions", json=chat_request()
+            )
+        return response
+
+    response = asyncio.run(main())
+    assert response.status_code == 200
+    assert len(sent) == 3
+    assert sent[1] - sent[0] >= 0.05
+    assert sent[2] - sent[1] >= 0.05
+    assert rate_limiters[("api.test", "test-model")].in_flight == 0
+
+
+def test_rate_limited_requests_give_up_after_the_retries(monkeypatch, rate_limiters):
+    monkeypatch.setenv("LLM_RATE_LIMIT_RETRIES", "1")
+    sent = []
+
+    def handler(request):
+        sent.append(request)
+        return httpx.Response(
+            429, headers={"retry-after-ms": "10"}, stream=httpx.ByteStream(b"")
+        )
+
+    with httpx.Client(
+        transport=RateLimitedSyncTransport(httpx.MockTransport(handler))
+    ) as client:
+        response = client.post(
+            "https://api.test/v1/chat/completions", json=chat_request()
+        )
+    assert response.status_code == 429
+    assert len(sent) == 2
+    assert rate_limiters[("api.test", "test-model")].in_flight == 0
+
+
+def test_requests_without_a_model_are_not_limited(rate_limiters):
+    def handler(request):
+        return httpx.Response(200)
+
+    with httpx.Client(
+        transport=RateLimitedSyncTransport(httpx.MockTransport(handler))
+    ) as client:
+        client.get("https://api.test/v1/models")
+        client.post("https://api.test/upload", content=json.dumps([1, 2]))
+    assert rate_limiters == {}
+
+
+def test_llm_priority_sets_the_priority_of_the_requests():
+    with llm_priority(Priority.BATCH):
+        assert rate_limit._priority.get() == Priority.BATCH
+    assert rate_limit._priority.get() == Priority.INTERACTIVE
@@ -0,0 +1,101 @@
+import pytest
+from llama_index.core.utils import get_tokenizer
+
+from app.agents import tool_output
+from app.agents.tool_output import (
+    ToolOutputPolicy,
+    ToolOutputStore,
+    ToolOutputStrategy,
+    get_tool_output_policy,
+    shorten_tool_output,
+)
+
+LONG_OUTPUT = " ".join(f"Sentence number {index} is filler." for index in range(200))
+
+
+def count_tokens(text: str) -> int:
+    return len(get_tokenizer()(text))
+
+
+@pytest.fixture
+def policies(monkeypatch):
+    monkeypatch.setattr(tool_output, "_tool_output_policies", {})
+    config = {"tool_outputs": {}}
+    monkeypatch.setattr(tool_output, "load_models_config", lambda: config)
+    return config["tool_outputs"]
+
+
+def test_tool_outputs_are_kept_without_a_policy(policies):
+    assert get_tool_output_policy("call_researcher") is None
+
+
+def test_tool_output_policy_falls_back_to_the_default(policies):
+    policies["default"] = {"max_tokens": 500}
+    policies["call_researcher"] = {"max_tokens": 1000, "strategy": "extract"}
+
+    assert get_tool_output_policy("call_researcher") == ToolOutputPolicy(
+        max_tokens=1000, strategy=ToolOutputStrategy.EXTRACT
+    )
+    assert get_tool_output_policy("other") == ToolOutputPolicy(
+        max_tokens=500, strategy=ToolOutputStrategy.HEAD_TAIL
+    )
+
+
+def test_short_outputs_are_kept():
+    policy = ToolOutputPolicy(max_tokens=100)
+    assert shorten_tool_output("Short.", policy, ToolOutputStore(), "tool") == "Short."
+
+
+def test_head_tail_keeps_the_beginning_and_the_end():
+    policy = ToolOutputPolicy(max_tokens=100, strategy=ToolOutputStrategy.HEAD_TAIL)
+    shortened = shorten_tool_output(LONG_OUTPUT, policy, ToolOutputStore(), "tool")
+
+    assert shortened.startswith("Sentence number 0 is filler.")
+    assert shortened.endswith("Sentence number 199 is filler.")
+    assert "tokens omitted" in shortened
+    assert count_tokens(shortened) < 130
+
+
+def test_extract_keeps_the_relevant_sentences_in_order():
+    content = LONG_OUTPUT.replace(
+        "Sentence number 150 is filler.", "Rust guarantees memory safety."
+    ).replace("Sentence number 50 is filler.", "Rust compiles to native code.")
+    policy = ToolOutputPolicy(max_tokens=20, strategy=ToolOutputStrategy.EXTRACT)
+
+    shortened = shorten_tool_output(
+        content, policy, ToolOutputStore(), "tool", tool_input="How safe is Rust?"
+    )
+    assert shortened.startswith(
+        "Rust compiles to native code. [...] Rust guarantees memory safety."
+    )
+    assert count_tokens(shortened) <= 30
+
+
+def test_extract_without_a_fitting_sentence_keeps_the_beginning():
+    content = "x" * 10_000
+    assert tool_output._extract(content, "query", max_chars=100) == "x" * 100
+
+
+def test_handle_stores_the_full_output_for_the_read_tool():
+    store = ToolOutputStore(page_tokens=100)
+    policy = ToolOutputPolicy(max_tokens=100, strategy=ToolOutputStrategy.HANDLE)
+
+    shortened = shorten_tool_output(LONG_OUTPUT, policy, store, "tool")
+    handle = shortened.split("handle '")[1].split("'")[0]
+    offset = int(shortened.split("offset ")[1].split(" ")[0])
+    assert LONG_OUTPUT.startswith(shortened.split("\n")[0])
+
+    page = store.read(handle, offset)
+    assert page.startswith(LONG_OUTPUT[offset : offset + 400])
+    assert f"continue with offset {offset + 400}]" in page
+    assert store.read(handle, len(LONG_OUTPUT) - 10) == LONG_OUTPUT[-10:]
+    assert "no tool output" in store.read("missing")
+
+
+def test_read_tool_output_tool():
+    store = ToolOutputStore()
+    handle = store.put("full output")
+    tool = store.as_tool()
+
+    assert tool.metadata.name == tool_output.READ_TOOL_OUTPUT_TOOL_NAME
+    assert tool(handle=handle, offset=5).content == "output"